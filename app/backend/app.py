@@ -1,31 +1,34 @@
-import io
 import json
 import logging
 import mimetypes
 import os
 import time
 from pathlib import Path
-from typing import AsyncGenerator
-import requests
+from typing import Any, AsyncGenerator, Optional, Union
 
 import aiohttp
 import openai
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
-from azure.storage.blob.aio import BlobServiceClient
+from azure.storage.blob.aio import (
+    BlobClient,
+    BlobServiceClient,
+    StorageStreamDownloader,
+)
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
@@ -33,6 +36,9 @@ from quart_cors import cors
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from core.authentication import AuthenticationHelper
+from core.cache import CacheGeneration, create_cache
+from core.contentcache import ContentCache, ContentCacheEntry, ContentCacheFileBody
+from core.feedback import FeedbackSink
 
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
@@ -41,6 +47,11 @@ CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_SEARCH_CLIENT = "search_client"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_OPENAI_SESSION = "openai_session"
+CONFIG_FEEDBACK_SINK = "feedback_sink"
+CONFIG_CONTENT_CACHE = "content_cache"
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -76,29 +87,138 @@ async def assets(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed in chunks, and Range and If-None-Match requests are passed on to
+# Blob Storage. Hot files can additionally be kept in a local disk cache (see CONTENT_CACHE_DIR).
 @bp.route("/content/<path>")
 async def content_file(path: str):
     # Remove page number from path, filename-1.txt -> filename.txt
     if path.find("#page=") > 0:
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
-    logging.info("Opening file %s at page %s", path)
-    blob_container_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    logging.info("Opening file %s", path)
+    blob_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].get_blob_client(path)
+    content_cache: Optional[ContentCache] = current_app.config[CONFIG_CONTENT_CACHE]
+    if content_cache:
+        return await send_cached_content(content_cache, blob_client, path)
+
+    offset, length = None, None
+    # Only a single range with a known start is passed on, other requests get the whole file
+    if request.range and request.range.units == "bytes" and len(request.range.ranges) == 1:
+        start, stop = request.range.ranges[0]
+        if start >= 0:
+            offset, length = start, (stop - start if stop is not None else None)
+    if_none_match = request.headers.get("If-None-Match")
+    conditions: dict[str, Any] = {}
+    if if_none_match and "," not in if_none_match and if_none_match != "*":
+        conditions = {"etag": if_none_match, "match_condition": MatchConditions.IfModified}
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        blob = await blob_client.download_blob(offset=offset, length=length, **conditions)
     except ResourceNotFoundError:
         logging.exception("Path not found: %s", path)
         abort(404)
+    except HttpResponseError as error:
+        # Blob Storage answers 304 if the ETag still matches, and 416 if the range starts past the end of the blob
+        if error.status_code == 304:
+            return Response(b"", status=304, headers={"ETag": if_none_match})
+        if error.status_code == 416:
+            abort(416)
+        raise
+    return stream_blob(blob, path, offset)
+
+
+def get_blob_content_type(blob: StorageStreamDownloader, path: str) -> str:
     if not blob.properties or not blob.properties.has_key("content_settings"):
         abort(404)
     mime_type = blob.properties["content_settings"]["content_type"]
     if mime_type == "application/octet-stream":
         mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    return mime_type
+
+
+def stream_blob(blob: StorageStreamDownloader, path: str, offset: Optional[int] = None) -> Response:
+    mime_type = get_blob_content_type(blob, path)
+    size = blob.size or 0
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(size)}
+    properties = blob.properties
+    if properties is not None and properties.etag:
+        headers["ETag"] = properties.etag
+    status = 200
+    if offset is not None:
+        status = 206
+        # The total length of the blob is only known from the Content-Range Blob Storage answered with
+        blob_size = "*"
+        if properties is not None and properties.content_range:
+            blob_size = properties.content_range.rsplit("/", 1)[1]
+        headers["Content-Range"] = f"bytes {offset}-{offset + size - 1}/{blob_size}"
+    return Response(
+        iter_blob_chunks(blob), status=status, headers=headers, mimetype=mime_type  # type: ignore[type-var]
+    )
+
+
+async def iter_blob_chunks(blob: StorageStreamDownloader) -> AsyncGenerator[bytes, None]:
+    # Quart only streams async generators, not other async iterables
+    async for chunk in blob.chunks():
+        yield chunk
+
+
+async def send_cached_content(content_cache: ContentCache, blob_client: BlobClient, path: str) -> Response:
+    # Holds on to the entry from the lookup on, so its file can't be deleted while it is revalidated
+    entry = content_cache.get(path)
+    if entry is not None:
+        content_cache.acquire(entry)
+    if entry is None or not content_cache.is_fresh(entry):
+        refreshed = await refresh_cached_content(content_cache, blob_client, path, entry)
+        if isinstance(refreshed, Response):
+            return refreshed
+        entry = refreshed
+
+    # The body takes over the hold and keeps the file until it is sent, even if the entry is replaced or evicted
+    response = Response(ContentCacheFileBody(content_cache, entry), mimetype=entry.content_type)
+    response.content_length = entry.size
+    response.headers["ETag"] = entry.etag
+    # Answers Range and If-None-Match requests from the local copy
+    return await response.make_conditional(request, accept_ranges=True, complete_length=entry.size)
+
+
+async def refresh_cached_content(
+    content_cache: ContentCache, blob_client: BlobClient, path: str, entry: Optional[ContentCacheEntry]
+) -> Union[ContentCacheEntry, Response]:
+    """
+    Revalidates or downloads the blob, taking over the hold on the stale entry.
+    Returns a held entry to serve, or a response streaming blobs that aren't cached.
+    """
+    conditions: dict[str, Any] = {}
+    if entry:
+        conditions = {"etag": entry.etag, "match_condition": MatchConditions.IfModified}
+    try:
+        try:
+            blob = await blob_client.download_blob(**conditions)
+        except ResourceNotFoundError:
+            logging.exception("Path not found: %s", path)
+            content_cache.remove(path)
+            abort(404)
+        except HttpResponseError as error:
+            if not (entry and error.status_code == 304):
+                raise
+            if content_cache.revalidate(entry):
+                # Hands the hold over to the caller instead of releasing it
+                revalidated, entry = entry, None
+                return revalidated
+            blob = None
+    finally:
+        if entry:
+            content_cache.release(entry)
+    if blob is None:
+        # The entry was evicted while it was revalidated, so the blob is downloaded again
+        return await refresh_cached_content(content_cache, blob_client, path, None)
+    mime_type = get_blob_content_type(blob, path)
+    etag = blob.properties.etag if blob.properties is not None else None
+    if blob.size is None or not etag or not content_cache.fits(blob.size):
+        content_cache.remove(path)
+        return stream_blob(blob, path)
+    stored = await content_cache.store(path, etag, mime_type, blob.chunks())
+    content_cache.acquire(stored)
+    return stored
 
 
 def error_dict(error: Exception) -> dict:
@@ -111,28 +231,25 @@ async def save_conversation():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
-    headers = {
-        'apikey': current_app.config["SUPABASE_KEY"],
-        'Authorization': 'Bearer ' + current_app.config["SUPABASE_KEY"],
-        'Content-Type': 'application/json',
-        'Prefer': 'return=minimal'
-    }
     data = {
-        'conversation_id': request_json.get("conversationId"),
-        'rating': request_json.get("rating"),
-        'feedback': request_json.get("feedback"),
-        'question': request_json.get("question"),
-        'answer': request_json.get("answer"),
-        'model_config': request_json.get("modelConfig"),
-        'conversation_object': request_json.get("conversation")
-    }     
+        "conversation_id": request_json.get("conversationId"),
+        "rating": request_json.get("rating"),
+        "feedback": request_json.get("feedback"),
+        "question": request_json.get("question"),
+        "answer": request_json.get("answer"),
+        "model_config": request_json.get("modelConfig"),
+        "conversation_object": request_json.get("conversation"),
+    }
 
+    feedback_sink = current_app.config[CONFIG_FEEDBACK_SINK]
+    if feedback_sink is None:
+        return jsonify({"error": "feedback storage is not configured"}), 500
     try:
-        response = requests.post(current_app.config["SUPABASE_URL"], headers=headers, json=data)
-        response.raise_for_status()
-        return jsonify({"result": "ok", "response": response.text})
+        # The row is stored in the background, so a slow database doesn't hold up this worker's other requests
+        feedback_sink.add(data)
+        return jsonify({"result": "ok"}), 202
     except Exception as error:
-        logging.exception("Exception in /ask: %s", error)
+        logging.exception("Exception in /save_conversation: %s", error)
         return jsonify(error_dict(error)), 500
 
 
@@ -146,12 +263,9 @@ async def ask():
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
     try:
         approach = current_app.config[CONFIG_ASK_APPROACH]
-        # Workaround for: https://github.com/openai/openai-python/issues/371
-        async with aiohttp.ClientSession() as s:
-            openai.aiosession.set(s)
-            r = await approach.run(
-                request_json["messages"], context=context, session_state=request_json.get("session_state")
-            )
+        r = await approach.run(
+            request_json["messages"], context=context, session_state=request_json.get("session_state")
+        )
         return jsonify(r)
     except Exception as error:
         logging.exception("Exception in /ask: %s", error)
@@ -202,6 +316,13 @@ def auth_setup():
     return jsonify(auth_helper.get_auth_setup_for_client())
 
 
+@bp.before_request
+async def use_openai_session():
+    # openai.aiosession is a context variable, so it's set for each request rather than once at startup.
+    # Workaround for: https://github.com/openai/openai-python/issues/371
+    openai.aiosession.set(current_app.config[CONFIG_OPENAI_SESSION])
+
+
 @bp.before_request
 async def ensure_openai_token():
     if openai.api_type != "azure_ad":
@@ -239,15 +360,49 @@ async def setup_clients():
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
     TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH")
+    # Cache each user's claims (including groups read from Microsoft Graph) for up to AUTH_CLAIMS_CACHE_TTL seconds
+    AUTH_CLAIMS_CACHE_SIZE = int(os.getenv("AUTH_CLAIMS_CACHE_SIZE", "0"))
+    AUTH_CLAIMS_CACHE_TTL = float(os.getenv("AUTH_CLAIMS_CACHE_TTL", "300"))
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
 
     AZURE_SEARCH_QUERY_LANGUAGE = os.getenv("AZURE_SEARCH_QUERY_LANGUAGE", "en-us")
     AZURE_SEARCH_QUERY_SPELLER = os.getenv("AZURE_SEARCH_QUERY_SPELLER", "lexicon")
+    # Overlap the chat approach's query rewrite, embedding and search calls (see ChatReadRetrieveReadApproach)
+    AZURE_OPENAI_SPECULATIVE_EMBEDDING = os.getenv("AZURE_OPENAI_SPECULATIVE_EMBEDDING") or None
+    AZURE_SEARCH_CONCURRENT_SUBQUERIES = os.getenv("AZURE_SEARCH_CONCURRENT_SUBQUERIES", "").lower() == "true"
+    # Pack as many retrieved sources into the chat prompt as fit its token limit, truncating the rest
+    AZURE_OPENAI_PACK_SOURCES = os.getenv("AZURE_OPENAI_PACK_SOURCES", "").lower() == "true"
+    # Cache query embeddings in memory (number of entries), optionally backed by a SQLite database shared by workers
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "0"))
+    EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+    EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+    # Cache search results the same way. prepdocs.py invalidates them by touching a marker file for the index
+    SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "0"))
+    SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+    SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH")
+    SEARCH_CACHE_GENERATION_DIR = os.getenv("SEARCH_CACHE_GENERATION_DIR")
+    # Cache chat answers generated with temperature 0 for single-turn conversations
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "0"))
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH")
+
+    # Connection pool shared by all OpenAI calls, so TCP and TLS connections are reused across requests
+    OPENAI_CONNECTION_LIMIT = int(os.getenv("OPENAI_CONNECTION_LIMIT", "100"))
+    OPENAI_CONNECTION_LIMIT_PER_HOST = int(os.getenv("OPENAI_CONNECTION_LIMIT_PER_HOST", "0"))
+    OPENAI_KEEPALIVE_TIMEOUT = float(os.getenv("OPENAI_KEEPALIVE_TIMEOUT", "60"))
+
+    # Stream /content files in chunks, optionally keeping hot files in a local disk cache of CONTENT_CACHE_SIZE bytes
+    CONTENT_CHUNK_SIZE = int(os.getenv("CONTENT_CHUNK_SIZE", str(1024 * 1024)))
+    CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR")
+    CONTENT_CACHE_SIZE = int(os.getenv("CONTENT_CACHE_SIZE", str(256 * 1024 * 1024)))
+    CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", "60"))
 
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+    # Feedback rows that can't be saved to Supabase are kept in this JSON Lines file and sent on the next start
+    FEEDBACK_SPILL_PATH = os.getenv("FEEDBACK_SPILL_PATH")
 
     # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -263,6 +418,8 @@ async def setup_clients():
         client_app_id=AZURE_CLIENT_APP_ID,
         tenant_id=AZURE_TENANT_ID,
         token_cache_path=TOKEN_CACHE_PATH,
+        claims_cache_size=AUTH_CLAIMS_CACHE_SIZE,
+        claims_cache_ttl=AUTH_CLAIMS_CACHE_TTL,
     )
 
     # Set up clients for Cognitive Search and Storage
@@ -271,8 +428,12 @@ async def setup_clients():
         index_name=AZURE_SEARCH_INDEX,
         credential=azure_credential,
     )
+    # Content files are streamed in chunks of this size, the first chunk is read before the response starts
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        max_single_get_size=CONTENT_CHUNK_SIZE,
+        max_chunk_get_size=CONTENT_CHUNK_SIZE,
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
 
@@ -295,6 +456,17 @@ async def setup_clients():
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
 
+    # Shared by both approaches, as they embed the same questions with the same model
+    embedding_cache = create_cache("embeddings", EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL, EMBEDDING_CACHE_PATH)
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    search_cache = create_cache(f"search-{AZURE_SEARCH_INDEX}", SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_PATH)
+    search_cache_generation = (
+        CacheGeneration(os.path.join(SEARCH_CACHE_GENERATION_DIR, f"{AZURE_SEARCH_INDEX}.generation"))
+        if SEARCH_CACHE_GENERATION_DIR
+        else None
+    )
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -308,6 +480,9 @@ async def setup_clients():
         KB_FIELDS_CONTENT,
         AZURE_SEARCH_QUERY_LANGUAGE,
         AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        search_cache_generation=search_cache_generation,
     )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -321,10 +496,39 @@ async def setup_clients():
         KB_FIELDS_CONTENT,
         AZURE_SEARCH_QUERY_LANGUAGE,
         AZURE_SEARCH_QUERY_SPELLER,
+        embedding_cache=embedding_cache,
+        search_cache=search_cache,
+        search_cache_generation=search_cache_generation,
+        answer_cache=create_cache("answers", ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_PATH),
+        speculative_embedding=AZURE_OPENAI_SPECULATIVE_EMBEDDING,
+        concurrent_subqueries=AZURE_SEARCH_CONCURRENT_SUBQUERIES,
+        pack_sources=AZURE_OPENAI_PACK_SOURCES,
+    )
+
+    current_app.config[CONFIG_OPENAI_SESSION] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=OPENAI_CONNECTION_LIMIT,
+            limit_per_host=OPENAI_CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT,
+        )
+    )
+
+    current_app.config[CONFIG_CONTENT_CACHE] = (
+        ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_SIZE, CONTENT_CACHE_TTL) if CONTENT_CACHE_DIR else None
     )
 
-    current_app.config["SUPABASE_URL"] = SUPABASE_URL
-    current_app.config["SUPABASE_KEY"] = SUPABASE_KEY
+    feedback_sink = None
+    if SUPABASE_URL:
+        feedback_sink = FeedbackSink(SUPABASE_URL, SUPABASE_KEY or "", spill_path=FEEDBACK_SPILL_PATH)
+        await feedback_sink.start()
+    current_app.config[CONFIG_FEEDBACK_SINK] = feedback_sink
+
+
+@bp.after_app_serving
+async def close_clients():
+    if feedback_sink := current_app.config[CONFIG_FEEDBACK_SINK]:
+        await feedback_sink.close()
+    await current_app.config[CONFIG_OPENAI_SESSION].close()
 
 
 def create_app():
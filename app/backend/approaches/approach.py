@@ -1,19 +1,181 @@
+import asyncio
+import unicodedata
 from abc import ABC
 from typing import Any, AsyncGenerator, Optional, Union
 
+import openai
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryType
+
 from core.authentication import AuthenticationHelper
+from core.cache import Cache, CacheGeneration
+from text import nonewlines
 
 
 class Approach(ABC):
+    # Subclasses set these in their constructors
+    search_client: SearchClient
+    openai_host: str
+    embedding_deployment: Optional[str]
+    embedding_model: str
+    query_language: str
+    query_speller: str
+    sourcepage_field: str
+    content_field: str
+    embedding_cache: Optional[Cache] = None
+    search_cache: Optional[Cache] = None
+    search_cache_generation: Optional[CacheGeneration] = None
+
+    # Constant used by reciprocal rank fusion when merging concurrent text and vector sub-queries
+    # https://learn.microsoft.com/azure/search/hybrid-search-ranking
+    RRF_K = 60
+
     def build_filter(self, overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
-        exclude_category = overrides.get("exclude_category") or None
-        security_filter = AuthenticationHelper.build_security_filters(overrides, auth_claims)
-        filters = []
-        if exclude_category:
-            filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
-        if security_filter:
-            filters.append(security_filter)
-        return None if len(filters) == 0 else " and ".join(filters)
+        return AuthenticationHelper.build_filter(overrides, auth_claims)
+
+    async def compute_text_embedding(self, q: str) -> list[float]:
+        if self.embedding_cache:
+            # Users often ask the exact same question, only differing in whitespace
+            cache_key = Cache.make_key(self.embedding_model, unicodedata.normalize("NFC", " ".join(q.split())))
+            if (cached_embedding := await self.embedding_cache.get(cache_key)) is not None:
+                return cached_embedding
+        embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
+        embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=q)
+        query_vector = embedding["data"][0]["embedding"]
+        if self.embedding_cache:
+            await self.embedding_cache.set(cache_key, query_vector)
+        return query_vector
+
+    async def search(
+        self,
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        filter: Optional[str],
+        top: int,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+    ) -> list[dict[str, Any]]:
+        if self.search_cache:
+            cache_key = Cache.make_key(
+                self.search_cache_generation.current() if self.search_cache_generation else None,
+                query_text,
+                Cache.make_key(query_vector) if query_vector else None,
+                filter,
+                top,
+                use_semantic_ranker,
+                use_semantic_captions,
+                self.query_language,
+                self.query_speller,
+            )
+            if (cached_docs := await self.search_cache.get(cache_key)) is not None:
+                return cached_docs
+
+        # Callers only request the semantic L2 reranker if retrieval mode is text or hybrid (vectors + text)
+        # The query text is None for vector-only queries, which the SDK accepts even though its type hints don't
+        if use_semantic_ranker:
+            r = await self.search_client.search(
+                query_text,  # type: ignore[arg-type]
+                filter=filter,
+                query_type=QueryType.SEMANTIC,
+                query_language=self.query_language,
+                query_speller=self.query_speller,
+                semantic_configuration_name="default",
+                top=top,
+                query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                vector=query_vector,
+                top_k=50 if query_vector else None,
+                vector_fields="embedding" if query_vector else None,
+            )
+        else:
+            r = await self.search_client.search(
+                query_text,  # type: ignore[arg-type]
+                filter=filter,
+                top=top,
+                vector=query_vector,
+                top_k=50 if query_vector else None,
+                vector_fields="embedding" if query_vector else None,
+            )
+        docs = [self.to_cacheable_doc(doc) async for doc in r]
+        if self.search_cache:
+            await self.search_cache.set(cache_key, docs)
+        return docs
+
+    async def search_concurrently(
+        self,
+        query_text: str,
+        query_vector: Union[list[float], "asyncio.Future[list[float]]"],
+        filter: Optional[str],
+        top: int,
+        use_semantic_ranker: bool,
+        use_semantic_captions: bool,
+    ) -> list[dict[str, Any]]:
+        """
+        Runs the text and vector halves of a hybrid query as two concurrent searches and merges them with
+        reciprocal rank fusion. The text search starts right away, so it overlaps with a still pending embedding.
+        """
+
+        async def vector_search():
+            vector = await query_vector if isinstance(query_vector, asyncio.Future) else query_vector
+            return await self.search(None, vector, filter, top, False, False)
+
+        searches = [
+            asyncio.ensure_future(
+                self.search(query_text, None, filter, top, use_semantic_ranker, use_semantic_captions)
+            ),
+            asyncio.ensure_future(vector_search()),
+        ]
+        try:
+            text_docs, vector_docs = await asyncio.gather(*searches)
+        except BaseException:
+            # Don't leave the other search or a pending embedding running, nor their failures unobserved
+            if isinstance(query_vector, asyncio.Future):
+                query_vector.cancel()
+                query_vector.add_done_callback(lambda future: future.cancelled() or future.exception())
+            for task in searches:
+                task.cancel()
+            await asyncio.gather(*searches, return_exceptions=True)
+            raise
+        return self.fuse_results([text_docs, vector_docs], top)
+
+    @staticmethod
+    def to_cacheable_doc(doc: dict[str, Any]) -> dict[str, Any]:
+        # Keep results JSON-serializable, and leave out the vectors that nobody reads back
+        cacheable_doc = {key: value for key, value in doc.items() if key != "embedding"}
+        if doc.get("@search.captions"):
+            cacheable_doc["@search.captions"] = [
+                {"text": caption.text, "highlights": getattr(caption, "highlights", None)}
+                for caption in doc["@search.captions"]
+            ]
+        return cacheable_doc
+
+    @classmethod
+    def fuse_results(cls, ranked_lists: list[list[dict[str, Any]]], top: int) -> list[dict[str, Any]]:
+        scores: dict[Any, float] = {}
+        docs: dict[Any, dict[str, Any]] = {}
+        for ranked in ranked_lists:
+            for rank, doc in enumerate(ranked):
+                key = doc.get("id") or id(doc)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (cls.RRF_K + rank + 1)
+                # Keep the first copy, text results come first and may carry semantic captions
+                docs.setdefault(key, doc)
+        ranked_keys = sorted(scores, key=lambda key: scores[key], reverse=True)
+        return [docs[key] for key in ranked_keys[:top]]
+
+    def get_sources_content(self, docs: list[dict[str, Any]], use_semantic_captions: bool) -> list[str]:
+        # Documents from a vector-only sub-query carry no captions, so fall back to their content
+        if use_semantic_captions:
+            return [
+                doc[self.sourcepage_field]
+                + ": "
+                + nonewlines(
+                    " . ".join([c["text"] for c in doc["@search.captions"]])
+                    if doc.get("@search.captions")
+                    else doc[self.content_field]
+                )
+                for doc in docs
+            ]
+        else:
+            return [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in docs]
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
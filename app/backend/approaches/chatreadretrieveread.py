@@ -1,17 +1,16 @@
+import asyncio
 import json
 import logging
 import re
 from typing import Any, AsyncGenerator, Optional, Union
 
-import aiohttp
 import openai
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
+from core.cache import Cache, CacheGeneration
 from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
-from text import nonewlines
+from core.modelhelper import get_token_limit, num_tokens_from_texts, truncate_to_tokens
 
 
 class ChatReadRetrieveReadApproach(Approach):
@@ -22,6 +21,14 @@ class ChatReadRetrieveReadApproach(Approach):
 
     NO_RESPONSE = "0"
 
+    # Speculative embedding modes: embed the raw question while the search query is being generated, and either
+    # re-embed when the generated query differs from the question, or always keep the raw question's embedding
+    SPECULATIVE_REEMBED = "reembed"
+    SPECULATIVE_RAW = "raw"
+
+    # When packing sources, a source that doesn't fit is truncated if at least this many tokens are left for it
+    MIN_TRUNCATED_SOURCE_TOKENS = 50
+
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
     top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion
@@ -92,6 +99,13 @@ If you cannot generate a search query, return just the number 0.
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[Cache] = None,
+        search_cache: Optional[Cache] = None,
+        search_cache_generation: Optional[CacheGeneration] = None,
+        answer_cache: Optional[Cache] = None,
+        speculative_embedding: Optional[str] = None,
+        concurrent_subqueries: bool = False,
+        pack_sources: bool = False,
     ):
         self.search_client = search_client
         self.openai_host = openai_host
@@ -103,7 +117,19 @@ If you cannot generate a search query, return just the number 0.
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.search_cache_generation = search_cache_generation
+        self.answer_cache = answer_cache
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        if speculative_embedding not in [None, self.SPECULATIVE_REEMBED, self.SPECULATIVE_RAW]:
+            raise ValueError(
+                f"Unknown speculative embedding mode '{speculative_embedding}', "
+                f"expected '{self.SPECULATIVE_REEMBED}' or '{self.SPECULATIVE_RAW}'"
+            )
+        self.speculative_embedding = speculative_embedding
+        self.concurrent_subqueries = concurrent_subqueries
+        self.pack_sources = pack_sources
 
     async def run_until_final_call(
         self,
@@ -149,66 +175,66 @@ If you cannot generate a search query, return just the number 0.
             few_shots=self.query_prompt_few_shots,
         )
 
+        # A speculative embedding of the raw question runs concurrently with the query rewrite call
+        speculative_embedding = None
+        if has_vector and self.speculative_embedding:
+            speculative_embedding = asyncio.ensure_future(self.compute_text_embedding(original_user_query))
+            # Mark failures as retrieved, so a discarded speculation doesn't log an unhandled task exception
+            speculative_embedding.add_done_callback(lambda task: task.cancelled() or task.exception())
+
         chatgpt_args = {"deployment_id": self.chatgpt_deployment} if self.openai_host == "azure" else {}
-        chat_completion = await openai.ChatCompletion.acreate(
-            **chatgpt_args,
-            model=self.chatgpt_model,
-            messages=messages,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            functions=functions,
-            function_call="auto",
-        )
+        try:
+            chat_completion = await openai.ChatCompletion.acreate(
+                **chatgpt_args,
+                model=self.chatgpt_model,
+                messages=messages,
+                temperature=0.0,
+                max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
+                n=1,
+                functions=functions,
+                function_call="auto",
+            )
+        except BaseException:
+            if speculative_embedding:
+                speculative_embedding.cancel()
+            raise
 
         query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
 
-        # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=query_text)
-            query_vector = embedding["data"][0]["embedding"]
-        else:
-            query_vector = None
+        # If retrieval mode includes vectors, compute an embedding for the query, reusing the speculative one
+        # when the rewritten query matches the question or when configured to always keep the raw embedding
+        query_vector: Optional[asyncio.Future[list[float]]] = None
+        if speculative_embedding and (
+            self.speculative_embedding == self.SPECULATIVE_RAW or self.is_same_query(query_text, original_user_query)
+        ):
+            query_vector = speculative_embedding
+        elif has_vector:
+            if speculative_embedding:
+                speculative_embedding.cancel()
+            query_vector = asyncio.ensure_future(self.compute_text_embedding(query_text))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
         # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
+        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
+        if query_text and query_vector and self.concurrent_subqueries:
+            docs = await self.search_concurrently(
+                query_text, query_vector, filter, top, use_semantic_ranker, use_semantic_captions
             )
         else:
-            r = await self.search_client.search(
+            docs = await self.search(
                 query_text,
-                filter=filter,
-                top=top,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
+                await query_vector if query_vector else None,
+                filter,
+                top,
+                use_semantic_ranker,
+                use_semantic_captions,
             )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        results = self.get_sources_content(docs, use_semantic_captions)
 
         follow_up_questions_prompt = (
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
@@ -231,6 +257,18 @@ If you cannot generate a search query, return just the number 0.
 
         response_token_limit = 1024
         messages_token_limit = self.chatgpt_token_limit - response_token_limit
+        packing_thoughts = ""
+        if overrides.get("pack_sources", self.pack_sources):
+            # Sources come right after the system message and the question, older turns get the remaining tokens
+            system_tokens, question_tokens = num_tokens_from_texts(
+                [system_message, original_user_query + "\n\nSources:\n"], self.chatgpt_model
+            )
+            # A long system prompt and question can leave no room for sources at all
+            sources_token_limit = max(messages_token_limit - system_tokens - question_tokens, 0)
+            results, packing_decisions = self.pack_sources_content(results, sources_token_limit)
+            packing_thoughts = "Packed sources:<br>" + "<br>".join(packing_decisions) + "<br><br>"
+        content = "\n".join(results)
+
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=self.chatgpt_model,
@@ -243,21 +281,73 @@ If you cannot generate a search query, return just the number 0.
 
         extra_info = {
             "data_points": results,
-            "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>"
+            "thoughts": f"Searched for:<br>{query_text}<br><br>{packing_thoughts}Conversations:<br>"
             + msg_to_display.replace("\n", "<br>"),
         }
 
+        temperature = overrides.get("temperature")
+        if temperature is None:
+            temperature = 0.1
+
+        # With a temperature of 0 and no earlier turns, the answer only depends on the prompt and sources,
+        # so it can be served from (and stored into) the answer cache
+        answer_cache_key = None
+        if self.answer_cache and temperature == 0 and len(history) == 1:
+            answer_cache_key = Cache.make_key(self.chatgpt_model, messages, response_token_limit)
+            if (cached_answer := await self.answer_cache.get(answer_cache_key)) is not None:
+                return (extra_info, self.replay_chat_completion(cached_answer, should_stream))
+
         chat_coroutine = openai.ChatCompletion.acreate(
             **chatgpt_args,
             model=self.chatgpt_model,
             messages=messages,
-            temperature=overrides.get("temperature") or 0.1,
+            temperature=temperature,
             max_tokens=response_token_limit,
             n=1,
             stream=should_stream,
         )
+        if answer_cache_key:
+            chat_coroutine = self.cache_chat_completion(chat_coroutine, answer_cache_key, should_stream)
         return (extra_info, chat_coroutine)
 
+    async def replay_chat_completion(self, answer: str, should_stream: bool):
+        if should_stream:
+            return self.replay_chat_completion_stream(answer)
+        return {
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": self.ASSISTANT, "content": answer}, "finish_reason": "stop"}],
+        }
+
+    async def replay_chat_completion_stream(self, answer: str) -> AsyncGenerator[dict, None]:
+        yield {
+            "object": "chat.completion.chunk",
+            "choices": [{"index": 0, "delta": {"role": self.ASSISTANT, "content": answer}, "finish_reason": None}],
+        }
+        yield {
+            "object": "chat.completion.chunk",
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }
+
+    async def cache_chat_completion(self, chat_coroutine, answer_cache_key: str, should_stream: bool):
+        chat_completion = await chat_coroutine
+        if should_stream:
+            return self.cache_chat_completion_stream(chat_completion, answer_cache_key)
+        if self.answer_cache and chat_completion["choices"][0].get("finish_reason") != "content_filter":
+            await self.answer_cache.set(answer_cache_key, chat_completion["choices"][0]["message"]["content"])
+        return chat_completion
+
+    async def cache_chat_completion_stream(self, chat_completion, answer_cache_key: str) -> AsyncGenerator[dict, None]:
+        answer = ""
+        finish_reason = None
+        async for event in chat_completion:
+            if event["choices"]:
+                answer += event["choices"][0]["delta"].get("content") or ""
+                finish_reason = event["choices"][0].get("finish_reason") or finish_reason
+            yield event
+        # Only reached if the client read the whole answer
+        if self.answer_cache and finish_reason != "content_filter":
+            await self.answer_cache.set(answer_cache_key, answer)
+
     async def run_without_streaming(
         self,
         history: list[dict[str, str]],
@@ -340,11 +430,7 @@ If you cannot generate a search query, return just the number 0.
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
         if stream is False:
-            # Workaround for: https://github.com/openai/openai-python/issues/371
-            async with aiohttp.ClientSession() as s:
-                openai.aiosession.set(s)
-                response = await self.run_without_streaming(messages, overrides, auth_claims, session_state, model_config)
-            return response
+            return await self.run_without_streaming(messages, overrides, auth_claims, session_state, model_config)
         else:
             return self.run_with_streaming(messages, overrides, auth_claims, session_state, model_config)
 
@@ -359,25 +445,54 @@ If you cannot generate a search query, return just the number 0.
     ) -> list:
         message_builder = MessageBuilder(system_prompt, model_id)
 
-        # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
-        for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
-
-        append_index = len(few_shots) + 1
-
-        message_builder.insert_message(self.USER, user_content, index=append_index)
+        # The conversation is built from the newest message backwards, each message goes right after the system message
+        message_builder.insert_message(self.USER, user_content)
         total_token_count = message_builder.count_tokens_for_message(message_builder.messages[-1])
 
         newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
+        # Count the whole history at once, most turns were already counted for the previous request
+        message_counts = message_builder.count_tokens_for_messages(newest_to_oldest)
+        for message, potential_message_count in zip(newest_to_oldest, message_counts):
             if (total_token_count + potential_message_count) > max_tokens:
                 logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
                 break
-            message_builder.insert_message(message["role"], message["content"], index=append_index)
+            message_builder.insert_message(message["role"], message["content"])
             total_token_count += potential_message_count
+
+        # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
+        for shot in reversed(few_shots):
+            message_builder.insert_message(shot.get("role"), shot.get("content"))
         return message_builder.messages
 
+    def pack_sources_content(self, sources: list[str], max_tokens: int) -> tuple[list[str], list[str]]:
+        """
+        Keeps the highest ranked sources that fit within max_tokens, truncating the first source that doesn't fit
+        if enough tokens are left for it. Returns the packed sources and a description of each packing decision.
+        """
+        packed: list[str] = []
+        decisions: list[str] = []
+        used_tokens = 0
+        max_tokens = max(max_tokens, 0)
+        # Each source also takes a newline when the sources are joined
+        for source, tokens in zip(sources, num_tokens_from_texts(sources, self.chatgpt_model)):
+            source_name = source.split(": ", 1)[0]
+            remaining_tokens = max_tokens - used_tokens
+            if tokens + 1 <= remaining_tokens:
+                packed.append(source)
+                used_tokens += tokens + 1
+                decisions.append(f"{source_name}: kept ({tokens} tokens)")
+            elif remaining_tokens <= 1:
+                decisions.append(f"{source_name}: dropped ({tokens} tokens), no tokens left for sources")
+            elif not packed or remaining_tokens - 1 >= self.MIN_TRUNCATED_SOURCE_TOKENS:
+                # Always keep at least part of the best source, if there is room for any of it
+                packed.append(truncate_to_tokens(source, remaining_tokens - 1, self.chatgpt_model))
+                used_tokens = max_tokens
+                decisions.append(f"{source_name}: truncated to {remaining_tokens - 1} of {tokens} tokens")
+            else:
+                decisions.append(f"{source_name}: dropped ({tokens} tokens)")
+        decisions.append(f"{used_tokens} of {max_tokens} tokens used by {len(packed)} of {len(sources)} sources")
+        return packed, decisions
+
     def get_search_query(self, chat_completion: dict[str, Any], user_query: str):
         response_message = chat_completion["choices"][0]["message"]
         if function_call := response_message.get("function_call"):
@@ -391,5 +506,9 @@ If you cannot generate a search query, return just the number 0.
                 return query_text
         return user_query
 
+    @staticmethod
+    def is_same_query(query_text: str, user_query: str) -> bool:
+        return " ".join(query_text.casefold().split()) == " ".join(user_query.casefold().split())
+
     def extract_followup_questions(self, content: str):
         return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
@@ -2,11 +2,10 @@ from typing import Any, AsyncGenerator, Optional, Union
 
 import openai
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import QueryType
 
 from approaches.approach import Approach
+from core.cache import Cache, CacheGeneration
 from core.messagebuilder import MessageBuilder
-from text import nonewlines
 
 
 class RetrieveThenReadApproach(Approach):
@@ -49,6 +48,9 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        embedding_cache: Optional[Cache] = None,
+        search_cache: Optional[Cache] = None,
+        search_cache_generation: Optional[CacheGeneration] = None,
     ):
         self.search_client = search_client
         self.openai_host = openai_host
@@ -60,6 +62,9 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.embedding_cache = embedding_cache
+        self.search_cache = search_cache
+        self.search_cache_generation = search_cache_generation
 
     async def run(
         self,
@@ -78,47 +83,15 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         filter = self.build_filter(overrides, auth_claims)
 
         # If retrieval mode includes vectors, compute an embedding for the query
-        if has_vector:
-            embedding_args = {"deployment_id": self.embedding_deployment} if self.openai_host == "azure" else {}
-            embedding = await openai.Embedding.acreate(**embedding_args, model=self.embedding_model, input=q)
-            query_vector = embedding["data"][0]["embedding"]
-        else:
-            query_vector = None
+        query_vector = await self.compute_text_embedding(q) if has_vector else None
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else ""
 
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector=query_vector,
-                top_k=50 if query_vector else None,
-                vector_fields="embedding" if query_vector else None,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+        use_semantic_ranker = True if overrides.get("semantic_ranker") and has_text else False
+        docs = await self.search(query_text, query_vector, filter, top, use_semantic_ranker, use_semantic_captions)
+        results = self.get_sources_content(docs, use_semantic_captions)
         content = "\n".join(results)
 
         message_builder = MessageBuilder(
@@ -1,10 +1,15 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
+import time
+from functools import lru_cache
 from tempfile import TemporaryDirectory
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
 import aiohttp
 from msal import ConfidentialClientApplication
@@ -14,6 +19,8 @@ from msal_extensions import (
     build_encrypted_persistence,
 )
 
+from .cache import MemoryCache
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -33,6 +40,8 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         token_cache_path: Optional[str] = None,
+        claims_cache_size: int = 0,
+        claims_cache_ttl: float = 300,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -58,6 +67,12 @@ class AuthenticationHelper:
                 token_cache=PersistedTokenCache(persistence),
             )
 
+        # Claims are cached per access token, so group changes take effect after at most claims_cache_ttl seconds
+        self.claims_cache = (
+            MemoryCache("auth-claims", claims_cache_size, claims_cache_ttl) if claims_cache_size > 0 else None
+        )
+        self.pending_claims: dict[str, asyncio.Future] = {}
+
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
         return {
@@ -115,31 +130,27 @@ class AuthenticationHelper:
 
     @staticmethod
     def build_security_filters(overrides: dict[str, Any], auth_claims: dict[str, Any]):
-        # Build different permutations of the oid or groups security filter using OData filters
-        # https://learn.microsoft.com/azure/search/search-security-trimming-for-azure-search
-        # https://learn.microsoft.com/azure/search/search-query-odata-filter
-        use_oid_security_filter = overrides.get("use_oid_security_filter")
-        use_groups_security_filter = overrides.get("use_groups_security_filter")
-
-        oid_security_filter = (
-            "oids/any(g:search.in(g, '{}'))".format(auth_claims.get("oid") or "") if use_oid_security_filter else None
-        )
-        groups_security_filter = (
-            "groups/any(g:search.in(g, '{}'))".format(", ".join(auth_claims.get("groups") or []))
-            if use_groups_security_filter
-            else None
+        return AuthenticationHelper.build_filter({**overrides, "exclude_category": None}, auth_claims)
+
+    @staticmethod
+    def build_filter(overrides: dict[str, Any], auth_claims: dict[str, Any]) -> Optional[str]:
+        # The claims are passed as a hashable key, so users in hundreds of groups don't rebuild their filter per request
+        return compile_filter(
+            overrides.get("exclude_category") or None,
+            bool(overrides.get("use_oid_security_filter")),
+            bool(overrides.get("use_groups_security_filter")),
+            auth_claims.get("oid") or "",
+            tuple(auth_claims.get("groups") or ()),
         )
 
-        # If only one security filter is specified, return that filter
-        # If both security filters are specified, combine them with "or" so only 1 security filter needs to pass
-        # If no security filters are specified, don't return any filter
-        if oid_security_filter and not groups_security_filter:
-            return oid_security_filter
-        elif groups_security_filter and not oid_security_filter:
-            return groups_security_filter
-        elif oid_security_filter and groups_security_filter:
-            return f"({oid_security_filter} or {groups_security_filter})"
-        else:
+    @staticmethod
+    def get_token_expiration(auth_token: str) -> Optional[float]:
+        # Reads the exp claim without validating the token, it's only used to expire cached claims early
+        try:
+            payload = auth_token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims["exp"])
+        except (IndexError, KeyError, TypeError, ValueError):
             return None
 
     @staticmethod
@@ -149,7 +160,10 @@ class AuthenticationHelper:
         async with aiohttp.ClientSession(headers=headers) as session:
             resp_json = None
             resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+            # Request the largest page size Graph allows, so most users' groups come back in a single page
+            async with session.get(
+                url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"
+            ) as resp:
                 resp_json = await resp.json()
                 resp_status = resp.status
                 if resp_status != 200:
@@ -175,34 +189,24 @@ class AuthenticationHelper:
         if not self.use_authentication:
             return {}
         try:
-            # Read the authentication token from the authorization header and exchange it using the On Behalf Of Flow
-            # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
-            # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
+            # Read the authentication token from the authorization header
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
-            if "error" in graph_resource_access_token:
-                raise AuthError(error=str(graph_resource_access_token), status_code=401)
-
-            # Read the claims from the response. The oid and groups claims are used for security filtering
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
-            id_token_claims = graph_resource_access_token["id_token_claims"]
-            auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups") or []}
-
-            # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
-            # or a groups overage claim may have been emitted.
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
-            missing_groups_claim = "groups" not in id_token_claims
-            has_group_overage_claim = (
-                missing_groups_claim
-                and "_claim_names" in id_token_claims
-                and "groups" in id_token_claims["_claim_names"]
-            )
-            if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
-            return auth_claims
+            if self.claims_cache is None:
+                return await self.get_auth_claims(auth_token)
+
+            # The cache is keyed on the whole token, which was validated by the On Behalf Of Flow when it was cached
+            cache_key = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            cached_claims = await self.claims_cache.get(cache_key)
+            if cached_claims is not None and (cached_claims["expires_on"] or float("inf")) > time.time():
+                return cached_claims["auth_claims"]
+            # Concurrent requests from the same user share one token exchange and Graph lookup
+            pending = self.pending_claims.get(cache_key)
+            if pending is None:
+                pending = asyncio.ensure_future(self.get_and_cache_auth_claims(cache_key, auth_token))
+                self.pending_claims[cache_key] = pending
+                pending.add_done_callback(lambda _: self.pending_claims.pop(cache_key, None))
+            # Shielded, so a cancelled request doesn't cancel the lookup for the others
+            return await asyncio.shield(pending)
         except AuthError as e:
             print(e.error)
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -210,3 +214,71 @@ class AuthenticationHelper:
         except Exception:
             logging.exception("Exception getting authorization information")
             return {}
+
+    async def get_and_cache_auth_claims(self, cache_key: str, auth_token: str) -> dict[str, Any]:
+        auth_claims = await self.get_auth_claims(auth_token)
+        if self.claims_cache is not None:
+            await self.claims_cache.set(
+                cache_key, {"auth_claims": auth_claims, "expires_on": self.get_token_expiration(auth_token)}
+            )
+        return auth_claims
+
+    async def get_auth_claims(self, auth_token: str) -> dict[str, Any]:
+        # Exchange the authentication token using the On Behalf Of Flow
+        # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
+        # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
+        graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
+            user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+        )
+        if "error" in graph_resource_access_token:
+            raise AuthError(error=str(graph_resource_access_token), status_code=401)
+
+        # Read the claims from the response. The oid and groups claims are used for security filtering
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
+        id_token_claims = graph_resource_access_token["id_token_claims"]
+        auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups") or []}
+
+        # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
+        # or a groups overage claim may have been emitted.
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
+        missing_groups_claim = "groups" not in id_token_claims
+        has_group_overage_claim = (
+            missing_groups_claim and "_claim_names" in id_token_claims and "groups" in id_token_claims["_claim_names"]
+        )
+        if missing_groups_claim or has_group_overage_claim:
+            # Read the user's groups from Microsoft Graph
+            auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+        return auth_claims
+
+
+def search_in_filter(field: str, values: Iterable[str]) -> str:
+    # search.in splits its values on commas, so they are joined without spaces to keep large filters small
+    return "{}/any(g:search.in(g, '{}'))".format(field, ",".join(value.replace("'", "''") for value in values))
+
+
+@lru_cache(maxsize=1024)
+def compile_filter(
+    exclude_category: Optional[str],
+    use_oid_security_filter: bool,
+    use_groups_security_filter: bool,
+    oid: str,
+    groups: tuple,
+) -> Optional[str]:
+    # Build different permutations of the oid or groups security filter using OData filters
+    # https://learn.microsoft.com/azure/search/search-security-trimming-for-azure-search
+    # https://learn.microsoft.com/azure/search/search-query-odata-filter
+    oid_security_filter = search_in_filter("oids", [oid]) if use_oid_security_filter else None
+    groups_security_filter = search_in_filter("groups", sorted(set(groups))) if use_groups_security_filter else None
+
+    # If only one security filter is specified, use that filter
+    # If both security filters are specified, combine them with "or" so only 1 security filter needs to pass
+    security_filter = oid_security_filter or groups_security_filter
+    if oid_security_filter and groups_security_filter:
+        security_filter = f"({oid_security_filter} or {groups_security_filter})"
+
+    filters = []
+    if exclude_category:
+        filters.append("category ne '{}'".format(exclude_category.replace("'", "''")))
+    if security_filter:
+        filters.append(security_filter)
+    return None if len(filters) == 0 else " and ".join(filters)
@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class Cache(ABC):
+    """
+    A key/value store for JSON-serializable values, keeping hit and miss statistics.
+    Attributes:
+        hits (int): Number of lookups that found a value.
+        misses (int): Number of lookups that found nothing, or an expired value.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self.lookup(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        logging.debug("Cache %s %s, %s", self.name, "miss" if value is None else "hit", self.stats())
+        return value
+
+    @abstractmethod
+    async def set(self, key: str, value: Any):
+        pass
+
+    @abstractmethod
+    async def lookup(self, key: str) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    async def clear(self):
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class MemoryCache(Cache):
+    """
+    In-process LRU cache with an optional time to live, optionally backed by a slower shared cache.
+    Misses are looked up in the backing cache and promoted, and writes go through to it.
+    """
+
+    def __init__(self, name: str, max_size: int, ttl: Optional[float] = None, backing_cache: Optional[Cache] = None):
+        super().__init__(name)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backing_cache = backing_cache
+        self.entries: OrderedDict[str, tuple[Optional[float], Any]] = OrderedDict()
+
+    async def lookup(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                return value
+            del self.entries[key]
+        if self.backing_cache:
+            value = await self.backing_cache.get(key)
+            if value is not None:
+                self.store(key, value)
+            return value
+        return None
+
+    async def set(self, key: str, value: Any):
+        self.store(key, value)
+        if self.backing_cache:
+            await self.backing_cache.set(key, value)
+
+    def store(self, key: str, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def clear(self):
+        self.entries.clear()
+        if self.backing_cache:
+            await self.backing_cache.clear()
+
+
+class SQLiteCache(Cache):
+    """
+    Cache stored in a local SQLite database, so entries survive restarts and are shared by all workers on a host.
+    Values are stored as JSON, each cache uses its own table so several caches can share one database file.
+    Expired entries are deleted when writing, at most once every PURGE_INTERVAL seconds.
+    Queries and commits run in a worker thread, so a slow disk or a locked database doesn't block the event loop.
+    """
+
+    PURGE_INTERVAL = 60.0
+
+    def __init__(self, name: str, path: str, ttl: Optional[float] = None):
+        super().__init__(name)
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            f'CREATE TABLE IF NOT EXISTS "{name}" (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+        )
+        self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}_expires_at" ON "{name}" (expires_at)')
+        self.purged_at = 0.0
+
+    async def lookup(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.read, key)
+
+    async def set(self, key: str, value: Any):
+        await asyncio.to_thread(self.write, key, value)
+
+    async def clear(self):
+        await asyncio.to_thread(self.delete_all)
+
+    def read(self, key: str) -> Optional[Any]:
+        with self.lock:
+            row = self.connection.execute(
+                f'SELECT value FROM "{self.name}" WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+                (key, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write(self, key: str, value: Any):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        with self.lock:
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO "{self.name}" (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+            if now - self.purged_at >= self.PURGE_INTERVAL:
+                self.connection.execute(f'DELETE FROM "{self.name}" WHERE expires_at <= ?', (now,))
+                self.purged_at = now
+
+    def delete_all(self):
+        with self.lock:
+            self.connection.execute(f'DELETE FROM "{self.name}"')
+
+    def close(self):
+        self.connection.close()
+
+
+class CacheGeneration:
+    """
+    Generation marker for cached data derived from an external source, such as a search index.
+    The generation is the modification time of a marker file, so another process (e.g. the ingestion script)
+    invalidates all entries keyed on the generation by touching the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def current(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+
+def create_cache(name: str, max_size: int, ttl: Optional[float] = None, path: Optional[str] = None) -> Optional[Cache]:
+    """
+    Creates an in-process LRU cache, backed by a SQLite database if a path is given.
+    Returns None if the cache is disabled, i.e. it has no size and no path.
+    """
+    if max_size <= 0 and not path:
+        return None
+    backing_cache = SQLiteCache(name, path, ttl) if path else None
+    if max_size <= 0:
+        return backing_cache
+    return MemoryCache(name, max_size, ttl, backing_cache)
@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import TracebackType
+from typing import AsyncIterator, Optional
+
+from quart.wrappers.response import FileBody
+
+
+@dataclass
+class ContentCacheEntry:
+    file_path: str
+    etag: str
+    content_type: str
+    size: int
+    validated_at: float
+    # Responses still streaming the file, it is only deleted once the last one is done
+    readers: int = 0
+    evicted: bool = False
+
+
+class ContentCache:
+    """
+    LRU cache of blob contents on local disk, for citation files that are opened over and over.
+    Entries older than the time to live are revalidated against the blob's ETag before they are served.
+    The cache owns its directory, files left over from a previous run are removed.
+    Every stored version gets its own file, so replacing or evicting an entry never touches a file that is being served.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[str, ContentCacheEntry] = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        for file_name in os.listdir(directory):
+            if file_name.endswith(".content") or file_name.endswith(".tmp"):
+                os.remove(os.path.join(directory, file_name))
+
+    def get(self, name: str) -> Optional[ContentCacheEntry]:
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.entries.move_to_end(name)
+        return entry
+
+    def is_fresh(self, entry: ContentCacheEntry) -> bool:
+        return time.monotonic() - entry.validated_at < self.ttl
+
+    def revalidate(self, entry: ContentCacheEntry) -> bool:
+        """Marks the entry as fresh again, returns False if it was evicted in the meantime"""
+        if entry.evicted:
+            return False
+        entry.validated_at = time.monotonic()
+        return True
+
+    def fits(self, size: int) -> bool:
+        return size <= self.max_bytes
+
+    async def store(self, name: str, etag: str, content_type: str, chunks: AsyncIterator[bytes]) -> ContentCacheEntry:
+        file_path = os.path.join(
+            self.directory, f"{hashlib.sha256(name.encode('utf-8')).hexdigest()}.{uuid.uuid4().hex}.content"
+        )
+        # Concurrent downloads of the same blob each write their own file, the last one to finish wins
+        temp_path = f"{file_path}.tmp"
+        size = 0
+        try:
+            with open(temp_path, "wb") as temp_file:
+                async for chunk in chunks:
+                    await asyncio.to_thread(temp_file.write, chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        self.remove(name)
+        os.replace(temp_path, file_path)
+        entry = ContentCacheEntry(file_path, etag, content_type, size, time.monotonic())
+        self.entries[name] = entry
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+        logging.debug("Cached content %s (%d bytes), cache holds %d bytes", name, size, self.total_bytes)
+        return entry
+
+    def remove(self, name: str):
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.size
+        entry.evicted = True
+        if entry.readers == 0:
+            self.delete_file(entry)
+
+    def acquire(self, entry: ContentCacheEntry):
+        entry.readers += 1
+
+    def release(self, entry: ContentCacheEntry):
+        entry.readers -= 1
+        if entry.evicted and entry.readers == 0:
+            self.delete_file(entry)
+
+    def delete_file(self, entry: ContentCacheEntry):
+        try:
+            os.remove(entry.file_path)
+        except FileNotFoundError:
+            pass
+
+
+class ContentCacheFileBody(FileBody):
+    """
+    Response body streaming a cached file, taking over a hold the caller acquired on the entry
+    and releasing it once the response is sent.
+    Bodies that are never sent, e.g. for 304 responses, release the entry when they are garbage collected.
+    """
+
+    def __init__(self, content_cache: ContentCache, entry: ContentCacheEntry):
+        self.release = weakref.finalize(self, content_cache.release, entry)
+        try:
+            super().__init__(entry.file_path)
+        except BaseException:
+            self.release()
+            raise
+
+    async def __aexit__(self, exc_type: type, exc_value: BaseException, tb: TracebackType) -> None:
+        try:
+            await super().__aexit__(exc_type, exc_value, tb)
+        finally:
+            self.release()
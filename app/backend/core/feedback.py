@@ -0,0 +1,167 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import uuid
+from typing import Any, Optional
+
+import aiohttp
+
+
+class FeedbackSink:
+    """
+    Stores conversation feedback rows in a Supabase (PostgREST) table without blocking request handlers.
+    Rows are queued in memory and a background task posts them in batches, retrying server errors, rate limiting
+    and connection errors with exponential backoff. Rows that the service rejects as invalid are dropped, logging their ids.
+    Rows that can't be queued or posted are written to local JSON Lines spill files, which are sent again the next
+    time a sink starts. Each spill goes to a new file next to spill_path, so several workers can share the path.
+    """
+
+    # Client errors that are worth retrying, all other 4xx responses reject the rows for good
+    RETRYABLE_CLIENT_ERRORS = [408, 429]
+
+    def __init__(
+        self,
+        url: str,
+        key: str,
+        spill_path: Optional[str] = None,
+        max_queue_size: int = 1000,
+        batch_size: int = 50,
+        flush_interval: float = 1.0,
+        max_retries: int = 5,
+        retry_delay: float = 1.0,
+    ):
+        self.url = url
+        self.headers = {
+            "apikey": key,
+            "Authorization": "Bearer " + key,
+            "Content-Type": "application/json",
+            "Prefer": "return=minimal",
+        }
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue: asyncio.Queue[dict[str, Any]] = asyncio.Queue(maxsize=max_queue_size)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession()
+        for row in self.read_spilled_rows():
+            self.add(row)
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self, timeout: float = 5.0):
+        """
+        Stops the background task, giving it a few seconds to send the queued rows, and spills the rest.
+        """
+        if self.task:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Timed out sending feedback rows, spilling the remaining rows")
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            remaining = []
+            while not self.queue.empty():
+                remaining.append(self.queue.get_nowait())
+            if remaining:
+                self.spill(remaining)
+        if self.session:
+            await self.session.close()
+
+    def add(self, row: dict[str, Any]):
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            logging.warning("Feedback queue is full, spilling row to %s", self.spill_path)
+            self.spill([row])
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # Wait a little for more rows, so a burst of feedback is sent in one request
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.send(batch)
+            except asyncio.CancelledError:
+                self.spill(batch)
+                raise
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def send(self, batch: list[dict[str, Any]]):
+        if self.session is None:
+            raise RuntimeError("FeedbackSink.start() must be awaited before sending rows")
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.session.post(self.url, headers=self.headers, json=batch) as response:
+                    response.raise_for_status()
+                logging.info("Saved %d feedback rows", len(batch))
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if (
+                    isinstance(error, aiohttp.ClientResponseError)
+                    and error.status < 500
+                    and error.status not in self.RETRYABLE_CLIENT_ERRORS
+                ):
+                    # Only the ids are logged, the rows hold the users' questions and answers
+                    logging.error(
+                        "Dropping %d feedback rows rejected with status %d, conversation ids: %s",
+                        len(batch),
+                        error.status,
+                        ", ".join(str(row.get("conversation_id")) for row in batch),
+                    )
+                    return
+                if attempt == self.max_retries:
+                    logging.error("Failed to save %d feedback rows: %s", len(batch), error)
+                    break
+                delay = self.retry_delay * 2**attempt
+                logging.warning("Failed to save feedback rows, retrying in %.1f seconds: %s", delay, error)
+                await asyncio.sleep(delay)
+        self.spill(batch)
+
+    def spill(self, rows: list[dict[str, Any]]):
+        if not self.spill_path:
+            logging.error("Dropping %d feedback rows, no spill file is configured", len(rows))
+            return
+        # Each spill is written to a new file that is only renamed into place once complete, so no other worker
+        # reads it half written
+        spill_file_path = f"{self.spill_path}.{os.getpid()}-{uuid.uuid4().hex}"
+        with open(spill_file_path + ".tmp", "w", encoding="utf-8") as spill_file:
+            for row in rows:
+                spill_file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(spill_file_path + ".tmp", spill_file_path)
+
+    def read_spilled_rows(self) -> list[dict[str, Any]]:
+        if not self.spill_path:
+            return []
+        rows: list[dict[str, Any]] = []
+        for spill_file_path in sorted(glob.glob(glob.escape(self.spill_path) + ".*")):
+            if spill_file_path.endswith(".tmp") or ".claimed-" in spill_file_path:
+                continue
+            # Renaming claims the file, if several workers start at the same time only one of them reads it
+            claimed_path = f"{spill_file_path}.claimed-{os.getpid()}-{uuid.uuid4().hex}"
+            try:
+                os.rename(spill_file_path, claimed_path)
+            except OSError:
+                continue
+            with open(claimed_path, encoding="utf-8") as spill_file:
+                rows.extend(json.loads(line) for line in spill_file if line.strip())
+            os.remove(claimed_path)
+        return rows
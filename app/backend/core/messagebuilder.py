@@ -1,23 +1,36 @@
 import unicodedata
+from collections import deque
+from functools import lru_cache
+from typing import Optional
 
-from .modelhelper import num_tokens_from_messages
+from .modelhelper import num_tokens_from_messages, num_tokens_from_messages_batch
 
 
 class MessageBuilder:
     """
     A class for building and managing messages in a chat conversation.
+    Messages are kept in a deque after the system message, so the usual pattern of inserting each message in front of
+    the previous one (right after the system message) is O(1), and the final list is materialized once.
     Attributes:
-        message (list): A list of dictionaries representing chat messages.
+        messages (list): A list of dictionaries representing chat messages.
         model (str): The name of the ChatGPT model.
-        token_count (int): The total number of tokens in the conversation.
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         insert_message(self, role: str, content: str, index: int = 1): Inserts a new message to the conversation.
+        append_message(self, role: str, content: str): Appends a new message to the end of the conversation.
     """
 
     def __init__(self, system_content: str, chatgpt_model: str):
-        self.messages = [{"role": "system", "content": self.normalize_content(system_content)}]
+        self.system_message = {"role": "system", "content": self.normalize_content(system_content)}
         self.model = chatgpt_model
+        self.conversation: deque[dict[str, str]] = deque()
+        self._messages: Optional[list[dict[str, str]]] = None
+
+    @property
+    def messages(self) -> list[dict[str, str]]:
+        if self._messages is None:
+            self._messages = [self.system_message, *self.conversation]
+        return self._messages
 
     def insert_message(self, role: str, content: str, index: int = 1):
         """
@@ -28,10 +41,31 @@ class MessageBuilder:
             content (str): The content of the message.
             index (int): The index at which to insert the message.
         """
-        self.messages.insert(index, {"role": role, "content": self.normalize_content(content)})
+        message = {"role": role, "content": self.normalize_content(content)}
+        if index == 1:
+            self.conversation.appendleft(message)
+        elif index > len(self.conversation):
+            self.conversation.append(message)
+        else:
+            self.conversation.insert(index - 1, message)
+        self._messages = None
+
+    def append_message(self, role: str, content: str):
+        self.insert_message(role, content, index=len(self.conversation) + 1)
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
+    def count_tokens_for_messages(self, messages: list[dict[str, str]]) -> list[int]:
+        return num_tokens_from_messages_batch(messages, self.model)
+
     def normalize_content(self, content: str):
-        return unicodedata.normalize("NFC", content)
+        return normalize_nfc(content)
+
+
+@lru_cache(maxsize=1024)
+def normalize_nfc(content: str) -> str:
+    # The same system prompt, few-shots and history come back on every turn, most of them already NFC
+    if unicodedata.is_normalized("NFC", content):
+        return content
+    return unicodedata.normalize("NFC", content)
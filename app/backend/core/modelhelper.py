@@ -1,5 +1,10 @@
 from __future__ import annotations
 
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import tiktoken
 
 MODELS_2_TOKEN_LIMITS = {
@@ -14,6 +19,9 @@ MODELS_2_TOKEN_LIMITS = {
 
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k"}
 
+# Number of distinct message values whose token counts are remembered, chat history is re-sent on every turn
+TOKEN_COUNT_CACHE_SIZE = 10000
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
@@ -35,11 +43,91 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
-    for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
-    return num_tokens
+    return num_tokens_from_messages_batch([message], model)[0]
+
+
+def num_tokens_from_messages_batch(messages: list[dict[str, str]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of several messages.
+    Values that were counted before are looked up, only the other values are tokenized.
+    Args:
+        messages (list): The messages to encode, each represented as a dictionary.
+        model (str): The name of the model to use for encoding.
+    Returns:
+        list: The number of tokens required to encode each message, in the same order.
+    """
+    counts = TOKEN_COUNTS.lookup(get_encoding(model), [value for message in messages for value in message.values()])
+    # 2 more tokens for the "role" and "content" keys
+    return [2 + sum(counts[value] for value in message.values()) for message in messages]
+
+
+def num_tokens_from_texts(texts: list[str], model: str) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each of several texts, sharing the token count cache.
+    """
+    counts = TOKEN_COUNTS.lookup(get_encoding(model), texts)
+    return [counts[text] for text in texts]
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """
+    Returns the longest prefix of the text that encodes to at most max_tokens tokens.
+    """
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[: max(max_tokens, 0)])
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding for a model, loading each encoding only once per process.
+    """
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+class TokenCounts:
+    """
+    LRU cache of token counts, keyed by encoding and a hash of the counted text.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, encoding: tiktoken.Encoding, values: list[str]) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        missing: dict[str, tuple[str, bytes]] = {}
+        with self.lock:
+            for value in values:
+                if value in counts or value in missing:
+                    continue
+                key = (encoding.name, hashlib.sha1(value.encode("utf-8")).digest())
+                if (count := self.counts.get(key)) is not None:
+                    self.counts.move_to_end(key)
+                    counts[value] = count
+                else:
+                    missing[value] = key
+        if missing:
+            # Messages are short, so encoding them one by one is cheaper than encode_batch, which starts a thread pool
+            missing_counts = {text: len(encoding.encode(text)) for text in missing}
+            with self.lock:
+                for text, count in missing_counts.items():
+                    counts[text] = count
+                    self.counts[missing[text]] = count
+                while len(self.counts) > self.max_size:
+                    self.counts.popitem(last=False)
+        return counts
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+
+
+TOKEN_COUNTS = TokenCounts(TOKEN_COUNT_CACHE_SIZE)
 
 
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
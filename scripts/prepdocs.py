@@ -1,12 +1,16 @@
 import argparse
 import asyncio
+import os
 from typing import Any, Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import AzureDeveloperCliCredential
 
+from prepdocslib.analysiscache import AnalysisCache
 from prepdocslib.blobmanager import BlobManager
+from prepdocslib.chunkmanifest import ChunkManifest
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     OpenAIEmbeddings,
@@ -18,9 +22,16 @@ from prepdocslib.listfilestrategy import (
     ListFileStrategy,
     LocalListFileStrategy,
 )
-from prepdocslib.contentparsers import DocumentAnalysisPdfParser, LocalPdfParser, ContentParser, TextParser, ParserType
+from prepdocslib.contentparsers import (
+    ContentParser,
+    DocumentAnalysisPdfParser,
+    LocalPdfParser,
+    ParserType,
+    TableFormat,
+    TextParser,
+)
 from prepdocslib.strategy import SearchInfo, Strategy
-from prepdocslib.textsplitter import TextSplitter
+from prepdocslib.textsplitter import HtmlTextSplitter, TextSplitter
 from prepdocslib.file_parsers import FileParserWrapper, XmlParser
 
 
@@ -44,7 +55,7 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
     elif args.parsertype == ParserType.PDF:
         # TODO make local pdfparser a parsertype
         if args.localpdfparser:
-            content_parser = LocalPdfParser()
+            content_parser = LocalPdfParser(processes=args.localpdfparserprocesses)
         else:
             # check if Azure Form Recognizer credentials are provided
             if args.formrecognizerservice is None:
@@ -59,6 +70,10 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
                 endpoint=f"https://{args.formrecognizerservice}.cognitiveservices.azure.com/",
                 credential=formrecognizer_creds,
                 verbose=args.verbose,
+                table_format=args.tableformat,
+                analysis_cache=AnalysisCache(args.analysiscachepath) if args.analysiscachepath else None,
+                max_concurrency=args.formrecognizerconcurrency,
+                pages_per_shard=args.formrecognizerpagespershard,
             )
     else:
         print(f"Error: Parser type {args.parsertype} is not an existing parser.")
@@ -66,6 +81,7 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
 
     use_vectors = not args.novectors
     embeddings: Optional[OpenAIEmbeddings] = None
+    embedding_cache = EmbeddingCache(args.embeddingcachepath) if use_vectors and args.embeddingcachepath else None
     if use_vectors and args.openaihost != "openai":
         azure_open_ai_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
             credential if is_key_empty(args.openaikey) else AzureKeyCredential(args.openaikey)
@@ -77,6 +93,10 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
             credential=azure_open_ai_credential,
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
+            max_concurrency=args.openaiconcurrency,
+            tokens_per_minute=args.openaitokensperminute,
+            requests_per_minute=args.openairequestsperminute,
+            embedding_cache=embedding_cache,
         )
     elif use_vectors:
         embeddings = OpenAIEmbeddingService(
@@ -85,6 +105,10 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
             organization=args.openaiorg,
             disable_batch=args.disablebatchvectors,
             verbose=args.verbose,
+            max_concurrency=args.openaiconcurrency,
+            tokens_per_minute=args.openaitokensperminute,
+            requests_per_minute=args.openairequestsperminute,
+            embedding_cache=embedding_cache,
         )
 
     print("Processing files...")
@@ -110,16 +134,26 @@ def setup_file_strategy(credential: AsyncTokenCredential, args: Any) -> FileStra
     else:
         document_action = DocumentAction.Add
 
+    # Splitters count tokens with the embedding model's encoding, so the counts are reused when batching embeddings
+    splitter_model_name = args.openaimodelname or "text-embedding-ada-002"
+    text_splitter = (
+        HtmlTextSplitter(max_tokens=args.maxsectiontokens or 500, model_name=splitter_model_name, verbose=args.verbose)
+        if args.htmlsplitter
+        else TextSplitter(max_tokens=args.maxsectiontokens, model_name=splitter_model_name)
+    )
+
     return FileStrategy(
         list_file_strategy=list_file_strategy,
         blob_manager=blob_manager,
         content_parser=content_parser,
-        text_splitter=TextSplitter(),
+        text_splitter=text_splitter,
         document_action=document_action,
         embeddings=embeddings,
         search_analyzer_name=args.searchanalyzername,
         use_acls=args.useacls,
         category=args.category,
+        concurrency=args.concurrency,
+        chunk_manifest=ChunkManifest(args.chunkmanifestpath, args.index) if args.chunkmanifestpath else None,
     )
 
 
@@ -134,10 +168,21 @@ async def main(strategy: Strategy, credential: AsyncTokenCredential, args: Any):
         verbose=args.verbose,
     )
 
-    if not args.remove and not args.removeall:
-        await strategy.setup(search_info)
+    try:
+        if not args.remove and not args.removeall:
+            await strategy.setup(search_info)
 
-    await strategy.run(search_info)
+        await strategy.run(search_info)
+
+        if args.searchcachegenerationdir:
+            search_info.bump_cache_generation(args.searchcachegenerationdir)
+    finally:
+        # Closes the SQLite databases, even if the run failed half way
+        if isinstance(strategy, FileStrategy):
+            if strategy.embeddings and strategy.embeddings.embedding_cache:
+                strategy.embeddings.embedding_cache.close()
+            if strategy.chunk_manifest:
+                strategy.chunk_manifest.close()
 
 
 if __name__ == "__main__":
@@ -169,6 +214,23 @@ if __name__ == "__main__":
     parser.add_argument(
         "--category", help="Value for the category field in the search index for all sections indexed in this run"
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Optional. Number of files to parse, embed and upload at the same time (default 1, one file after the other)",
+    )
+    parser.add_argument(
+        "--htmlsplitter",
+        action="store_true",
+        help="Optional. Split HTML documents along their sections, headings, tables and lists instead of every 1000 characters",
+    )
+    parser.add_argument(
+        "--maxsectiontokens",
+        type=int,
+        required=False,
+        help="Optional. Maximum number of tokens of a section, longer sections are split further (default 500 with --htmlsplitter, no limit otherwise)",
+    )
     parser.add_argument(
         "--skipblobs", action="store_true", help="Skip uploading individual pages to Azure Blob Storage"
     )
@@ -201,6 +263,11 @@ if __name__ == "__main__":
         default="en.microsoft",
         help="Optional. Name of the Azure Cognitive Search analyzer to use for the content field in the index",
     )
+    parser.add_argument(
+        "--searchcachegenerationdir",
+        required=False,
+        help="Optional. Directory shared with the app (SEARCH_CACHE_GENERATION_DIR) whose marker file for the index is touched after ingestion, invalidating cached search results",
+    )
     parser.add_argument("--openaihost", help="Host of the API used to compute embeddings ('azure' or 'openai')")
     parser.add_argument("--openaiservice", help="Name of the Azure OpenAI service used to compute embeddings")
     parser.add_argument(
@@ -218,6 +285,34 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--openaiconcurrency",
+        type=int,
+        default=1,
+        help="Optional. Number of embedding requests to send at the same time (default 1)",
+    )
+    parser.add_argument(
+        "--openaitokensperminute",
+        type=int,
+        required=False,
+        help="Optional. Tokens per minute quota of the embedding deployment, embedding requests are spaced out to stay within it",
+    )
+    parser.add_argument(
+        "--openairequestsperminute",
+        type=int,
+        required=False,
+        help="Optional. Requests per minute quota of the embedding deployment, embedding requests are spaced out to stay within it",
+    )
+    parser.add_argument(
+        "--embeddingcachepath",
+        required=False,
+        help="Optional. Path to a local SQLite database caching the embeddings of sections, so that sections whose text hasn't changed since a previous run aren't embedded again",
+    )
+    parser.add_argument(
+        "--chunkmanifestpath",
+        required=False,
+        help="Optional. Path to a local SQLite database recording the sections indexed from each file, so that re-indexing a changed file only uploads its new or changed sections and deletes the sections it no longer has",
+    )
     parser.add_argument(
         "--openaikey",
         required=False,
@@ -239,6 +334,13 @@ if __name__ == "__main__":
         action="store_true",
         help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure Form Recognizer service to extract text, tables and layout from the documents",
     )
+    parser.add_argument(
+        "--localpdfparserprocesses",
+        type=int,
+        nargs="?",
+        const=os.cpu_count(),
+        help="Optional. Number of processes the local PDF parser extracts pages with (one per CPU core if no number is given)",
+    )
     parser.add_argument(
         "--formrecognizerservice",
         required=False,
@@ -249,6 +351,30 @@ if __name__ == "__main__":
         required=False,
         help="Optional. Use this Azure Form Recognizer account key instead of the current user identity to login (use az login to set current user for Azure)",
     )
+    parser.add_argument(
+        "--formrecognizerconcurrency",
+        type=int,
+        required=False,
+        help="Optional. Maximum number of documents or page ranges to analyze with Azure Form Recognizer at the same time (default 4 with --formrecognizerpagespershard, no limit beyond --concurrency otherwise)",
+    )
+    parser.add_argument(
+        "--formrecognizerpagespershard",
+        type=int,
+        required=False,
+        help="Optional. Analyze PDFs with more pages than this in ranges of this many pages at the same time, at most 4 documents or page ranges at a time unless --formrecognizerconcurrency is set",
+    )
+    parser.add_argument(
+        "--analysiscachepath",
+        required=False,
+        help="Optional. Path to a local SQLite database caching the Azure Form Recognizer analysis of documents, so that documents that haven't changed since a previous run aren't analyzed again",
+    )
+    parser.add_argument(
+        "--tableformat",
+        type=TableFormat,
+        choices=list(TableFormat),
+        default=TableFormat.HTML,
+        help="Optional. Format of the tables extracted by Azure Form Recognizer, 'markdown' takes fewer tokens than 'html'",
+    )
     parser.add_argument("--parsertype",
                         help="The parser type that should handle the documents",
                         type=ParserType,
@@ -0,0 +1,60 @@
+import gzip
+import hashlib
+import json
+import sqlite3
+from typing import Optional
+
+from azure.ai.formrecognizer import AnalyzeResult
+
+
+class AnalysisCache:
+    """
+    Content-addressed cache of Azure Form Recognizer analysis results stored in a local SQLite database, so that
+    re-running the ingestion doesn't analyze documents again when their content didn't change. Entries are keyed on
+    the SHA-256 of the model id, the analyzed page range and the document bytes, and results are stored as
+    gzip-compressed JSON.
+    Attributes:
+        hits (int): Number of documents whose analysis was found in the cache.
+        misses (int): Number of documents that had to be analyzed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, result BLOB NOT NULL)")
+
+    @staticmethod
+    def make_key(model_id: str, document: bytes, pages: Optional[str] = None) -> str:
+        digest = hashlib.sha256(f"{model_id}\0".encode() if pages is None else f"{model_id}\0{pages}\0".encode())
+        digest.update(document)
+        return digest.hexdigest()
+
+    def get(self, model_id: str, document: bytes, pages: Optional[str] = None) -> Optional[AnalyzeResult]:
+        row = self.connection.execute(
+            "SELECT result FROM analyses WHERE key = ?", (AnalysisCache.make_key(model_id, document, pages),)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return AnalyzeResult.from_dict(json.loads(gzip.decompress(row[0])))
+
+    def set(self, model_id: str, document: bytes, result: AnalyzeResult, pages: Optional[str] = None):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO analyses (key, result) VALUES (?, ?)",
+            (
+                AnalysisCache.make_key(model_id, document, pages),
+                gzip.compress(json.dumps(result.to_dict(), separators=(",", ":")).encode()),
+            ),
+        )
+        self.connection.commit()
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_ratio:.0%} hit ratio)"
+
+    def close(self):
+        self.connection.close()
@@ -61,9 +61,11 @@ class BlobManager:
                 await container_client.delete_blob(blob_path)
 
     @classmethod
-    def sourcepage_from_file_page(cls, filename, page=0) -> str:
+    def sourcepage_from_file_page(cls, filename, page=0, anchor: Optional[str] = None) -> str:
         if os.path.splitext(filename)[1].lower() == ".pdf":
             return f"{os.path.basename(filename)}#page={page+1}"
+        elif anchor:
+            return f"{os.path.basename(filename)}#{anchor}"
         else:
             return os.path.basename(filename)
 
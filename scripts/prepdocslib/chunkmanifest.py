@@ -0,0 +1,55 @@
+import hashlib
+import json
+import sqlite3
+from typing import Any, Optional
+
+
+class ChunkManifest:
+    """
+    Records the id and content hash of each section indexed from a source file, in a local SQLite database,
+    so that re-ingesting a changed file only uploads the sections that changed and deletes the sections
+    that the new version of the file no longer has. Entries are kept per index, so one manifest can be
+    shared by several indexes.
+    """
+
+    def __init__(self, path: str, index_name: str):
+        self.path = path
+        self.index_name = index_name
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (index_name TEXT NOT NULL, sourcefile TEXT NOT NULL, id TEXT NOT NULL, "
+            "hash TEXT NOT NULL, PRIMARY KEY (index_name, id))"
+        )
+
+    @staticmethod
+    def make_hash(document: dict[str, Any], embedding_model: Optional[str] = None) -> str:
+        # Covers every field of the document, and the model its embedding will be computed with
+        return hashlib.sha256(json.dumps([embedding_model, document], sort_keys=True).encode()).hexdigest()
+
+    def get(self, sourcefile: str) -> dict[str, str]:
+        rows = self.connection.execute(
+            "SELECT id, hash FROM chunks WHERE index_name = ? AND sourcefile = ?", (self.index_name, sourcefile)
+        )
+        return {id: hash for id, hash in rows}
+
+    def set(self, sourcefile: str, hashes: dict[str, str]):
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM chunks WHERE index_name = ? AND sourcefile = ?", (self.index_name, sourcefile)
+            )
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO chunks (index_name, sourcefile, id, hash) VALUES (?, ?, ?, ?)",
+                [(self.index_name, sourcefile, id, hash) for id, hash in hashes.items()],
+            )
+
+    def remove(self, sourcefile: Optional[str] = None):
+        with self.connection:
+            if sourcefile is None:
+                self.connection.execute("DELETE FROM chunks WHERE index_name = ?", (self.index_name,))
+            else:
+                self.connection.execute(
+                    "DELETE FROM chunks WHERE index_name = ? AND sourcefile = ?", (self.index_name, sourcefile)
+                )
+
+    def close(self):
+        self.connection.close()
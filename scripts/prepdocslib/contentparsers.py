@@ -1,14 +1,28 @@
+import asyncio
 import html
+import io
+import os
+import shutil
+import tempfile
 from abc import ABC
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from typing import IO, AsyncGenerator, Union
+from typing import IO, AsyncGenerator, List, Optional, Union
 
-from azure.ai.formrecognizer import DocumentTable
+from azure.ai.formrecognizer import (
+    AnalyzeResult,
+    DocumentPage,
+    DocumentTable,
+    DocumentTableCell,
+)
 from azure.ai.formrecognizer.aio import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from pypdf import PdfReader
+from pypdf.errors import PdfReadError
 
+from .analysiscache import AnalysisCache
 from .strategy import USER_AGENT
 
 
@@ -17,6 +31,11 @@ class ParserType(Enum):
     TEXT = "TEXT"
 
 
+class TableFormat(Enum):
+    HTML = "html"
+    MARKDOWN = "markdown"
+
+
 class Page:
     """
     A single page from a pdf
@@ -42,104 +61,307 @@ class ContentParser(ABC):
         if False:
             yield
 
+    def close(self):
+        pass
+
 
 class TextParser(ContentParser):
     """
     Parser that parses text which is in byte format.
     """
-    
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         text_byte = content.read()
         text_str = text_byte.decode()
         yield Page(page_num=0, offset=0, text=text_str)
 
 
+# The PDF that a worker process of LocalPdfParser read last, with the path, modification time and size of its file
+worker_reader: Optional[tuple[tuple[str, int, int], PdfReader]] = None
+
+
+def extract_page_texts(path: str, start: int, end: int) -> List[str]:
+    # Runs in the worker processes of LocalPdfParser, so it has to be a module-level function.
+    # Workers read the PDF from its file once, and extract the following ranges of the same file from that reader.
+    global worker_reader
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if worker_reader is None or worker_reader[0] != key:
+        worker_reader = (key, PdfReader(path))
+    reader = worker_reader[1]
+    return [reader.pages[page_num].extract_text() for page_num in range(start, end)]
+
+
 class LocalPdfParser(ContentParser):
     """
     Concrete parser backed by PyPDF that can parse PDFs into pages
     To learn more, please visit https://pypi.org/project/pypdf/
+    Extracting text is CPU-bound, so with processes set, ranges of pages are extracted in a pool of that many
+    processes, which parses large PDFs faster and keeps the event loop free for network I/O.
+    The processes read the PDF from its file, PDFs that aren't local files are written to a temporary file first.
+    Call close to shut the processes down.
     """
 
+    # Each PDF is split into about this many ranges of pages per process, to even out slow pages
+    RANGES_PER_PROCESS = 4
+
+    def __init__(self, processes: Optional[int] = None):
+        self.processes = processes
+        self.executor: Optional[ProcessPoolExecutor] = None
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
-        reader = PdfReader(content)
-        pages = reader.pages
-        offset = 0
-        for page_num, p in enumerate(pages):
-            page_text = p.extract_text()
-            yield Page(page_num=page_num, offset=offset, text=page_text)
-            offset += len(page_text)
+        if self.processes is None:
+            reader = PdfReader(content)
+            pages = reader.pages
+            offset = 0
+            for page_num, p in enumerate(pages):
+                page_text = p.extract_text()
+                yield Page(page_num=page_num, offset=offset, text=page_text)
+                offset += len(page_text)
+            return
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        path = LocalPdfParser.get_file_path(content)
+        temp_path = None
+        if path is None:
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_file:
+                shutil.copyfileobj(content, temp_file)
+            path = temp_path = temp_file.name
+        futures: List[asyncio.Future] = []
+        try:
+            num_pages = len(PdfReader(path).pages)
+            range_length = max(1, -(-num_pages // (self.processes * LocalPdfParser.RANGES_PER_PROCESS)))
+            loop = asyncio.get_running_loop()
+            futures = [
+                loop.run_in_executor(
+                    self.executor, extract_page_texts, path, start, min(start + range_length, num_pages)
+                )
+                for start in range(0, num_pages, range_length)
+            ]
+            # The ranges are extracted in parallel, and their pages are yielded in order
+            offset = 0
+            page_num = 0
+            for future in futures:
+                for page_text in await future:
+                    yield Page(page_num=page_num, offset=offset, text=page_text)
+                    offset += len(page_text)
+                    page_num += 1
+        finally:
+            for future in futures:
+                future.cancel()
+            if temp_path is not None:
+                os.remove(temp_path)
+
+    @staticmethod
+    def get_file_path(content: IO) -> Optional[str]:
+        # Files opened from disk have their path as name, in-memory content may have a name too
+        name = getattr(content, "name", None)
+        if isinstance(content, io.BufferedReader) and isinstance(name, str) and os.path.isfile(name):
+            return name
+        return None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
 
 class DocumentAnalysisPdfParser(ContentParser):
     """
     Concrete parser backed by Azure AI Document Intelligence that can parse PDFS into pages
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/document-intelligence/overview
+    With max_concurrency set, at most that many documents or page ranges are analyzed at the same time, and with
+    pages_per_shard set, PDFs with more pages are analyzed in ranges of that many pages at the same time.
+    Sharding without max_concurrency analyzes at most DEFAULT_SHARD_CONCURRENCY documents or page ranges at a time.
+    Call close to close the analysis cache.
     """
 
+    DEFAULT_SHARD_CONCURRENCY = 4
+
     def __init__(
         self,
         endpoint: str,
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         model_id="prebuilt-layout",
         verbose: bool = False,
+        table_format: TableFormat = TableFormat.HTML,
+        analysis_cache: Optional[AnalysisCache] = None,
+        max_concurrency: Optional[int] = None,
+        pages_per_shard: Optional[int] = None,
     ):
         self.model_id = model_id
         self.endpoint = endpoint
         self.credential = credential
         self.verbose = verbose
+        self.table_format = table_format
+        self.analysis_cache = analysis_cache
+        # A large PDF turns into many analyses at once, which would run into the request limits of the resource
+        if max_concurrency is None and pages_per_shard is not None:
+            max_concurrency = DocumentAnalysisPdfParser.DEFAULT_SHARD_CONCURRENCY
+        self.max_concurrency = max_concurrency
+        self.pages_per_shard = pages_per_shard
+        self.semaphore: Optional[asyncio.Semaphore] = None
 
-    async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
-        if self.verbose:
-            print(f"Extracting text from '{content.name}' using Azure Form Recognizer")
+    def page_ranges(self, document: bytes) -> List[Optional[str]]:
+        # The page ranges to analyze a document in, None stands for the whole document
+        if self.pages_per_shard is None:
+            return [None]
+        try:
+            num_pages = len(PdfReader(io.BytesIO(document)).pages)
+        except PdfReadError:
+            return [None]
+        if num_pages <= self.pages_per_shard:
+            return [None]
+        return [
+            f"{start}-{min(start + self.pages_per_shard - 1, num_pages)}"
+            for start in range(1, num_pages + 1, self.pages_per_shard)
+        ]
+
+    async def analyze(self, content: IO) -> List[AnalyzeResult]:
+        if self.analysis_cache is None and self.pages_per_shard is None:
+            return [await self.analyze_pages(content.name, content)]
+
+        document = content.read()
+        page_ranges = self.page_ranges(document)
+        if self.verbose and len(page_ranges) > 1:
+            print(f"Splitting '{content.name}' into {len(page_ranges)} page ranges for Azure Form Recognizer")
+        tasks = [asyncio.ensure_future(self.analyze_pages(content.name, document, pages)) for pages in page_ranges]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            # The document fails with any of its page ranges, the analyses of the other ranges are cancelled
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def analyze_pages(self, name: str, document: Union[IO, bytes], pages: Optional[str] = None) -> AnalyzeResult:
+        description = f"'{name}'" if pages is None else f"pages {pages} of '{name}'"
+        if self.analysis_cache is not None and isinstance(document, bytes):
+            cached_result = self.analysis_cache.get(self.model_id, document, pages)
+            if cached_result is not None:
+                if self.verbose:
+                    print(f"Using the cached Azure Form Recognizer analysis of {description}")
+                return cached_result
+
+        if self.max_concurrency is None:
+            result = await self.begin_analyze_document(description, document, pages)
+        else:
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            async with self.semaphore:
+                result = await self.begin_analyze_document(description, document, pages)
+
+        if self.analysis_cache is not None and isinstance(document, bytes):
+            self.analysis_cache.set(self.model_id, document, result, pages)
+        return result
 
+    async def begin_analyze_document(
+        self, description: str, document: Union[IO, bytes], pages: Optional[str] = None
+    ) -> AnalyzeResult:
+        if self.verbose:
+            print(f"Extracting text from {description} using Azure Form Recognizer")
         async with DocumentAnalysisClient(
             endpoint=self.endpoint, credential=self.credential, headers={"x-ms-useragent": USER_AGENT}
         ) as form_recognizer_client:
-            poller = await form_recognizer_client.begin_analyze_document(model_id=self.model_id, document=content)
-            form_recognizer_results = await poller.result()
+            poller = await form_recognizer_client.begin_analyze_document(
+                model_id=self.model_id, document=document, **({"pages": pages} if pages else {})
+            )
+            return await poller.result()
 
-            offset = 0
-            for page_num, page in enumerate(form_recognizer_results.pages):
-                tables_on_page = [
-                    table
-                    for table in (form_recognizer_results.tables or [])
-                    if table.bounding_regions and table.bounding_regions[0].page_number == page_num + 1
-                ]
-
-                # mark all positions of the table spans in the page
-                page_offset = page.spans[0].offset
-                page_length = page.spans[0].length
-                table_chars = [-1] * page_length
-                for table_id, table in enumerate(tables_on_page):
-                    for span in table.spans:
-                        # replace all table spans with "table_id" in table_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                table_chars[idx] = table_id
-
-                # build page text by replacing characters in table spans with table html
-                page_text = ""
-                added_tables = set()
-                for idx, table_id in enumerate(table_chars):
-                    if table_id == -1:
-                        page_text += form_recognizer_results.content[page_offset + idx]
-                    elif table_id not in added_tables:
-                        page_text += DocumentAnalysisPdfParser.table_to_html(tables_on_page[table_id])
-                        added_tables.add(table_id)
+    def close(self):
+        if self.analysis_cache is not None:
+            if self.verbose:
+                print(f"Analysis cache: {self.analysis_cache.stats()}")
+            self.analysis_cache.close()
+
+    async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
+        offset = 0
+        page_num = 0
+        # The results of page ranges are stitched back together in order, their pages keep their page numbers
+        for form_recognizer_results in await self.analyze(content):
+            # Tables are grouped by the page they start on, keeping their order
+            tables_by_page: dict[int, List[DocumentTable]] = {}
+            for table in form_recognizer_results.tables or []:
+                if table.bounding_regions:
+                    tables_by_page.setdefault(table.bounding_regions[0].page_number, []).append(table)
 
+            for page in form_recognizer_results.pages:
+                page_text = DocumentAnalysisPdfParser.page_to_text(
+                    form_recognizer_results.content, page, tables_by_page.get(page.page_number, []), self.table_format
+                )
                 yield Page(page_num=page_num, offset=offset, text=page_text)
                 offset += len(page_text)
+                page_num += 1
 
     @classmethod
-    def table_to_html(cls, table: DocumentTable):
-        table_html = "<table>"
-        rows = [
-            sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index)
-            for i in range(table.row_count)
+    def page_to_text(
+        cls,
+        content: str,
+        page: DocumentPage,
+        tables_on_page: List[DocumentTable],
+        table_format: TableFormat = TableFormat.HTML,
+    ) -> str:
+        # Builds the page text from the content of the page, replacing the spans of each table with the rendered table.
+        # Where the spans of tables overlap, the later table wins, and a table's HTML is inserted where its first
+        # remaining character was.
+        page_offset = page.spans[0].offset
+        page_length = page.spans[0].length
+        table_intervals = [
+            (max(span.offset - page_offset, 0), min(span.offset - page_offset + span.length, page_length), table_id)
+            for table_id, table in enumerate(tables_on_page)
+            for span in table.spans
         ]
+        table_intervals = [(start, end, table_id) for start, end, table_id in table_intervals if start < end]
+        if not table_intervals:
+            return content[page_offset : page_offset + page_length]
+
+        # Split the page at every start and end of a table span, each piece belongs to the last table covering it
+        boundaries = sorted(
+            {0, page_length, *(start for start, _, _ in table_intervals), *(end for _, end, _ in table_intervals)}
+        )
+        starting: defaultdict[int, List[int]] = defaultdict(list)
+        ending: defaultdict[int, List[int]] = defaultdict(list)
+        for start, end, table_id in table_intervals:
+            starting[start].append(table_id)
+            ending[end].append(table_id)
+        covering: Counter[int] = Counter()
+        parts: List[str] = []
+        added_tables = set()
+        for piece_start, piece_end in zip(boundaries, boundaries[1:]):
+            covering.subtract(ending[piece_start])
+            covering.update(starting[piece_start])
+            table_id = max((table_id for table_id, count in covering.items() if count > 0), default=-1)
+            if table_id == -1:
+                parts.append(content[page_offset + piece_start : page_offset + piece_end])
+            elif table_id not in added_tables:
+                parts.append(DocumentAnalysisPdfParser.table_to_text(tables_on_page[table_id], table_format))
+                added_tables.add(table_id)
+        return "".join(parts)
+
+    @classmethod
+    def table_to_text(cls, table: DocumentTable, table_format: TableFormat = TableFormat.HTML) -> str:
+        if table_format == TableFormat.MARKDOWN:
+            return DocumentAnalysisPdfParser.table_to_markdown(table)
+        return DocumentAnalysisPdfParser.table_to_html(table)
+
+    @classmethod
+    def table_rows(cls, table: DocumentTable) -> List[List[DocumentTableCell]]:
+        # Buckets the cells by row in a single pass, each row ordered by column
+        rows: List[List[DocumentTableCell]] = [[] for _ in range(table.row_count)]
+        for cell in table.cells:
+            if 0 <= cell.row_index < table.row_count:
+                rows[cell.row_index].append(cell)
         for row_cells in rows:
-            table_html += "<tr>"
+            row_cells.sort(key=lambda cell: cell.column_index)
+        return rows
+
+    @classmethod
+    def table_to_html(cls, table: DocumentTable) -> str:
+        parts = ["<table>"]
+        for row_cells in DocumentAnalysisPdfParser.table_rows(table):
+            parts.append("<tr>")
             for cell in row_cells:
                 tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
                 cell_spans = ""
@@ -147,7 +369,23 @@ class DocumentAnalysisPdfParser(ContentParser):
                     cell_spans += f" colSpan={cell.column_span}"
                 if cell.row_span is not None and cell.row_span > 1:
                     cell_spans += f" rowSpan={cell.row_span}"
-                table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
-            table_html += "</tr>"
-        table_html += "</table>"
-        return table_html
+                parts.append(f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>")
+            parts.append("</tr>")
+        parts.append("</table>")
+        return "".join(parts)
+
+    @classmethod
+    def table_to_markdown(cls, table: DocumentTable) -> str:
+        # Renders the table as a Markdown pipe table, which takes fewer tokens than HTML. Markdown has no merged
+        # cells, so a cell that spans several rows or columns is written in its first one and the others stay empty.
+        # The first row is used as the header row.
+        column_count = max([table.column_count, *(cell.column_index + 1 for cell in table.cells)])
+        lines = []
+        for row_index, row_cells in enumerate(DocumentAnalysisPdfParser.table_rows(table)):
+            row = [""] * column_count
+            for cell in row_cells:
+                row[cell.column_index] = " ".join(cell.content.split()).replace("|", "\\|")
+            lines.append("|" + "|".join(row) + "|")
+            if row_index == 0:
+                lines.append("|" + "|".join(["-"] * column_count) + "|")
+        return "\n" + "\n".join(lines) + "\n"
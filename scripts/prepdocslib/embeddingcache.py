@@ -0,0 +1,63 @@
+import hashlib
+import sqlite3
+from array import array
+from typing import List, Optional
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of embeddings stored in a local SQLite database, so that re-running the ingestion
+    only embeds sections whose text changed. Entries are keyed on the SHA-256 of the model name and the text,
+    and embeddings are stored as arrays of doubles so they come back exactly as the embeddings API returned them.
+    Attributes:
+        hits (int): Number of texts whose embedding was found in the cache.
+        misses (int): Number of texts that had to be embedded.
+    """
+
+    # SQLite limits the number of parameters of a query
+    MAX_QUERY_KEYS = 500
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+
+    @staticmethod
+    def make_key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [EmbeddingCache.make_key(model, text) for text in texts]
+        found: dict[str, List[float]] = {}
+        for i in range(0, len(keys), EmbeddingCache.MAX_QUERY_KEYS):
+            query_keys = keys[i : i + EmbeddingCache.MAX_QUERY_KEYS]
+            rows = self.connection.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(query_keys))})", query_keys
+            )
+            for key, embedding in rows:
+                found[key] = array("d", embedding).tolist()
+        embeddings = [found.get(key) for key in keys]
+        hits = sum(1 for embedding in embeddings if embedding is not None)
+        self.hits += hits
+        self.misses += len(embeddings) - hits
+        return embeddings
+
+    def set_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            [
+                (EmbeddingCache.make_key(model, text), array("d", embedding).tobytes())
+                for text, embedding in zip(texts, embeddings)
+            ],
+        )
+        self.connection.commit()
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups else 0.0
+        return f"{self.hits} hits, {self.misses} misses ({hit_ratio:.0%} hit ratio)"
+
+    def close(self):
+        self.connection.close()
@@ -1,9 +1,9 @@
+import asyncio
 import time
 from abc import ABC
-from typing import Any, List, Optional, Union
+from typing import Any, Generic, List, Optional, TypeVar, Union
 
 import openai
-import tiktoken
 from azure.core.credentials import AccessToken, AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from tenacity import (
@@ -13,6 +13,10 @@ from tenacity import (
     wait_random_exponential,
 )
 
+from .embeddingcache import EmbeddingCache
+from .ratelimiter import RateLimiter, get_retry_after, wait_retry_after
+from .tokenizer import count_tokens
+
 
 class EmbeddingBatch:
     """
@@ -24,98 +28,202 @@ class EmbeddingBatch:
         self.token_length = token_length
 
 
+T = TypeVar("T")
+
+
+class EmbeddingBatcher(Generic[T]):
+    """
+    Fills batches up to the token limit and size that an embedding model accepts in a single request,
+    as items are added one by one
+    """
+
+    def __init__(self, token_limit: int, max_batch_size: int):
+        self.token_limit = token_limit
+        self.max_batch_size = max_batch_size
+        self.items: List[T] = []
+        self.token_length = 0
+
+    def add(self, item: T, token_length: int) -> List[tuple[List[T], int]]:
+        # Returns the batches that are complete, with their token lengths
+        batches = []
+        if self.token_length + token_length >= self.token_limit and len(self.items) > 0:
+            batches.append(self.flush())
+        self.items.append(item)
+        self.token_length += token_length
+        if len(self.items) == self.max_batch_size:
+            batches.append(self.flush())
+        return batches
+
+    def flush(self) -> tuple[List[T], int]:
+        batch = (self.items, self.token_length)
+        self.items = []
+        self.token_length = 0
+        return batch
+
+
 class OpenAIEmbeddings(ABC):
     """
     Contains common logic across both OpenAI and Azure OpenAI embedding services
-    Can split source text into batches for more efficient embedding calls
+    Can split source text into batches for more efficient embedding calls, and send up to max_concurrency batches
+    at the same time within the deployment's tokens per minute and requests per minute quotas.
+    Texts found in the embedding cache aren't sent at all.
     """
 
     SUPPORTED_BATCH_AOAI_MODEL = {"text-embedding-ada-002": {"token_limit": 8100, "max_batch_size": 16}}
 
-    def __init__(self, open_ai_model_name: str, disable_batch: bool = False, verbose: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        disable_batch: bool = False,
+        verbose: bool = False,
+        max_concurrency: int = 1,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.disable_batch = disable_batch
         self.verbose = verbose
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = (
+            RateLimiter(tokens_per_minute, requests_per_minute) if tokens_per_minute or requests_per_minute else None
+        )
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.embedded_tokens = 0
+        self.embedding_requests = 0
+        self.started_at: Optional[float] = None
+        self.embedding_cache = embedding_cache
 
     async def create_embedding_arguments(self) -> dict[str, Any]:
         raise NotImplementedError
 
     def before_retry_sleep(self, retry_state):
+        retry_after = get_retry_after(retry_state.outcome.exception())
+        if retry_after is not None and self.rate_limiter:
+            # Hold back the other batches too, they would be rate limited as well
+            self.rate_limiter.pause(retry_after)
         if self.verbose:
             print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
+    def get_retrying(self) -> AsyncRetrying:
+        return AsyncRetrying(
+            retry=retry_if_exception_type(openai.error.RateLimitError),
+            wait=wait_retry_after(wait_random_exponential(min=15, max=60)),
+            stop=stop_after_attempt(15),
+            before_sleep=self.before_retry_sleep,
+        )
+
+    async def create_embedding_response(self, input: Union[str, List[str]], token_length: Optional[int]) -> Any:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self.semaphore:
+            async for attempt in self.get_retrying():
+                with attempt:
+                    if self.rate_limiter:
+                        await self.rate_limiter.acquire(
+                            token_length if token_length is not None else self.calculate_token_length(str(input))
+                        )
+                    if self.started_at is None:
+                        self.started_at = time.monotonic()
+                    emb_args = await self.create_embedding_arguments()
+                    emb_response = await openai.Embedding.acreate(**emb_args, input=input)
+        self.embedding_requests += 1
+        self.embedded_tokens += emb_response.get("usage", {}).get("total_tokens") or token_length or 0
+        return emb_response
+
+    def get_throughput(self) -> tuple[float, float]:
+        # Tokens and requests per minute since the first embedding request
+        minutes = (time.monotonic() - self.started_at) / 60 if self.started_at is not None else 0
+        if minutes <= 0:
+            return 0.0, 0.0
+        return self.embedded_tokens / minutes, self.embedding_requests / minutes
+
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return count_tokens(text, self.open_ai_model_name)
 
-    def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
+    def create_batcher(self) -> Optional[EmbeddingBatcher[Any]]:
+        # Fills batches like create_embeddings sends them in a single request, or None if texts are sent one by one
+        batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
+        if self.disable_batch or not batch_info:
+            return None
+        return EmbeddingBatcher(batch_info["token_limit"], batch_info["max_batch_size"])
+
+    def split_text_into_batches(
+        self, texts: List[str], token_lengths: Optional[List[int]] = None
+    ) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
         if not batch_info:
             raise NotImplementedError(
                 f"Model {self.open_ai_model_name} is not supported with batch embedding operations"
             )
 
-        batch_token_limit = batch_info["token_limit"]
-        batch_max_size = batch_info["max_batch_size"]
+        batcher: EmbeddingBatcher[str] = EmbeddingBatcher(batch_info["token_limit"], batch_info["max_batch_size"])
         batches: List[EmbeddingBatch] = []
-        batch: List[str] = []
-        batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
-            if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
-                batches.append(EmbeddingBatch(batch, batch_token_length))
-                batch = []
-                batch_token_length = 0
-
-            batch.append(text)
-            batch_token_length = batch_token_length + text_token_length
-            if len(batch) == batch_max_size:
-                batches.append(EmbeddingBatch(batch, batch_token_length))
-                batch = []
-                batch_token_length = 0
-
-        if len(batch) > 0:
-            batches.append(EmbeddingBatch(batch, batch_token_length))
+        for i, text in enumerate(texts):
+            # Token lengths counted by the text splitter aren't counted again
+            text_token_length = token_lengths[i] if token_lengths else self.calculate_token_length(text)
+            batches.extend(EmbeddingBatch(*batch) for batch in batcher.add(text, text_token_length))
+        if batcher.items:
+            batches.append(EmbeddingBatch(*batcher.flush()))
 
         return batches
 
-    async def create_embedding_batch(self, texts: List[str]) -> List[List[float]]:
-        batches = self.split_text_into_batches(texts)
-        embeddings = []
-        for batch in batches:
-            async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(openai.error.RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
-                stop=stop_after_attempt(15),
-                before_sleep=self.before_retry_sleep,
-            ):
-                with attempt:
-                    emb_args = await self.create_embedding_arguments()
-                    emb_response = await openai.Embedding.acreate(**emb_args, input=batch.texts)
-                    embeddings.extend([data["embedding"] for data in emb_response["data"]])
-                    if self.verbose:
-                        print(f"Batch Completed. Batch size  {len(batch.texts)} Token count {batch.token_length}")
-
-        return embeddings
+    async def create_embedding_batch(
+        self, texts: List[str], token_lengths: Optional[List[int]] = None
+    ) -> List[List[float]]:
+        batches = self.split_text_into_batches(texts, token_lengths)
+        # Batches are sent concurrently, up to max_concurrency at a time
+        batch_embeddings = await asyncio.gather(*[self.embed_batch(batch) for batch in batches])
+        return [embedding for embeddings in batch_embeddings for embedding in embeddings]
 
-    async def create_embedding_single(self, text: str) -> List[float]:
-        async for attempt in AsyncRetrying(
-            retry=retry_if_exception_type(openai.error.RateLimitError),
-            wait=wait_random_exponential(min=15, max=60),
-            stop=stop_after_attempt(15),
-            before_sleep=self.before_retry_sleep,
-        ):
-            with attempt:
-                emb_args = await self.create_embedding_arguments()
-                emb_response = await openai.Embedding.acreate(**emb_args, input=text)
+    async def embed_batch(self, batch: EmbeddingBatch) -> List[List[float]]:
+        emb_response = await self.create_embedding_response(batch.texts, batch.token_length)
+        if self.verbose:
+            tokens_per_minute, requests_per_minute = self.get_throughput()
+            print(
+                f"Batch Completed. Batch size  {len(batch.texts)} Token count {batch.token_length}. "
+                f"Throughput {tokens_per_minute:.0f} tokens/minute, {requests_per_minute:.0f} requests/minute"
+            )
+        return [data["embedding"] for data in emb_response["data"]]
 
+    async def create_embedding_single(self, text: str, token_length: Optional[int] = None) -> List[float]:
+        emb_response = await self.create_embedding_response(text, token_length)
         return emb_response["data"][0]["embedding"]
 
-    async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+    async def create_embeddings(self, texts: List[str], token_lengths: Optional[List[int]] = None) -> List[List[float]]:
+        if not self.embedding_cache:
+            return await self.compute_embeddings(texts, token_lengths)
+
+        # Texts found in the embedding cache aren't sent, duplicates of a missing text are only sent once
+        cached_embeddings = self.embedding_cache.get_many(self.open_ai_model_name, texts)
+        missing = {text: i for i, (text, embedding) in enumerate(zip(texts, cached_embeddings)) if embedding is None}
+        computed_embeddings: dict[str, List[float]] = {}
+        if missing:
+            missing_texts = list(missing)
+            missing_token_lengths = [token_lengths[i] for i in missing.values()] if token_lengths else None
+            computed_embeddings = dict(
+                zip(missing_texts, await self.compute_embeddings(missing_texts, missing_token_lengths))
+            )
+            self.embedding_cache.set_many(self.open_ai_model_name, missing_texts, list(computed_embeddings.values()))
+        return [
+            computed_embeddings[text] if embedding is None else embedding
+            for text, embedding in zip(texts, cached_embeddings)
+        ]
+
+    async def compute_embeddings(
+        self, texts: List[str], token_lengths: Optional[List[int]] = None
+    ) -> List[List[float]]:
         if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
-            return await self.create_embedding_batch(texts)
-
-        return [await self.create_embedding_single(text) for text in texts]
+            return await self.create_embedding_batch(texts, token_lengths)
+
+        return list(
+            await asyncio.gather(
+                *[
+                    self.create_embedding_single(text, token_lengths[i] if token_lengths else None)
+                    for i, text in enumerate(texts)
+                ]
+            )
+        )
 
 
 class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
@@ -132,8 +240,20 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         disable_batch: bool = False,
         verbose: bool = False,
+        max_concurrency: int = 1,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, disable_batch, verbose)
+        super().__init__(
+            open_ai_model_name,
+            disable_batch,
+            verbose,
+            max_concurrency,
+            tokens_per_minute,
+            requests_per_minute,
+            embedding_cache,
+        )
         self.open_ai_service = open_ai_service
         self.open_ai_deployment = open_ai_deployment
         self.credential = credential
@@ -178,8 +298,20 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         organization: Optional[str] = None,
         disable_batch: bool = False,
         verbose: bool = False,
+        max_concurrency: int = 1,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, disable_batch, verbose)
+        super().__init__(
+            open_ai_model_name,
+            disable_batch,
+            verbose,
+            max_concurrency,
+            tokens_per_minute,
+            requests_per_minute,
+            embedding_cache,
+        )
         self.credential = credential
         self.organization = organization
 
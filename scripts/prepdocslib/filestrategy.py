@@ -1,10 +1,14 @@
+import asyncio
+import os
 from enum import Enum
 from typing import Optional, Union
 
 from .blobmanager import BlobManager
+from .chunkmanifest import ChunkManifest
 from .embeddings import OpenAIEmbeddings
-from .listfilestrategy import ListFileStrategy
+from .listfilestrategy import File, ListFileStrategy
 from .contentparsers import ContentParser
+from .pipeline import IngestionPipeline, IngestionProgress
 from .searchmanager import SearchManager, Section
 from .strategy import SearchInfo, Strategy
 from .textsplitter import TextSplitter
@@ -33,6 +37,8 @@ class FileStrategy(Strategy):
         search_analyzer_name: Optional[str] = None,
         use_acls: bool = False,
         category: Optional[str] = None,
+        concurrency: int = 1,
+        chunk_manifest: Optional[ChunkManifest] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -43,6 +49,8 @@ class FileStrategy(Strategy):
         self.search_analyzer_name = search_analyzer_name
         self.use_acls = use_acls
         self.category = category
+        self.concurrency = concurrency
+        self.chunk_manifest = chunk_manifest
 
     async def setup(self, search_info: SearchInfo):
         search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
@@ -51,26 +59,75 @@ class FileStrategy(Strategy):
     async def run(self, search_info: SearchInfo):
         search_manager = SearchManager(search_info, self.search_analyzer_name, self.use_acls, self.embeddings)
         if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    pages = [page async for page in self.content_parser.parse(content=file.content)]
-                    sections = [
-                        Section(split_page, content=file, category=self.category)
-                        for split_page in self.text_splitter.split_pages(pages)
-                    ]
-                    if search_info.verbose:
-                        print(f"Split '{file.filename()}' into '{len(sections)}' sections")
-                    await search_manager.update_content(sections)
-                    await self.blob_manager.upload_blob(file)
-                finally:
-                    if file:
-                        file.close()
+            try:
+                await self.add_files(search_manager, search_info)
+            finally:
+                # Shuts down the parser's worker processes, if it has any
+                self.content_parser.close()
         elif self.document_action == DocumentAction.Remove:
             paths = self.list_file_strategy.list_paths()
             async for path in paths:
                 await self.blob_manager.remove_blob(path)
                 await search_manager.remove_content(path)
+                if self.chunk_manifest:
+                    self.chunk_manifest.remove(os.path.basename(path))
         elif self.document_action == DocumentAction.RemoveAll:
             await self.blob_manager.remove_blob()
             await search_manager.remove_content()
+            if self.chunk_manifest:
+                self.chunk_manifest.remove()
+
+    async def add_files(self, search_manager: SearchManager, search_info: SearchInfo):
+        # Files are ingested by a pool of workers, so parsing, embedding and uploading of different files overlap.
+        # The queue only holds as many files as there are workers, so listing doesn't run ahead of ingestion.
+        # The workers share one pipeline, which embeds and indexes sections from many files in the same batches.
+        files: asyncio.Queue[Optional[File]] = asyncio.Queue(maxsize=self.concurrency)
+        progress = IngestionProgress(search_info.verbose)
+
+        async def list_files():
+            async for file in self.list_file_strategy.list():
+                try:
+                    await files.put(file)
+                except asyncio.CancelledError:
+                    file.close()
+                    raise
+            for _ in range(self.concurrency):
+                await files.put(None)
+
+        async def ingest_files(pipeline: IngestionPipeline):
+            while (file := await files.get()) is not None:
+                try:
+                    await self.add_file(file, pipeline, search_info, progress)
+                finally:
+                    file.close()
+
+        async with IngestionPipeline(search_manager, progress, chunk_manifest=self.chunk_manifest) as pipeline:
+            tasks = [asyncio.create_task(list_files())] + [
+                asyncio.create_task(ingest_files(pipeline)) for _ in range(self.concurrency)
+            ]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # If a file failed, stop the other workers and close the files they didn't get to
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                while not files.empty():
+                    if file := files.get_nowait():
+                        file.close()
+
+    async def add_file(
+        self, file: File, pipeline: IngestionPipeline, search_info: SearchInfo, progress: IngestionProgress
+    ):
+        pages = [page async for page in self.content_parser.parse(content=file.content)]
+        sections = [
+            Section(split_page, content=file, category=self.category)
+            for split_page in self.text_splitter.split_pages(pages)
+        ]
+        progress.advance("Parsed", file)
+        if search_info.verbose:
+            print(f"Split '{file.filename()}' into '{len(sections)}' sections")
+        # Only waits for the sections to be queued, they are indexed in the background
+        await pipeline.add(file, sections)
+        await self.blob_manager.upload_blob(file)
+        progress.advance("Uploaded", file)
@@ -0,0 +1,210 @@
+import asyncio
+from typing import Any, List, Optional
+
+from .chunkmanifest import ChunkManifest
+from .embeddings import EmbeddingBatcher, OpenAIEmbeddings
+from .listfilestrategy import File
+from .searchmanager import SearchManager, Section
+
+# A search document on its way through the pipeline, with the file it comes from and the token count of its content,
+# if the text splitter counted it
+DocumentItem = tuple[File, dict[str, Any], Optional[int]]
+
+
+class IngestionProgress:
+    """
+    Counts the files that have made it through each ingestion stage, so concurrent ingestion can report its progress
+    """
+
+    STAGES = ["Parsed", "Indexed", "Uploaded"]
+
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.counts = {stage: 0 for stage in IngestionProgress.STAGES}
+
+    def advance(self, stage: str, file: File):
+        self.counts[stage] += 1
+        if self.verbose:
+            counts = ", ".join(f"{count} {stage.lower()}" for stage, count in self.counts.items())
+            print(f"{stage} '{file.filename()}' (files {counts})")
+
+
+class IngestionPipeline:
+    """
+    Streams the sections of many files through a shared embedding stage and a shared indexing stage.
+    Embedding requests are filled up to the model's batch limits and index uploads up to 1000 documents,
+    regardless of how many sections each file has. Use as an async context manager, leaving it waits for the
+    sections that were added to be indexed. With a chunk manifest, only the sections of a file that changed since
+    it was last indexed go through the stages, and the sections it no longer has are deleted from the index
+    once its changed sections are indexed.
+    """
+
+    def __init__(
+        self,
+        search_manager: SearchManager,
+        progress: Optional[IngestionProgress] = None,
+        max_queue_size: int = 16,
+        chunk_manifest: Optional[ChunkManifest] = None,
+    ):
+        self.search_manager = search_manager
+        self.chunk_manifest = chunk_manifest
+        self.embeddings = search_manager.embeddings
+        self.verbose = search_manager.search_info.verbose
+        self.progress = progress
+        # Queues hold lists of document items, a None item ends the stage
+        self.documents: asyncio.Queue[Optional[List[DocumentItem]]] = asyncio.Queue(max_queue_size)
+        self.embedded: asyncio.Queue[Optional[List[DocumentItem]]] = (
+            asyncio.Queue(max_queue_size) if self.embeddings else self.documents
+        )
+        self.remaining_documents: dict[File, int] = {}
+        # Hashes of all sections of a file, recorded in the chunk manifest once its changed sections are indexed
+        self.manifest_updates: dict[File, dict[str, str]] = {}
+        # Ids of the sections a file no longer has, deleted from the index once its changed sections are indexed
+        self.removed_ids: dict[File, List[str]] = {}
+        self.tasks: List[asyncio.Task] = []
+
+    async def __aenter__(self) -> "IngestionPipeline":
+        self.tasks = [asyncio.create_task(self.index_documents())]
+        if self.embeddings:
+            self.tasks.append(asyncio.create_task(self.embed_documents(self.embeddings)))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self.put(self.documents, None)
+                await asyncio.gather(*self.tasks)
+                if self.verbose and self.embeddings and self.embeddings.embedding_cache:
+                    print(f"Embedding cache: {self.embeddings.embedding_cache.stats()}")
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def add(self, file: File, sections: List[Section]):
+        documents = self.search_manager.create_documents(sections, content_ids=self.chunk_manifest is not None)
+        token_counts = {
+            document["id"]: section.split_page.token_count for document, section in zip(documents, sections)
+        }
+        if self.chunk_manifest:
+            documents = await self.diff_documents(self.chunk_manifest, file, documents)
+        if not documents:
+            await self.finish(file)
+            return
+        self.remaining_documents[file] = len(documents)
+        await self.put(self.documents, [(file, document, token_counts[document["id"]]) for document in documents])
+
+    async def diff_documents(
+        self, chunk_manifest: ChunkManifest, file: File, documents: List[dict[str, Any]]
+    ) -> List[dict[str, Any]]:
+        embedding_model = self.embeddings.open_ai_model_name if self.embeddings else None
+        hashes = {document["id"]: ChunkManifest.make_hash(document, embedding_model) for document in documents}
+        indexed_hashes = chunk_manifest.get(file.filename())
+        if not indexed_hashes:
+            # A file the manifest doesn't know may have been indexed without it, with ids numbering its sections.
+            # Those sections are replaced, like the sections a recorded file no longer has.
+            indexed_hashes = {id: "" for id in await self.search_manager.get_document_ids(file.filename())}
+        changed_documents = [
+            document for document in documents if indexed_hashes.get(document["id"]) != hashes[document["id"]]
+        ]
+        # Sections that the file no longer has, for example when it got shorter, are deleted and the manifest is
+        # updated only once the changed sections are indexed. A failed run leaves the file as it was indexed before,
+        # and is redone next time.
+        removed_ids = [id for id in indexed_hashes if id not in hashes]
+        self.removed_ids[file] = removed_ids
+        self.manifest_updates[file] = hashes
+        if self.verbose:
+            print(
+                f"'{file.filename()}' has {len(changed_documents)} new or changed sections, "
+                f"{len(documents) - len(changed_documents)} unchanged and {len(removed_ids)} removed"
+            )
+        return changed_documents
+
+    async def put(self, queue: asyncio.Queue, item: Optional[List[DocumentItem]]):
+        # Waits for room in the queue, unless a stage has failed and will never make room
+        put = asyncio.ensure_future(queue.put(item))
+        await asyncio.wait([put, *self.tasks], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            for task in self.tasks:
+                if task.done() and not task.cancelled() and task.exception():
+                    raise task.exception()  # type: ignore[misc]
+            raise RuntimeError("Ingestion pipeline stopped before all sections were added")
+
+    async def embed_documents(self, embeddings: OpenAIEmbeddings):
+        batcher: Optional[EmbeddingBatcher[DocumentItem]] = embeddings.create_batcher()
+        # Up to max_concurrency batches are embedded at the same time, the rate limiter of the embeddings spaces them out
+        pending: set[asyncio.Task] = set()
+
+        async def dispatch(batch: List[DocumentItem]):
+            while len(pending) >= embeddings.max_concurrency:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    task.result()
+            pending.add(asyncio.create_task(self.embed_batch(embeddings, batch)))
+
+        try:
+            while (items := await self.documents.get()) is not None:
+                for item in items:
+                    # Batches are filled like the embeddings fill them, so each one is sent in a single request
+                    if batcher is None:
+                        await dispatch([item])
+                        continue
+                    file, document, text_token_length = item
+                    if text_token_length is None:
+                        text_token_length = embeddings.calculate_token_length(document["content"])
+                        item = (file, document, text_token_length)
+                    for batch, _ in batcher.add(item, text_token_length):
+                        await dispatch(batch)
+            if batcher and batcher.items:
+                await dispatch(batcher.flush()[0])
+            await asyncio.gather(*pending)
+        finally:
+            for task in pending:
+                task.cancel()
+        await self.put(self.embedded, None)
+
+    async def embed_batch(self, embeddings: OpenAIEmbeddings, batch: List[DocumentItem]):
+        texts = [document["content"] for _, document, _ in batch]
+        token_lengths = [token_length for _, _, token_length in batch if token_length is not None]
+        # Sections found in the embedding cache skip the embedding requests
+        vectors = await embeddings.create_embeddings(texts, token_lengths if len(token_lengths) == len(batch) else None)
+        for (_, document, _), embedding in zip(batch, vectors):
+            document["embedding"] = embedding
+        if self.verbose:
+            print(f"Embedded {len(batch)} sections from {len(set(file for file, _, _ in batch))} files")
+        await self.put(self.embedded, batch)
+
+    async def index_documents(self):
+        batch: List[DocumentItem] = []
+        async with self.search_manager.search_info.create_search_client() as search_client:
+            while (items := await self.embedded.get()) is not None:
+                for item in items:
+                    batch.append(item)
+                    if len(batch) == SearchManager.MAX_BATCH_SIZE:
+                        await self.upload_batch(search_client, batch)
+                        batch = []
+            if batch:
+                await self.upload_batch(search_client, batch)
+
+    async def upload_batch(self, search_client, batch: List[DocumentItem]):
+        await search_client.upload_documents([document for _, document, _ in batch])
+        if self.verbose:
+            print(f"Uploaded {len(batch)} sections from {len(set(file for file, _, _ in batch))} files to search index")
+        for file, _, _ in batch:
+            self.remaining_documents[file] -= 1
+            if self.remaining_documents[file] == 0:
+                del self.remaining_documents[file]
+                await self.finish(file)
+
+    async def finish(self, file: File):
+        if self.chunk_manifest and file in self.manifest_updates:
+            if removed_ids := self.removed_ids.pop(file, None):
+                await self.search_manager.remove_documents(removed_ids)
+            self.chunk_manifest.set(file.filename(), self.manifest_updates.pop(file))
+        self.advance("Indexed", file)
+
+    def advance(self, stage: str, file: File):
+        if self.progress:
+            self.progress.advance(stage, file)
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from typing import Optional
+
+from tenacity import RetryCallState
+from tenacity.wait import wait_base
+
+
+class TokenBucket:
+    """
+    Bucket that refills continuously at a per-minute rate, holding at most burst_seconds worth of capacity.
+    Azure OpenAI evaluates its quotas over short windows, so the bucket doesn't allow a whole minute's quota at once.
+    """
+
+    def __init__(self, per_minute: int, burst_seconds: float = 10):
+        self.rate = per_minute / 60
+        self.capacity = max(self.rate * burst_seconds, 1)
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        # Amounts larger than the bucket only wait until it is full, otherwise they would never fit
+        return max(0, (min(amount, self.capacity) - self.available) / self.rate)
+
+    def take(self, amount: float):
+        self.available -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Schedules requests within a tokens per minute and a requests per minute quota, in the order they were made.
+    When the service asks to retry after some time, all requests are paused for that long.
+    """
+
+    def __init__(self, tokens_per_minute: Optional[int] = None, requests_per_minute: Optional[int] = None):
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                for bucket, amount in [(self.tokens, tokens), (self.requests, 1)]:
+                    if bucket:
+                        bucket.refill(now)
+                        wait = max(wait, bucket.wait_time(amount))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.tokens:
+                self.tokens.take(tokens)
+            if self.requests:
+                self.requests.take(1)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_retry_after(exception: Optional[BaseException]) -> Optional[float]:
+    # Azure OpenAI sends retry-after-ms along with retry-after, which only has a resolution of seconds
+    headers = getattr(exception, "headers", None) or {}
+    headers = {key.lower(): value for key, value in headers.items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class wait_retry_after(wait_base):
+    """
+    Tenacity wait strategy that waits as long as a rate limited response's Retry-After header asks,
+    falling back to another strategy when the response doesn't say
+    """
+
+    def __init__(self, fallback: wait_base):
+        self.fallback = fallback
+
+    def __call__(self, retry_state: RetryCallState) -> float:
+        retry_after = get_retry_after(retry_state.outcome.exception() if retry_state.outcome else None)
+        return retry_after if retry_after is not None else self.fallback(retry_state)
@@ -1,6 +1,7 @@
 import asyncio
+import hashlib
 import os
-from typing import List, Optional
+from typing import Any, List, Optional
 
 from azure.search.documents.indexes.models import (
     HnswParameters,
@@ -41,6 +42,9 @@ class SearchManager:
     To learn more, please visit https://learn.microsoft.com/azure/search/search-what-is-azure-search
     """
 
+    # Maximum number of documents uploaded to the search index in a single request
+    MAX_BATCH_SIZE = 1000
+
     def __init__(
         self,
         search_info: SearchInfo,
@@ -117,35 +121,55 @@ class SearchManager:
                 if self.search_info.verbose:
                     print(f"Search index {self.search_info.index_name} already exists")
 
-    async def update_content(self, sections: List[Section]):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+    def create_documents(self, sections: List[Section], content_ids: bool = False) -> List[dict[str, Any]]:
+        # Ids number the sections of a file in batches of MAX_BATCH_SIZE, as they were numbered when files were uploaded
+        # in batches, so ingesting a file again overwrites its sections. With content_ids, ids are derived from the
+        # content of the section and the page it cites instead, so inserting a section doesn't change the ids of the
+        # sections after it. Those are only used with a chunk manifest, which deletes the sections a file no longer has.
+        batch_size = SearchManager.MAX_BATCH_SIZE
+        documents = []
+        occurrences: dict[str, int] = {}
+        for i, section in enumerate(sections):
+            sourcepage = BlobManager.sourcepage_from_file_page(
+                filename=section.content.filename(),
+                page=section.split_page.page_num,
+                anchor=section.split_page.anchor,
+            )
+            if content_ids:
+                # Sections repeated on the same page are numbered
+                digest = hashlib.sha256(f"{sourcepage}\0{section.split_page.text}".encode()).hexdigest()[:32]
+                occurrences[digest] = occurrences.get(digest, 0) + 1
+                id = f"{section.content.filename_to_id()}-{digest}"
+                if occurrences[digest] > 1:
+                    id += f"-{occurrences[digest]}"
+            else:
+                id = f"{section.content.filename_to_id()}-batch-{i // batch_size}-page-{i % batch_size}"
+            documents.append(
+                {
+                    "id": id,
+                    "content": section.split_page.text,
+                    "category": section.category,
+                    "sourcepage": sourcepage,
+                    "sourcefile": section.content.filename(),
+                    **section.content.acls,
+                }
+            )
+        return documents
 
+    async def get_document_ids(self, sourcefile: str) -> List[str]:
+        filter = "sourcefile eq '{}'".format(sourcefile.replace("'", "''"))
         async with self.search_info.create_search_client() as search_client:
-            for index, batch in enumerate(section_batches):
-                if self.search_info.verbose:
-                    print(f"Uploading batch {index + 1} of {len(section_batches)} to search index")
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-batch-{index}-page-{i}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": BlobManager.sourcepage_from_file_page(
-                            filename=section.content.filename(), page=section.split_page.page_num
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for i, section in enumerate(batch)
-                ]
-                if self.embeddings:
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document["embedding"] = embeddings[i]
+            result = await search_client.search("", filter=filter, select=["id"])
+            return [document["id"] async for document in result]
 
-                await search_client.upload_documents(documents)
+    async def remove_documents(self, ids: List[str]):
+        async with self.search_info.create_search_client() as search_client:
+            for i in range(0, len(ids), SearchManager.MAX_BATCH_SIZE):
+                removed_docs = await search_client.delete_documents(
+                    documents=[{"id": id} for id in ids[i : i + SearchManager.MAX_BATCH_SIZE]]
+                )
+                if self.search_info.verbose:
+                    print(f"\tRemoved {len(removed_docs)} sections from index")
 
     async def remove_content(self, path: Optional[str] = None):
         if self.search_info.verbose:
@@ -1,3 +1,5 @@
+import os
+import time
 from abc import ABC
 from typing import Union
 
@@ -36,6 +38,18 @@ class SearchInfo:
     def create_search_indexer_client(self) -> SearchIndexerClient:
         return SearchIndexerClient(endpoint=self.endpoint, credential=self.credential)
 
+    def bump_cache_generation(self, directory: str):
+        """
+        Touches the marker file that the app keys its search result cache on, so results cached before
+        the index changed are no longer used
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.index_name}.generation")
+        with open(path, "w", encoding="utf-8") as generation_file:
+            generation_file.write(str(time.time()))
+        if self.verbose:
+            print(f"Invalidated search result cache for index {self.index_name} in {path}")
+
 
 class Strategy(ABC):
     """
@@ -1,39 +1,100 @@
-from typing import Generator, List
+import re
+from bisect import bisect_right
+from typing import Callable, Generator, List, Optional
 
 from .contentparsers import Page
+from .tokenizer import count_tokens
+
+
+def find_first(text: str, characters: List[str], start: int, end: int) -> int:
+    # Position of the first of the characters in text[start:end], or -1
+    positions = [
+        position for position in (text.find(character, start, end) for character in characters) if position >= 0
+    ]
+    return min(positions, default=-1)
+
+
+def find_last(text: str, characters: List[str], start: int, end: int) -> int:
+    # Position of the last of the characters in text[start:end], or -1
+    return max((text.rfind(character, start, end) for character in characters), default=-1)
 
 
 class SplitPage:
     """
     A section of a page that has been split into a smaller chunk.
+    The anchor, if any, is the id of the element of an HTML document that the chunk belongs to.
+    The token count, if any, is the number of tokens of the text, as counted by the splitter.
     """
 
-    def __init__(self, page_num: int, text: str):
+    def __init__(self, page_num: int, text: str, anchor: Optional[str] = None, token_count: Optional[int] = None):
         self.page_num = page_num
         self.text = text
+        self.anchor = anchor
+        self.token_count = token_count
 
 
 class TextSplitter:
     """
     Class that splits pages into smaller chunks. This is required because embedding models may not be able to analyze an entire page at once
+    With max_tokens, chunks that have more tokens than that are split further, and chunks carry their token count
     """
 
-    def __init__(self, verbose: bool = False):
+    def __init__(
+        self, verbose: bool = False, max_tokens: Optional[int] = None, model_name: str = "text-embedding-ada-002"
+    ):
         self.sentence_endings = [".", "!", "?"]
         self.word_breaks = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
         self.max_section_length = 1000
         self.sentence_search_limit = 100
         self.section_overlap = 100
         self.verbose = verbose
+        self.max_tokens = max_tokens
+        self.model_name = model_name
 
-    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
-        def find_page(offset):
+    def count_tokens(self, text: str) -> int:
+        return count_tokens(text, self.model_name)
+
+    def create_split_pages(self, page_num: int, text: str) -> Generator[SplitPage, None, None]:
+        if self.max_tokens is None:
+            yield SplitPage(page_num=page_num, text=text)
+            return
+        token_count = self.count_tokens(text)
+        if token_count <= self.max_tokens or len(text) < 2:
+            yield SplitPage(page_num=page_num, text=text, token_count=token_count)
+            return
+        # Split in two, at the sentence ending or else the word break closest to the middle
+        middle = len(text) // 2
+        split_at = middle
+        for characters in (self.sentence_endings, self.word_breaks):
+            before = find_last(text, characters, 1, middle + 1)
+            after = find_first(text, characters, middle + 1, len(text) - 1)
+            candidates = [position + 1 for position in (before, after) if position >= 0]
+            if candidates:
+                split_at = min(candidates, key=lambda position: abs(position - middle))
+                break
+        yield from self.create_split_pages(page_num, text[:split_at])
+        yield from self.create_split_pages(page_num, text[split_at:])
+
+    @staticmethod
+    def create_page_finder(pages: List[Page]) -> Callable[[int], int]:
+        page_offsets = [page.offset for page in pages]
+        pages_in_order = all(page_offsets[i] <= page_offsets[i + 1] for i in range(len(page_offsets) - 1))
+
+        def find_page(offset: int) -> int:
             num_pages = len(pages)
+            if pages_in_order:
+                # The page whose offset is the last one at or before the offset, or the last page if there is none
+                i = bisect_right(page_offsets, offset) - 1
+                return pages[i if i >= 0 else num_pages - 1].page_num
             for i in range(num_pages - 1):
                 if offset >= pages[i].offset and offset < pages[i + 1].offset:
                     return pages[i].page_num
             return pages[num_pages - 1].page_num
 
+        return find_page
+
+    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
+        find_page = TextSplitter.create_page_finder(pages)
         all_text = "".join(page.text for page in pages)
         length = len(all_text)
         start = 0
@@ -45,15 +106,15 @@ class TextSplitter:
             if end > length:
                 end = length
             else:
-                # Try to find the end of the sentence
-                while (
-                    end < length
-                    and (end - start - self.max_section_length) < self.sentence_search_limit
-                    and all_text[end] not in self.sentence_endings
-                ):
-                    if all_text[end] in self.word_breaks:
-                        last_word = end
-                    end += 1
+                # Try to find the end of the sentence, within sentence_search_limit after max_section_length.
+                # The boundaries are searched with str.find over the window rather than character by character.
+                search_end = min(length, start + self.max_section_length + self.sentence_search_limit)
+                if (sentence_end := find_first(all_text, self.sentence_endings, end, search_end)) >= 0:
+                    end = sentence_end
+                else:
+                    # Remember the last word break in case no sentence ends there
+                    last_word = find_last(all_text, self.word_breaks, end, search_end)
+                    end = search_end
                 if end < length and all_text[end] not in self.sentence_endings and last_word > 0:
                     end = last_word  # Fall back to at least keeping a whole word
             if end < length:
@@ -61,21 +122,20 @@ class TextSplitter:
 
             # Try to find the start of the sentence or at least a whole word boundary
             last_word = -1
-            while (
-                start > 0
-                and start > end - self.max_section_length - 2 * self.sentence_search_limit
-                and all_text[start] not in self.sentence_endings
-            ):
-                if all_text[start] in self.word_breaks:
-                    last_word = start
-                start -= 1
+            search_start = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+            if start > search_start:
+                sentence_start = find_last(all_text, self.sentence_endings, search_start + 1, start + 1)
+                section_start = sentence_start if sentence_start >= 0 else search_start
+                # The first word break after the start of the sentence
+                last_word = find_first(all_text, self.word_breaks, section_start + 1, start + 1)
+                start = section_start
             if all_text[start] not in self.sentence_endings and last_word > 0:
                 start = last_word
             if start > 0:
                 start += 1
 
             section_text = all_text[start:end]
-            yield SplitPage(page_num=find_page(start), text=section_text)
+            yield from self.create_split_pages(find_page(start), section_text)
 
             last_table_start = section_text.rfind("<table")
             if last_table_start > 2 * self.sentence_search_limit and last_table_start > section_text.rfind("</table"):
@@ -91,4 +151,107 @@ class TextSplitter:
                 start = end - self.section_overlap
 
         if start + self.section_overlap < end:
-            yield SplitPage(page_num=find_page(start), text=all_text[start:end])
+            yield from self.create_split_pages(find_page(start), all_text[start:end])
+
+
+class HtmlTextSplitter(TextSplitter):
+    """
+    Splits HTML documents along their structure, such as the manuals produced by the preprocessing scripts.
+    Each <section> is split separately, and a section that doesn't fit in max_tokens is split at its headings,
+    then at tables and lists, then at rows and list items, and only then at sentences and words, packing as many
+    consecutive parts into a chunk as fit. Chunks carry the id of their section or subsection heading as anchor,
+    and chunks that don't start a section repeat the section title so they can be understood on their own.
+    """
+
+    SECTION_START = re.compile(r"(?:<!--(?:(?!-->).)*-->\s*)?<section\b", re.DOTALL)
+    # Where to split a part that doesn't fit, from the preferred boundaries to the last resort
+    SPLIT_LEVELS = [
+        (re.compile(r"(?:<!--(?:(?!-->).)*-->\s*)?<h[1-6]\b", re.DOTALL), None),
+        (re.compile(r"<(?:table|ul|ol|div)\b"), re.compile(r"</(?:table|ul|ol|div)>")),
+        (re.compile(r"<(?:tr|li|p)\b"), re.compile(r"</(?:tr|li|p)>|<br\s*/?>")),
+        (None, re.compile(r"[.!?]\s+")),
+        (None, re.compile(r"\s+")),
+    ]
+    HEADING_END = re.compile(r"</h[1-6]>\s*(?:<!--(?:(?!-->).)*-->\s*)*", re.DOTALL)
+    SECTION_TAG = re.compile(r"<section\b[^>]*>")
+    HEADING = re.compile(r"<(h[1-6])\b[^>]*>(.*?)</\1>", re.DOTALL)
+    LEADING_HEADING_ID = re.compile(r"\s*(?:<!--(?:(?!-->).)*-->\s*)*<h[1-6]\b[^>]*\bid=\"([^\"]+)\"", re.DOTALL)
+    ID_ATTRIBUTE = re.compile(r"\bid=\"([^\"]+)\"")
+
+    def __init__(self, max_tokens: int = 500, model_name: str = "text-embedding-ada-002", verbose: bool = False):
+        super().__init__(verbose, max_tokens, model_name)
+        self.max_tokens: int = max_tokens
+
+    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
+        find_page = TextSplitter.create_page_finder(pages)
+        all_text = "".join(page.text for page in pages)
+        section_starts = [0] + [match.start() for match in HtmlTextSplitter.SECTION_START.finditer(all_text)]
+        section_starts.append(len(all_text))
+        for section_start, section_end in zip(section_starts, section_starts[1:]):
+            section_text = all_text[section_start:section_end]
+            if not section_text.strip():
+                continue
+            section_tag = HtmlTextSplitter.SECTION_TAG.search(section_text)
+            section_id = HtmlTextSplitter.ID_ATTRIBUTE.search(section_tag.group(0)) if section_tag else None
+            heading = HtmlTextSplitter.HEADING.search(section_text) if section_tag else None
+            title = f"<{heading.group(1)}>{heading.group(2)}</{heading.group(1)}>" if heading else ""
+            if self.count_tokens(section_text) <= self.max_tokens:
+                ranges = [(0, len(section_text))]
+            else:
+                # Leave room for the title that is repeated at the start of the following chunks
+                ranges = self.split_part(
+                    section_text, 0, len(section_text), 0, self.max_tokens - self.count_tokens(title)
+                )
+            for start, end in ranges:
+                text = section_text[start:end]
+                if not text.strip():
+                    continue
+                anchor = section_id.group(1) if section_id else None
+                if heading_id := HtmlTextSplitter.LEADING_HEADING_ID.match(text):
+                    anchor = heading_id.group(1)
+                if heading and start > heading.start():
+                    text = title + text
+                yield SplitPage(
+                    page_num=find_page(section_start + start),
+                    text=text,
+                    anchor=anchor,
+                    token_count=self.count_tokens(text),
+                )
+
+    def split_part(self, text: str, start: int, end: int, level: int, max_tokens: int) -> List[tuple[int, int]]:
+        # Ranges of text[start:end] that each fit in max_tokens, splitting at the boundaries of the level
+        if level == len(HtmlTextSplitter.SPLIT_LEVELS):
+            # A single word that doesn't fit is cut, a token is at least one character long
+            step = max(max_tokens, 1)
+            return [(i, min(i + step, end)) for i in range(start, end, step)]
+        split_before, split_after = HtmlTextSplitter.SPLIT_LEVELS[level]
+        positions: set[int] = set()
+        if split_before:
+            positions.update(match.start() for match in split_before.finditer(text, start, end))
+        if split_after:
+            positions.update(match.end() for match in split_after.finditer(text, start, end))
+        # Headings stay with the content that follows them
+        positions.difference_update(match.end() for match in HtmlTextSplitter.HEADING_END.finditer(text, start, end))
+        boundaries = [start] + sorted(position for position in positions if start < position < end) + [end]
+
+        ranges: List[tuple[int, int]] = []
+        chunk_start, chunk_tokens = start, 0
+        for part_start, part_end in zip(boundaries, boundaries[1:]):
+            part_tokens = self.count_tokens(text[part_start:part_end])
+            if chunk_tokens + part_tokens <= max_tokens:
+                chunk_tokens += part_tokens
+                continue
+            if part_tokens <= max_tokens:
+                ranges.append((chunk_start, part_start))
+                chunk_start, chunk_tokens = part_start, part_tokens
+                continue
+            if chunk_start < part_start:
+                ranges.append((chunk_start, part_start))
+            # The last piece of the part stays open for the parts that follow
+            part_ranges = self.split_part(text, part_start, part_end, level + 1, max_tokens)
+            ranges.extend(part_ranges[:-1])
+            chunk_start, chunk_end = part_ranges[-1]
+            chunk_tokens = self.count_tokens(text[chunk_start:chunk_end])
+        if chunk_start < end:
+            ranges.append((chunk_start, end))
+        return ranges
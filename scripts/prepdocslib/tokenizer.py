@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    # Loading an encoding builds its whole vocabulary, so each one is only loaded once per process
+    return tiktoken.encoding_for_model(model_name)
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    return len(get_encoding(model_name).encode(text, disallowed_special=()))
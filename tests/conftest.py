@@ -20,6 +20,19 @@ from core.authentication import AuthenticationHelper
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
 
 
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="Also run the micro-benchmarks, which compare timings")
+
+
+def pytest_collection_modifyitems(config, items):
+    # Timings are unreliable on shared CI runners, so micro-benchmarks only run when asked for
+    if config.getoption("--benchmark"):
+        return
+    for item in items:
+        if item.get_closest_marker("benchmark"):
+            item.add_marker(pytest.mark.skip(reason="micro-benchmark, run with --benchmark"))
+
+
 class MockAzureCredential(AsyncTokenCredential):
     async def get_token(self, uri):
         return MockToken("mock_token", 9999999999)
@@ -3,6 +3,7 @@ import logging
 import os
 from unittest import mock
 
+import openai
 import pytest
 import quart.testing.app
 
@@ -99,7 +100,7 @@ async def test_ask_rtr_text_filter(auth_client, snapshot):
     assert response.status_code == 200
     assert (
         auth_client.config[app.CONFIG_SEARCH_CLIENT].filter
-        == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
+        == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y,GROUP_Z')))"
     )
     result = await response.get_json()
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
@@ -230,7 +231,7 @@ async def test_chat_text_filter(auth_client, snapshot):
     assert response.status_code == 200
     assert (
         auth_client.config[app.CONFIG_SEARCH_CLIENT].filter
-        == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
+        == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y,GROUP_Z')))"
     )
     result = await response.get_json()
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
@@ -370,7 +371,7 @@ async def test_chat_stream_text_filter(auth_client, snapshot):
     assert response.status_code == 200
     assert (
         auth_client.config[app.CONFIG_SEARCH_CLIENT].filter
-        == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
+        == "category ne 'excluded' and (oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y,GROUP_Z')))"
     )
     result = await response.get_data()
     snapshot.assert_match(result, "result.jsonlines")
@@ -528,3 +529,21 @@ def test_error_dict(caplog):
     assert error == {
         "error": "The app encountered an error processing your request.\nIf you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.\nError type: <class 'Exception'>\n"
     }
+
+
+@pytest.mark.asyncio
+async def test_openai_session_shared(client, monkeypatch):
+    sessions = []
+
+    async def mock_run(*args, **kwargs):
+        sessions.append(openai.aiosession.get())
+        return {"choices": []}
+
+    monkeypatch.setattr("approaches.retrievethenread.RetrieveThenReadApproach.run", mock_run)
+    monkeypatch.setattr("approaches.chatreadretrieveread.ChatReadRetrieveReadApproach.run", mock_run)
+    for route in ["/ask", "/chat", "/chat"]:
+        response = await client.post(route, json={"messages": [{"content": "Hi", "role": "user"}]})
+        assert response.status_code == 200
+    session = client.app.config[app.CONFIG_OPENAI_SESSION]
+    assert sessions == [session, session, session]
+    assert not session.closed
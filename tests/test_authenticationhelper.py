@@ -1,9 +1,16 @@
+import asyncio
+import base64
+import json
+import time
+import uuid
+
+import msal
 import pytest
 
-from core.authentication import AuthenticationHelper, AuthError
+from core.authentication import AuthenticationHelper, AuthError, compile_filter
 
 
-def create_authentication_helper():
+def create_authentication_helper(claims_cache_size: int = 0):
     return AuthenticationHelper(
         use_authentication=True,
         server_app_id="SERVER_APP",
@@ -11,9 +18,15 @@ def create_authentication_helper():
         client_app_id="CLIENT_APP",
         tenant_id="TENANT_ID",
         token_cache_path=None,
+        claims_cache_size=claims_cache_size,
     )
 
 
+def create_token(claims: dict) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode("utf-8")).decode("ascii").rstrip("=")
+    return f"header.{payload}.signature"
+
+
 @pytest.mark.asyncio
 async def test_get_auth_claims_success(mock_confidential_client_success):
     helper = create_authentication_helper()
@@ -44,6 +57,55 @@ async def test_get_auth_claims_overage_unauthorized(mock_confidential_client_ove
     assert len(auth_claims.keys()) == 0
 
 
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(mock_confidential_client_overage, mock_list_groups_success):
+    helper = create_authentication_helper(claims_cache_size=10)
+    # The Graph mock fails if the groups are listed more than once
+    results = await asyncio.gather(
+        *[helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) for _ in range(3)]
+    )
+    results.append(await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}))
+    for auth_claims in results:
+        assert auth_claims == {"oid": "OID_X", "groups": ["OVERAGE_GROUP_Y", "OVERAGE_GROUP_Z"]}
+    assert helper.claims_cache.hits == 1
+    assert helper.pending_claims == {}
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cache_per_token(monkeypatch, mock_confidential_client_success):
+    assertions = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        assertions.append(kwargs["user_assertion"])
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": []}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    helper = create_authentication_helper(claims_cache_size=10)
+    expired_token = create_token({"oid": "OID_X", "exp": time.time() - 60})
+    valid_token = create_token({"oid": "OID_X", "exp": time.time() + 3600})
+    for token in [expired_token, expired_token, valid_token, valid_token, "Token"]:
+        await helper.get_auth_claims_if_enabled(headers={"Authorization": f"Bearer {token}"})
+    assert assertions == [expired_token, expired_token, valid_token, "Token"]
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_errors_not_cached(mock_confidential_client_unauthorized):
+    helper = create_authentication_helper(claims_cache_size=10)
+    auth_claims = await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"})
+    assert auth_claims == {}
+    assert helper.claims_cache.entries == {}
+    assert helper.pending_claims == {}
+
+
+def test_get_token_expiration():
+    assert AuthenticationHelper.get_token_expiration(create_token({"exp": 1700000000})) == 1700000000
+    assert AuthenticationHelper.get_token_expiration(create_token({"oid": "OID_X"})) is None
+    assert AuthenticationHelper.get_token_expiration("Token") is None
+    assert AuthenticationHelper.get_token_expiration("header.not-base64!.signature") is None
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -108,14 +170,14 @@ def test_build_security_filters():
         AuthenticationHelper.build_security_filters(
             overrides={"use_groups_security_filter": True}, auth_claims={"groups": ["GROUP_Y", "GROUP_Z"]}
         )
-        == "groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z'))"
+        == "groups/any(g:search.in(g, 'GROUP_Y,GROUP_Z'))"
     )
     assert (
         AuthenticationHelper.build_security_filters(
             overrides={"use_oid_security_filter": True, "use_groups_security_filter": True},
             auth_claims={"oid": "OID_X", "groups": ["GROUP_Y", "GROUP_Z"]},
         )
-        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y, GROUP_Z')))"
+        == "(oids/any(g:search.in(g, 'OID_X')) or groups/any(g:search.in(g, 'GROUP_Y,GROUP_Z')))"
     )
     assert (
         AuthenticationHelper.build_security_filters(
@@ -129,3 +191,80 @@ def test_build_security_filters():
         )
         == "oids/any(g:search.in(g, ''))"
     )
+
+
+def test_build_filter():
+    assert (
+        AuthenticationHelper.build_filter(overrides={"exclude_category": "dogs"}, auth_claims={})
+        == "category ne 'dogs'"
+    )
+    # Groups are deduplicated and sorted, so the same claims in any order share one compiled filter
+    assert (
+        AuthenticationHelper.build_filter(
+            overrides={"exclude_category": "cat's", "use_groups_security_filter": True},
+            auth_claims={"groups": ["GROUP_Z", "GROUP_Y", "GROUP_Z"]},
+        )
+        == "category ne 'cat''s' and groups/any(g:search.in(g, 'GROUP_Y,GROUP_Z'))"
+    )
+
+
+def test_build_filter_memoized():
+    compile_filter.cache_clear()
+    overrides = {"use_oid_security_filter": True, "use_groups_security_filter": True}
+    auth_claims = {"oid": "OID_X", "groups": [f"GROUP_{i}" for i in range(600)]}
+    security_filter = AuthenticationHelper.build_filter(overrides, auth_claims)
+    assert (
+        AuthenticationHelper.build_filter(overrides, {**auth_claims, "groups": list(auth_claims["groups"])})
+        is security_filter
+    )
+    assert compile_filter.cache_info().hits == 1
+    assert "search.in(g, 'GROUP_0,GROUP_1,GROUP_10," in security_filter
+
+
+def test_build_filter_many_groups_compiled_once():
+    # A user in 600 groups only pays for compiling the filter on their first request
+    compile_filter.cache_clear()
+    overrides = {"use_oid_security_filter": True, "use_groups_security_filter": True, "exclude_category": "excluded"}
+    groups = [str(uuid.UUID(int=i)) for i in range(600)]
+    security_filters = {
+        AuthenticationHelper.build_filter(overrides, {"oid": "OID_X", "groups": list(groups)}) for _ in range(200)
+    }
+    assert len(security_filters) == 1
+    assert compile_filter.cache_info().misses == 1
+    assert compile_filter.cache_info().hits == 199
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio
+async def test_filter_and_claims_benchmark(monkeypatch, mock_confidential_client_success):
+    # Micro-benchmark: memoized filters and cached claims are much cheaper than compiling and looking them up again
+    overrides = {"use_oid_security_filter": True, "use_groups_security_filter": True, "exclude_category": "excluded"}
+    auth_claims = {"oid": "OID_X", "groups": [str(uuid.UUID(int=i)) for i in range(600)]}
+
+    def seconds_per_filter(memoized: bool) -> float:
+        start = time.perf_counter()
+        for _ in range(200):
+            if not memoized:
+                compile_filter.cache_clear()
+            AuthenticationHelper.build_filter(overrides, auth_claims)
+        return (time.perf_counter() - start) / 200
+
+    seconds_per_filter(memoized=False)  # warm up
+    assert seconds_per_filter(memoized=True) * 3 < seconds_per_filter(memoized=False)
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        time.sleep(0.001)  # The token exchange is a round trip to Microsoft Entra ID
+        return {"access_token": "MockToken", "id_token_claims": auth_claims}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+
+    async def seconds_per_lookup(helper: AuthenticationHelper) -> float:
+        start = time.perf_counter()
+        for _ in range(50):
+            assert await helper.get_auth_claims_if_enabled(headers={"Authorization": "Bearer Token"}) == auth_claims
+        return (time.perf_counter() - start) / 50
+
+    cached_seconds = await seconds_per_lookup(create_authentication_helper(claims_cache_size=10))
+    assert cached_seconds * 10 < await seconds_per_lookup(create_authentication_helper())
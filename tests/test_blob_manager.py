@@ -166,6 +166,7 @@ async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
 def test_sourcepage_from_file_page():
     assert BlobManager.sourcepage_from_file_page("test.pdf", 0) == "test.pdf#page=1"
     assert BlobManager.sourcepage_from_file_page("test.html", 0) == "test.html"
+    assert BlobManager.sourcepage_from_file_page("test.html", 0, anchor="SEC-1") == "test.html#SEC-1"
 
 
 def test_blob_name_from_file_name():
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import threading
+import time
+
+import openai
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
+from approaches.retrievethenread import RetrieveThenReadApproach
+from core.cache import Cache, CacheGeneration, MemoryCache, SQLiteCache, create_cache
+
+from scripts.prepdocslib.strategy import SearchInfo
+
+
+@pytest.mark.asyncio
+async def test_memorycache_lru():
+    cache = MemoryCache("test", max_size=2)
+    await cache.set("a", 1)
+    await cache.set("b", 2)
+    assert await cache.get("a") == 1
+    # "b" is now the least recently used entry
+    await cache.set("c", 3)
+    assert await cache.get("b") is None
+    assert await cache.get("a") == 1
+    assert await cache.get("c") == 3
+    assert cache.stats() == {"hits": 3, "misses": 1, "hit_ratio": 0.75}
+
+
+@pytest.mark.asyncio
+async def test_memorycache_ttl(monkeypatch):
+    now = time.monotonic()
+    cache = MemoryCache("test", max_size=10, ttl=60)
+    await cache.set("a", [0.1, 0.2])
+    assert await cache.get("a") == [0.1, 0.2]
+    monkeypatch.setattr(time, "monotonic", lambda: now + 61)
+    assert await cache.get("a") is None
+    assert len(cache.entries) == 0
+
+
+@pytest.mark.asyncio
+async def test_sqlitecache_persists():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        path = os.path.join(tmpdirname, "cache.db")
+        cache = SQLiteCache("embeddings", path)
+        await cache.set("a", [0.1, 0.2])
+        cache.close()
+
+        cache = SQLiteCache("embeddings", path)
+        assert await cache.get("a") == [0.1, 0.2]
+        assert await cache.get("b") is None
+        await cache.clear()
+        assert await cache.get("a") is None
+        cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlitecache_purges_expired_entries(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        now = time.time()
+        cache = SQLiteCache("embeddings", os.path.join(tmpdirname, "cache.db"), ttl=60)
+        await cache.set("a", 1)
+        monkeypatch.setattr(time, "time", lambda: now + 30)
+        await cache.set("b", 2)
+        monkeypatch.setattr(time, "time", lambda: now + 75)
+        await cache.set("c", 3)
+        # Expired entries are deleted by the next write, once the purge interval has passed
+        assert [row[0] for row in cache.connection.execute('SELECT key FROM "embeddings" ORDER BY key')] == ["b", "c"]
+        assert await cache.get("a") is None
+        assert await cache.get("b") == 2
+        cache.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlitecache_queries_off_the_event_loop():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = SQLiteCache("embeddings", os.path.join(tmpdirname, "cache.db"))
+        query_threads = set()
+        cache.connection.set_trace_callback(lambda _: query_threads.add(threading.get_ident()))
+        await cache.set("a", 1)
+        assert await cache.get("a") == 1
+        await cache.clear()
+        assert query_threads and threading.get_ident() not in query_threads
+        cache.close()
+
+
+def test_cache_is_abstract():
+    with pytest.raises(TypeError):
+        Cache("test")  # type: ignore[abstract]
+
+
+@pytest.mark.asyncio
+async def test_memorycache_promotes_from_backing_cache():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        backing_cache = SQLiteCache("embeddings", os.path.join(tmpdirname, "cache.db"))
+        await backing_cache.set("a", {"value": 1})
+        cache = MemoryCache("embeddings", max_size=10, backing_cache=backing_cache)
+        assert await cache.get("a") == {"value": 1}
+        assert "a" in cache.entries
+        await cache.set("b", 2)
+        assert await backing_cache.get("b") == 2
+        backing_cache.close()
+
+
+def test_create_cache():
+    assert create_cache("test", 0) is None
+    assert isinstance(create_cache("test", 10), MemoryCache)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = create_cache("test", 0, path=os.path.join(tmpdirname, "cache.db"))
+        assert isinstance(cache, SQLiteCache)
+        cache.close()
+
+
+@pytest.mark.asyncio
+async def test_compute_text_embedding_cached(monkeypatch):
+    monkeypatch.setattr(openai, "api_type", "openai")
+    queries = []
+
+    async def mock_acreate(*args, **kwargs):
+        queries.append(kwargs["input"])
+        return {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    approach = RetrieveThenReadApproach(
+        None,
+        "openai",
+        None,
+        "gpt-35-turbo",
+        None,
+        "text-embedding-ada-002",
+        "sourcepage",
+        "content",
+        "en-us",
+        "lexicon",
+        embedding_cache=MemoryCache("embeddings", max_size=10),
+    )
+    assert await approach.compute_text_embedding("How do I check photocell of the CSU frame?") == [0.1, 0.2, 0.3]
+    assert await approach.compute_text_embedding(" How do I check  photocell of the CSU frame? ") == [0.1, 0.2, 0.3]
+    assert queries == ["How do I check photocell of the CSU frame?"]
+    assert approach.embedding_cache.hits == 1
+
+
+def test_cachegeneration():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        generation = CacheGeneration(os.path.join(tmpdirname, "test-index.generation"))
+        assert generation.current() == 0
+        # prepdocs.py bumps the generation after ingesting content into the index
+        SearchInfo(endpoint="", credential=AzureKeyCredential("x"), index_name="test-index").bump_cache_generation(
+            tmpdirname
+        )
+        assert generation.current() != 0
+
+
+@pytest.mark.asyncio
+async def test_search_cached(mock_acs_search):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        search_client = SearchClient(
+            endpoint="https://test.search.windows.net", index_name="test-index", credential=AzureKeyCredential("x")
+        )
+        approach = RetrieveThenReadApproach(
+            search_client,
+            "openai",
+            None,
+            "gpt-35-turbo",
+            None,
+            "text-embedding-ada-002",
+            "sourcepage",
+            "content",
+            "en-us",
+            "lexicon",
+            search_cache=MemoryCache("search-test-index", max_size=10),
+            search_cache_generation=CacheGeneration(os.path.join(tmpdirname, "test-index.generation")),
+        )
+        docs = await approach.search("whistleblower policy", None, None, 3, True, True)
+        assert docs[0]["@search.captions"] == [{"text": "Caption: A whistleblower policy.", "highlights": None}]
+        assert await approach.search("whistleblower policy", None, None, 3, True, True) == docs
+        assert approach.search_cache.hits == 1
+        # A different filter is a different query
+        await approach.search("whistleblower policy", None, "category ne 'x'", 3, True, True)
+        assert approach.search_cache.misses == 2
+
+        with open(os.path.join(tmpdirname, "test-index.generation"), "w") as generation_file:
+            generation_file.write("1")
+        await approach.search("whistleblower policy", None, None, 3, True, True)
+        assert approach.search_cache.misses == 3
@@ -1,6 +1,14 @@
+import asyncio
 import json
 
+import openai
+import pytest
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.cache import MemoryCache
+from core.modelhelper import num_tokens_from_texts
 
 
 def test_get_search_query():
@@ -231,3 +239,244 @@ def test_get_messages_from_history_few_shots():
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+def test_is_same_query():
+    assert ChatReadRetrieveReadApproach.is_same_query("capital of France", "  Capital of   france ")
+    assert not ChatReadRetrieveReadApproach.is_same_query("capital of France", "What is the capital of France?")
+
+
+def test_fuse_results():
+    text_docs = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    vector_docs = [{"id": "c"}, {"id": "d"}]
+    fused = ChatReadRetrieveReadApproach.fuse_results([text_docs, vector_docs], top=3)
+    # "c" appears in both lists, so it outranks documents found by only one sub-query
+    assert [doc["id"] for doc in fused] == ["c", "a", "b"]
+
+
+def create_chat_approach(**kwargs):
+    return ChatReadRetrieveReadApproach(
+        SearchClient(endpoint="https://test.search.windows.net", index_name="test", credential=AzureKeyCredential("x")),
+        "openai",
+        None,
+        "gpt-35-turbo",
+        None,
+        "text-embedding-ada-002",
+        "sourcepage",
+        "content",
+        "en-us",
+        "lexicon",
+        **kwargs,
+    )
+
+
+@pytest.fixture
+def embedded_queries(monkeypatch, mock_openai_chatcompletion, mock_acs_search):
+    monkeypatch.setattr(openai, "api_type", "openai")
+    queries = []
+
+    async def mock_acreate(*args, **kwargs):
+        queries.append(kwargs["input"])
+        return {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    return queries
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_reembeds_rewritten_query(embedded_queries, monkeypatch):
+    mock_acreate = openai.ChatCompletion.acreate
+
+    async def slow_acreate(*args, **kwargs):
+        # Let the speculative embedding start while the query is being generated, as it would over the network
+        await asyncio.sleep(0)
+        return await mock_acreate(*args, **kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_acreate)
+    chat_approach = create_chat_approach(speculative_embedding="reembed")
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {}, {})
+    chat_coroutine.close()
+    # The generated query "capital of France" diverges from the question, so it is embedded as well
+    assert embedded_queries == ["What is the capital of France?", "capital of France"]
+    assert extra_info["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+
+
+@pytest.mark.asyncio
+async def test_speculative_embedding_raw(embedded_queries):
+    chat_approach = create_chat_approach(speculative_embedding="raw")
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    _, chat_coroutine = await chat_approach.run_until_final_call(history, {}, {})
+    chat_coroutine.close()
+    assert embedded_queries == ["What is the capital of France?"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_subqueries(embedded_queries):
+    chat_approach = create_chat_approach(concurrent_subqueries=True)
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {"retrieval_mode": "hybrid"}, {})
+    chat_coroutine.close()
+    assert embedded_queries == ["capital of France"]
+    # The same document comes back from both the text and the vector sub-query and is only used once
+    assert extra_info["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_subqueries_failure(monkeypatch):
+    chat_approach = create_chat_approach()
+    cancelled_searches = []
+
+    async def mock_search(query_text, query_vector, *args):
+        if query_text:
+            raise ConnectionError("Search failed")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled_searches.append("vector")
+            raise
+
+    monkeypatch.setattr(chat_approach, "search", mock_search)
+    query_vector = asyncio.get_running_loop().create_future()
+    with pytest.raises(ConnectionError):
+        await chat_approach.search_concurrently("capital of France", query_vector, None, 3, False, False)
+    # The pending embedding and the vector search are cancelled when the text search fails
+    assert query_vector.cancelled()
+
+    query_vector = asyncio.get_running_loop().create_future()
+    query_vector.set_result([0.1, 0.2, 0.3])
+    with pytest.raises(ConnectionError):
+        await chat_approach.search_concurrently("capital of France", query_vector, None, 3, False, False)
+    assert cancelled_searches == ["vector"]
+
+
+def test_speculative_embedding_unknown_mode():
+    with pytest.raises(ValueError, match="speculative embedding mode 'always'"):
+        create_chat_approach(speculative_embedding="always")
+
+
+@pytest.mark.asyncio
+async def test_answer_cache(embedded_queries, monkeypatch):
+    chat_approach = create_chat_approach(answer_cache=MemoryCache("answers", max_size=10))
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    overrides = {"temperature": 0, "retrieval_mode": "text"}
+    first = await chat_approach.run_without_streaming(history, overrides, {})
+    assert first["choices"][0]["message"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+
+    async def mock_acreate_answer(*args, **kwargs):
+        if kwargs.get("functions"):
+            return openai.util.convert_to_openai_object(
+                {"choices": [{"message": {"role": "assistant", "content": "capital of France"}}]}
+            )
+        raise AssertionError("The answer should come from the cache")
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", mock_acreate_answer)
+    second = await chat_approach.run_without_streaming(history, overrides, {})
+    assert second["choices"][0]["message"]["content"] == first["choices"][0]["message"]["content"]
+    events = [event async for event in chat_approach.run_with_streaming(history, overrides, {})]
+    assert events[1]["choices"][0]["delta"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    assert chat_approach.answer_cache.hits == 2
+
+
+@pytest.mark.asyncio
+async def test_answer_cache_streaming(embedded_queries):
+    chat_approach = create_chat_approach(answer_cache=MemoryCache("answers", max_size=10))
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    [event async for event in chat_approach.run_with_streaming(history, {"temperature": 0}, {})]
+    assert list(chat_approach.answer_cache.entries.values())[0][1] == (
+        "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    )
+    # Answers are only cached for deterministic requests
+    [event async for event in chat_approach.run_with_streaming(history, {"temperature": 0.5}, {})]
+    assert len(chat_approach.answer_cache.entries) == 1
+
+
+def test_get_messages_from_history_long():
+    chat_approach = create_chat_approach()
+    history = []
+    for turn in range(150):
+        history.append({"role": "user", "content": f"What is step {turn} of the procedure?"})
+        history.append({"role": "assistant", "content": f"Step {turn} is to check photocell {turn}."})
+    history.append({"role": "user", "content": "What is the last step?"})
+    few_shots = [{"role": "user", "content": "Shot question"}, {"role": "assistant", "content": "Shot answer"}]
+
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id="gpt-35-turbo",
+        history=history,
+        user_content="What is the last step?",
+        max_tokens=100000,
+        few_shots=few_shots,
+    )
+    assert messages == [{"role": "system", "content": "You are a bot."}, *few_shots, *history]
+
+    messages = chat_approach.get_messages_from_history(
+        system_prompt="You are a bot.",
+        model_id="gpt-35-turbo",
+        history=history,
+        user_content="What is the last step?",
+        max_tokens=100,
+        few_shots=few_shots,
+    )
+    # Only the newest turns fit, and they keep their order
+    assert messages[:3] == [{"role": "system", "content": "You are a bot."}, *few_shots]
+    assert messages[3:] == history[-len(messages) + 3 :]
+
+
+def test_pack_sources_content():
+    chat_approach = create_chat_approach()
+    sources = [
+        "info1.html: " + "Check the photocell. " * 10,
+        "info2.html: " + "Clean the lens. " * 100,
+        "info3.html: Replace the fuse.",
+    ]
+    # Room for the first source and part of the second one
+    max_tokens = num_tokens_from_texts(sources[:1], "gpt-35-turbo")[0] + 1 + 60
+    packed, decisions = chat_approach.pack_sources_content(sources, max_tokens)
+    assert packed[0] == sources[0]
+    assert packed[1].startswith("info2.html: Clean the lens.")
+    assert len(packed) == 2
+    assert sum(num_tokens_from_texts(packed, "gpt-35-turbo")) + len(packed) <= max_tokens
+    assert decisions[0].startswith("info1.html: kept")
+    assert decisions[1].startswith("info2.html: truncated to 59 of")
+    assert decisions[2].startswith("info3.html: dropped")
+    assert decisions[3] == f"{max_tokens} of {max_tokens} tokens used by 2 of 3 sources"
+
+    packed, decisions = chat_approach.pack_sources_content(sources, 10000)
+    assert packed == sources
+
+    # Without room for sources, they are all dropped
+    for max_tokens in [0, -100]:
+        packed, decisions = chat_approach.pack_sources_content(sources, max_tokens)
+        assert packed == []
+        assert decisions[0].startswith("info1.html: dropped (")
+        assert decisions[0].endswith("no tokens left for sources")
+        assert decisions[3] == "0 of 0 tokens used by 0 of 3 sources"
+
+
+@pytest.mark.asyncio
+async def test_pack_sources(embedded_queries):
+    chat_approach = create_chat_approach(pack_sources=True)
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {}, {})
+    chat_coroutine.close()
+    assert extra_info["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+    assert "Packed sources:<br>Benefit_Options-2.pdf: kept" in extra_info["thoughts"]
+
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, {"pack_sources": False}, {})
+    chat_coroutine.close()
+    assert "Packed sources" not in extra_info["thoughts"]
+
+
+@pytest.mark.asyncio
+async def test_pack_sources_long_prompt(embedded_queries):
+    # A prompt longer than the token limit leaves no room for sources, which are dropped instead of truncated
+    chat_approach = create_chat_approach(pack_sources=True)
+    history = [{"role": "user", "content": "What is the capital of France?"}]
+    overrides = {"prompt_template": "You are a bot. " * 2000}
+    extra_info, chat_coroutine = await chat_approach.run_until_final_call(history, overrides, {})
+    chat_coroutine.close()
+    assert extra_info["data_points"] == []
+    assert "no tokens left for sources" in extra_info["thoughts"]
+    assert "0 of 0 tokens used by 0 of 1 sources" in extra_info["thoughts"]
+    assert "truncated to -" not in extra_info["thoughts"]
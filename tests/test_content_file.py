@@ -1,5 +1,6 @@
 import os
 from collections import namedtuple
+from typing import Callable, Optional
 
 import aiohttp
 import pytest
@@ -12,6 +13,7 @@ from azure.core.pipeline.transport import (
 from azure.storage.blob.aio import BlobServiceClient
 
 import app
+from core.contentcache import ContentCache, ContentCacheFileBody
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
 
@@ -97,3 +99,188 @@ async def test_content_file(monkeypatch, mock_env):
         assert response.status_code == 200
         assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
+
+
+class MockBlobResponse(aiohttp.ClientResponse):
+    def __init__(self, url, status, body_bytes, headers):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = "OK"
+        self._url = url
+
+
+class MockRangeTransport(AsyncHttpTransport):
+    """Serves one blob, honoring ranges and ETag conditions like Blob Storage does"""
+
+    def __init__(self, content: bytes, etag: str = '"0x8DB00000000000A"'):
+        self.content = content
+        self.etag = etag
+        self.requests: list[HttpRequest] = []
+        self.on_send: Optional[Callable[[HttpRequest], None]] = None
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        self.requests.append(request)
+        if self.on_send:
+            self.on_send(request)
+        if request.headers.get("If-None-Match") == self.etag:
+            return AioHttpTransportResponse(request, MockBlobResponse(request.url, 304, b"", {"ETag": self.etag}))
+        start, end = 0, len(self.content) - 1
+        if blob_range := request.headers.get("x-ms-range"):
+            start_text, end_text = blob_range.removeprefix("bytes=").split("-")
+            start, end = int(start_text), min(int(end_text), end) if end_text else end
+        body = self.content[start : end + 1]
+        headers = {
+            "Content-Type": "text/html",
+            "Content-Range": f"bytes {start}-{end}/{len(self.content)}",
+            "Content-Length": str(len(body)),
+            "ETag": self.etag,
+        }
+        return AioHttpTransportResponse(request, MockBlobResponse(request.url, 206, body, headers))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+def create_blob_container_client(transport: AsyncHttpTransport):
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=transport,
+        retry_total=0,
+        max_single_get_size=8,
+        max_chunk_get_size=8,
+    )
+    return blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+
+@pytest.mark.asyncio
+async def test_content_file_streams_ranges(monkeypatch, mock_env):
+    content = b"<html><body>The manual</body></html>"
+    transport = MockRangeTransport(content)
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": create_blob_container_client(transport)})
+        client = test_app.test_client()
+
+        # Downloaded in chunks of 8 bytes
+        response = await client.get("/content/manual.html")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "text/html; charset=utf-8"
+        assert response.headers["ETag"] == transport.etag
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert await response.get_data() == content
+        assert len(transport.requests) == 5
+
+        response = await client.get("/content/manual.html", headers={"Range": "bytes=6-11"})
+        assert response.status_code == 206
+        assert response.headers["Content-Range"] == f"bytes 6-11/{len(content)}"
+        assert await response.get_data() == b"<body>"
+
+        response = await client.get("/content/manual.html", headers={"If-None-Match": transport.etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == transport.etag
+
+
+@pytest.mark.asyncio
+async def test_content_file_disk_cache(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setenv("CONTENT_CACHE_DIR", str(tmp_path))
+    content = b"<html><body>The manual</body></html>"
+    transport = MockRangeTransport(content)
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": create_blob_container_client(transport)})
+        client = test_app.test_client()
+
+        response = await client.get("/content/manual.html")
+        assert response.status_code == 200
+        assert await response.get_data() == content
+        requests_count = len(transport.requests)
+
+        # Fresh entries are served from disk without asking Blob Storage
+        response = await client.get("/content/manual.html", headers={"Range": "bytes=6-11"})
+        assert response.status_code == 206
+        assert await response.get_data() == b"<body>"
+        response = await client.get("/content/manual.html", headers={"If-None-Match": transport.etag})
+        assert response.status_code == 304
+        assert len(transport.requests) == requests_count
+
+        # Stale entries are revalidated with the blob's ETag
+        content_cache = quart_app.config[app.CONFIG_CONTENT_CACHE]
+        content_cache.ttl = 0
+        response = await client.get("/content/manual.html")
+        assert response.status_code == 200
+        assert await response.get_data() == content
+        assert len(transport.requests) == requests_count + 1
+        assert transport.requests[-1].headers["If-None-Match"] == transport.etag
+
+
+@pytest.mark.asyncio
+async def test_content_file_disk_cache_evicted_while_revalidated(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setenv("CONTENT_CACHE_DIR", str(tmp_path))
+    content = b"<html><body>The manual</body></html>"
+    transport = MockRangeTransport(content)
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        quart_app.config.update({"blob_container_client": create_blob_container_client(transport)})
+        client = test_app.test_client()
+        response = await client.get("/content/manual.html")
+        assert response.status_code == 200
+        assert await response.get_data() == content
+
+        # Another request evicts the entry while its conditional GET is in flight
+        content_cache = quart_app.config[app.CONFIG_CONTENT_CACHE]
+        content_cache.ttl = 0
+
+        def evict(request):
+            if request.headers.get("If-None-Match"):
+                content_cache.remove("manual.html")
+
+        transport.on_send = evict
+        response = await client.get("/content/manual.html")
+        assert response.status_code == 200
+        assert await response.get_data() == content
+        assert "If-None-Match" not in transport.requests[-1].headers
+        entry = content_cache.get("manual.html")
+        assert entry is not None
+        assert os.listdir(tmp_path) == [os.path.basename(entry.file_path)]
+
+
+async def iter_chunks(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_content_cache_keeps_served_files(tmp_path):
+    content_cache = ContentCache(str(tmp_path), max_bytes=10)
+    entry = await content_cache.store("manual.html", '"1"', "text/html", iter_chunks(b"first"))
+    content_cache.acquire(entry)
+    body = ContentCacheFileBody(content_cache, entry)
+
+    # Replacing the entry writes a new file, the one being served stays until the response is sent
+    replaced = await content_cache.store("manual.html", '"2"', "text/html", iter_chunks(b"second"))
+    assert replaced.file_path != entry.file_path
+    assert os.path.exists(entry.file_path)
+    async with body:
+        assert b"".join([chunk async for chunk in body]) == b"first"
+    assert not os.path.exists(entry.file_path)
+
+    # Evicted entries are deleted when their last response is done, even if it is never sent
+    content_cache.acquire(replaced)
+    body = ContentCacheFileBody(content_cache, replaced)
+    await content_cache.store("other.html", '"3"', "text/html", iter_chunks(b"0123456789"))
+    assert content_cache.get("manual.html") is None
+    assert os.path.exists(replaced.file_path)
+    del body
+    assert not os.path.exists(replaced.file_path)
@@ -0,0 +1,593 @@
+import asyncio
+import html
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import pytest
+from azure.ai.formrecognizer import AnalyzeResult, DocumentPage, DocumentTable
+from azure.core.credentials import AzureKeyCredential
+
+import scripts.prepdocslib.contentparsers
+from scripts.prepdocslib.analysiscache import AnalysisCache
+from scripts.prepdocslib.contentparsers import (
+    DocumentAnalysisPdfParser,
+    LocalPdfParser,
+    TableFormat,
+    extract_page_texts,
+)
+from scripts.prepdocslib.tokenizer import count_tokens
+
+
+def reference_page_to_text(content: str, page: DocumentPage, tables_on_page: list[DocumentTable]) -> str:
+    # The previous implementation, which marks every character of the page and appends them one at a time
+    page_offset = page.spans[0].offset
+    page_length = page.spans[0].length
+    table_chars = [-1] * page_length
+    for table_id, table in enumerate(tables_on_page):
+        for span in table.spans:
+            for i in range(span.length):
+                idx = span.offset - page_offset + i
+                if idx >= 0 and idx < page_length:
+                    table_chars[idx] = table_id
+
+    page_text = ""
+    added_tables = set()
+    for idx, table_id in enumerate(table_chars):
+        if table_id == -1:
+            page_text += content[page_offset + idx]
+        elif table_id not in added_tables:
+            page_text += DocumentAnalysisPdfParser.table_to_html(tables_on_page[table_id])
+            added_tables.add(table_id)
+    return page_text
+
+
+def reference_table_to_html(table: DocumentTable) -> str:
+    # The previous implementation, which scans every cell of the table for each row
+    table_html = "<table>"
+    rows = [
+        sorted([cell for cell in table.cells if cell.row_index == i], key=lambda cell: cell.column_index)
+        for i in range(table.row_count)
+    ]
+    for row_cells in rows:
+        table_html += "<tr>"
+        for cell in row_cells:
+            tag = "th" if (cell.kind == "columnHeader" or cell.kind == "rowHeader") else "td"
+            cell_spans = ""
+            if cell.column_span is not None and cell.column_span > 1:
+                cell_spans += f" colSpan={cell.column_span}"
+            if cell.row_span is not None and cell.row_span > 1:
+                cell_spans += f" rowSpan={cell.row_span}"
+            table_html += f"<{tag}{cell_spans}>{html.escape(cell.content)}</{tag}>"
+        table_html += "</tr>"
+    table_html += "</table>"
+    return table_html
+
+
+def create_analyze_result(
+    rng: random.Random, num_pages: int, page_length: int, tables_per_page: int, overlapping: bool = False
+) -> AnalyzeResult:
+    # Analysis results shaped like the ones of the prebuilt-layout model, with tables spread over the pages
+    words = ["Pressure", "valve", "torque", "Nm", "replace", "the", "seal", "&", "<bolt>", "12.5", "\n"]
+    content = ""
+    pages = []
+    tables = []
+    for page_number in range(1, num_pages + 1):
+        page_offset = len(content)
+        page_content = ""
+        while len(page_content) < page_length:
+            page_content += rng.choice(words) + " "
+        content += page_content[:page_length]
+        pages.append({"page_number": page_number, "spans": [{"offset": page_offset, "length": page_length}]})
+        for _ in range(tables_per_page):
+            table_offset = page_offset + rng.randrange(-20 if overlapping else 0, page_length)
+            table_length = rng.randint(1, page_length // (2 if overlapping else 4 * tables_per_page))
+            spans = [{"offset": table_offset, "length": table_length}]
+            if overlapping and rng.random() < 0.5:
+                spans.append({"offset": table_offset + table_length + 5, "length": rng.randint(1, 50)})
+            rows, columns = rng.randint(1, 5), rng.randint(1, 4)
+            cells = [
+                {
+                    "kind": rng.choice(["content", "columnHeader", "rowHeader"]),
+                    "row_index": row,
+                    "column_index": column,
+                    "row_span": rng.choice([None, 1, 2]),
+                    "column_span": rng.choice([None, 1, 2]),
+                    "content": f"{rng.choice(words)} {row}-{column}",
+                }
+                for row in range(rows)
+                for column in range(columns)
+            ]
+            tables.append(
+                {
+                    "row_count": rows,
+                    "column_count": columns,
+                    "cells": cells,
+                    "bounding_regions": [{"page_number": page_number, "polygon": []}],
+                    "spans": spans,
+                }
+            )
+        if not overlapping:
+            # Tables that are recognized on a page don't overlap
+            page_tables = sorted(tables[-tables_per_page:], key=lambda table: table["spans"][0]["offset"])
+            end = page_offset
+            for table in page_tables:
+                span = table["spans"][0]
+                span["offset"] = max(span["offset"], end)
+                span["length"] = max(0, min(span["length"], page_offset + page_length - span["offset"]))
+                end = span["offset"] + span["length"]
+    return AnalyzeResult.from_dict({"content": content, "pages": pages, "tables": tables})
+
+
+def tables_on_page(result: AnalyzeResult, page_num: int) -> list[DocumentTable]:
+    return [
+        table
+        for table in (result.tables or [])
+        if table.bounding_regions and table.bounding_regions[0].page_number == page_num + 1
+    ]
+
+
+def test_page_to_text_matches_reference():
+    rng = random.Random(1)
+    for overlapping in [False, True]:
+        result = create_analyze_result(rng, num_pages=30, page_length=400, tables_per_page=3, overlapping=overlapping)
+        for page_num, page in enumerate(result.pages):
+            tables = tables_on_page(result, page_num)
+            assert DocumentAnalysisPdfParser.page_to_text(result.content, page, tables) == reference_page_to_text(
+                result.content, page, tables
+            )
+
+
+def mock_document_analysis_client(monkeypatch, result: AnalyzeResult) -> list:
+    # Records the documents sent for analysis, and returns the same result for each of them
+    documents = []
+
+    class MockPoller:
+        async def result(self):
+            return result
+
+    class MockDocumentAnalysisClient:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc_val, exc_tb):
+            pass
+
+        async def begin_analyze_document(self, model_id, document):
+            documents.append(document)
+            return MockPoller()
+
+    monkeypatch.setattr(scripts.prepdocslib.contentparsers, "DocumentAnalysisClient", MockDocumentAnalysisClient)
+    return documents
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse(monkeypatch):
+    result = create_analyze_result(random.Random(2), num_pages=5, page_length=300, tables_per_page=2)
+    mock_document_analysis_client(monkeypatch, result)
+    parser = DocumentAnalysisPdfParser(
+        endpoint="https://test.cognitiveservices.azure.com/", credential=AzureKeyCredential("x")
+    )
+    content = io.BytesIO(b"pdf")
+    content.name = "test.pdf"
+    pages = [page async for page in parser.parse(content)]
+
+    assert [page.page_num for page in pages] == [0, 1, 2, 3, 4]
+    assert [page.text for page in pages] == [
+        reference_page_to_text(result.content, page, tables_on_page(result, page_num))
+        for page_num, page in enumerate(result.pages)
+    ]
+    assert [page.offset for page in pages] == [sum(len(page.text) for page in pages[:i]) for i in range(5)]
+    assert "<table>" in pages[0].text
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse_cache(monkeypatch, tmp_path, capsys):
+    result = create_analyze_result(random.Random(3), num_pages=4, page_length=300, tables_per_page=2)
+    documents = mock_document_analysis_client(monkeypatch, result)
+
+    async def parse(document: bytes, model_id: str = "prebuilt-layout") -> list[str]:
+        analysis_cache = AnalysisCache(str(tmp_path / "analyses.db"))
+        parser = DocumentAnalysisPdfParser(
+            endpoint="https://test.cognitiveservices.azure.com/",
+            credential=AzureKeyCredential("x"),
+            model_id=model_id,
+            verbose=True,
+            analysis_cache=analysis_cache,
+        )
+        content = io.BytesIO(document)
+        content.name = "test.pdf"
+        pages = [page.text async for page in parser.parse(content)]
+        # Closing the parser reports the cache statistics and closes the cache
+        parser.close()
+        with pytest.raises(sqlite3.ProgrammingError):
+            analysis_cache.connection.execute("SELECT 1")
+        return pages
+
+    pages = await parse(b"pdf")
+    assert documents == [b"pdf"]
+    assert "Analysis cache: 0 hits, 1 misses (0% hit ratio)" in capsys.readouterr().out
+    # Documents that were analyzed before, by the same model, are parsed from the cache
+    assert await parse(b"pdf") == pages
+    assert documents == [b"pdf"]
+    assert "Analysis cache: 1 hits, 0 misses (100% hit ratio)" in capsys.readouterr().out
+    await parse(b"pdf v2")
+    await parse(b"pdf", model_id="prebuilt-read")
+    assert documents == [b"pdf", b"pdf v2", b"pdf"]
+
+
+def test_analysis_cache(tmp_path):
+    result = create_analyze_result(random.Random(4), num_pages=3, page_length=200, tables_per_page=1)
+    analysis_cache = AnalysisCache(str(tmp_path / "analyses.db"))
+    assert analysis_cache.get("prebuilt-layout", b"pdf") is None
+    analysis_cache.set("prebuilt-layout", b"pdf", result)
+    cached_result = analysis_cache.get("prebuilt-layout", b"pdf")
+    assert cached_result is not None
+    assert cached_result.to_dict() == result.to_dict()
+    assert analysis_cache.get("prebuilt-read", b"pdf") is None
+    assert analysis_cache.stats() == "1 hits, 2 misses (33% hit ratio)"
+    analysis_cache.close()
+
+
+def create_dense_analyze_result() -> AnalyzeResult:
+    # Synthetic result with dense pages, sized like a long manual with several tables per page
+    return create_analyze_result(random.Random(0), num_pages=20, page_length=20000, tables_per_page=5)
+
+
+def test_page_to_text_matches_reference_dense_pages():
+    result = create_dense_analyze_result()
+    for page_num, page in enumerate(result.pages):
+        tables = tables_on_page(result, page_num)
+        assert DocumentAnalysisPdfParser.page_to_text(result.content, page, tables) == reference_page_to_text(
+            result.content, page, tables
+        )
+
+
+@pytest.mark.benchmark
+def test_page_to_text_benchmark():
+    # Micro-benchmark: assembling dense pages from intervals is much faster than character by character
+    result = create_dense_analyze_result()
+    pages = [(page, tables_on_page(result, page_num)) for page_num, page in enumerate(result.pages)]
+
+    start = time.perf_counter()
+    texts = [DocumentAnalysisPdfParser.page_to_text(result.content, page, tables) for page, tables in pages]
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reference_texts = [reference_page_to_text(result.content, page, tables) for page, tables in pages]
+    reference_seconds = time.perf_counter() - start
+
+    assert texts == reference_texts
+    assert seconds * 10 < reference_seconds
+
+
+def create_table(rows: int, columns: int, cells: list[dict]) -> DocumentTable:
+    return DocumentTable.from_dict({"row_count": rows, "column_count": columns, "cells": cells, "spans": []})
+
+
+def test_table_to_html_matches_reference():
+    rng = random.Random(4)
+    result = create_analyze_result(rng, num_pages=20, page_length=300, tables_per_page=3)
+    tables = list(result.tables)
+    # Cells in any order, and cells outside of the row count, are rendered as before
+    shuffled_cells = [cell.to_dict() for cell in tables[0].cells]
+    rng.shuffle(shuffled_cells)
+    shuffled_cells.append({"kind": "content", "row_index": 99, "column_index": 0, "content": "outside"})
+    tables.append(create_table(tables[0].row_count, tables[0].column_count, shuffled_cells))
+    for table in tables:
+        assert DocumentAnalysisPdfParser.table_to_html(table) == reference_table_to_html(table)
+
+
+def test_table_to_markdown():
+    table = create_table(
+        3,
+        3,
+        [
+            {"kind": "columnHeader", "row_index": 0, "column_index": 0, "column_span": 2, "content": "Part"},
+            {"kind": "columnHeader", "row_index": 0, "column_index": 2, "content": "Torque"},
+            {"kind": "content", "row_index": 1, "column_index": 2, "content": "12 Nm"},
+            {"kind": "content", "row_index": 1, "column_index": 0, "row_span": 2, "content": "Valve\nseal"},
+            {"kind": "content", "row_index": 1, "column_index": 1, "content": "A|B"},
+            {"kind": "content", "row_index": 2, "column_index": 1, "content": "<bolt> & nut"},
+            {"kind": "content", "row_index": 2, "column_index": 2, "content": ""},
+        ],
+    )
+    assert DocumentAnalysisPdfParser.table_to_markdown(table) == (
+        "\n|Part||Torque|\n|-|-|-|\n|Valve seal|A\\|B|12 Nm|\n||<bolt> & nut||\n"
+    )
+    assert DocumentAnalysisPdfParser.table_to_text(table, TableFormat.MARKDOWN).startswith("\n|Part|")
+    assert DocumentAnalysisPdfParser.table_to_text(table) == DocumentAnalysisPdfParser.table_to_html(table)
+
+
+def test_page_to_text_markdown():
+    result = create_analyze_result(random.Random(6), num_pages=3, page_length=500, tables_per_page=2)
+    for page_num, page in enumerate(result.pages):
+        tables = tables_on_page(result, page_num)
+        page_text = DocumentAnalysisPdfParser.page_to_text(result.content, page, tables, TableFormat.MARKDOWN)
+        assert "<table>" not in page_text
+        for table in tables:
+            assert DocumentAnalysisPdfParser.table_to_markdown(table) in page_text
+
+
+def create_parts_list(rows: int, columns: int) -> DocumentTable:
+    return create_table(
+        rows,
+        columns,
+        [
+            {"kind": "content", "row_index": row, "column_index": column, "content": f"Part {row}-{column}"}
+            for row in range(rows)
+            for column in range(columns)
+        ],
+    )
+
+
+def test_table_to_html_parts_list():
+    table = create_parts_list(1000, 4)
+    table_html = DocumentAnalysisPdfParser.table_to_html(table)
+    assert table_html == reference_table_to_html(table)
+    # The Markdown table takes fewer tokens
+    table_markdown = DocumentAnalysisPdfParser.table_to_markdown(table)
+    assert count_tokens(table_markdown, "text-embedding-ada-002") < count_tokens(table_html, "text-embedding-ada-002")
+
+
+@pytest.mark.benchmark
+def test_table_to_html_benchmark():
+    # Micro-benchmark: rendering a parts list with thousands of cells is much faster in a single pass
+    table = create_parts_list(1000, 4)
+
+    start = time.perf_counter()
+    table_html = DocumentAnalysisPdfParser.table_to_html(table)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reference_table_html = reference_table_to_html(table)
+    reference_seconds = time.perf_counter() - start
+
+    assert table_html == reference_table_html
+    assert seconds * 10 < reference_seconds
+
+
+def create_pdf(num_pages: int) -> bytes:
+    # A minimal PDF with a line of text on each page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids ["
+        + b" ".join(f"{4 + 2 * i} 0 R".encode() for i in range(num_pages))
+        + b"] "
+        + f"/Count {num_pages} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i in range(num_pages):
+        stream = f"BT /F1 12 Tf 72 720 Td (Page {i} of the manual: check valve {i}.) Tj ET".encode()
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {5 + 2 * i} 0 R "
+            "/Resources << /Font << /F1 3 0 R >> >> >>".encode()
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream")
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += f"{i + 1} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += b"".join(f"{offset:010} 00000 n \n".encode() for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return pdf
+
+
+@pytest.mark.asyncio
+async def test_local_pdf_parser_processes():
+    pdf = create_pdf(num_pages=23)
+    pages = [page async for page in LocalPdfParser().parse(io.BytesIO(pdf))]
+    assert [page.text for page in pages] == [f"Page {i} of the manual: check valve {i}." for i in range(23)]
+
+    parser = LocalPdfParser(processes=2)
+    try:
+        # Pages are extracted in ranges by the worker processes, and yielded in order
+        for _ in range(2):
+            process_pages = [page async for page in parser.parse(io.BytesIO(pdf))]
+            assert [(page.page_num, page.offset, page.text) for page in process_pages] == [
+                (page.page_num, page.offset, page.text) for page in pages
+            ]
+    finally:
+        parser.close()
+
+
+@pytest.mark.asyncio
+async def test_local_pdf_parser_processes_files(monkeypatch, tmp_path):
+    path = tmp_path / "manual.pdf"
+    path.write_bytes(create_pdf(num_pages=9))
+    temp_dir = tmp_path / "temp"
+    temp_dir.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(temp_dir))
+    parser = LocalPdfParser(processes=2)
+    try:
+        # Local files are read by the worker processes in place, other content goes through a temporary file
+        with open(path, "rb") as content:
+            assert LocalPdfParser.get_file_path(content) == str(path)
+            file_pages = [page.text async for page in parser.parse(content)]
+        memory_pages = [page.text async for page in parser.parse(io.BytesIO(path.read_bytes()))]
+        assert file_pages == memory_pages == [f"Page {i} of the manual: check valve {i}." for i in range(9)]
+        assert os.listdir(temp_dir) == []
+    finally:
+        parser.close()
+    assert parser.executor is None
+
+
+def test_extract_page_texts_reuses_reader(tmp_path):
+    # Worker processes read each PDF once, and extract all the ranges they get from it
+    path = tmp_path / "manual.pdf"
+    path.write_bytes(create_pdf(num_pages=6))
+    assert extract_page_texts(str(path), 0, 2) == [f"Page {i} of the manual: check valve {i}." for i in range(2)]
+    reader = scripts.prepdocslib.contentparsers.worker_reader
+    assert extract_page_texts(str(path), 2, 6) == [f"Page {i} of the manual: check valve {i}." for i in range(2, 6)]
+    assert scripts.prepdocslib.contentparsers.worker_reader is reader
+
+    # A file that changed is read again
+    path.write_bytes(create_pdf(num_pages=12))
+    assert extract_page_texts(str(path), 10, 12) == [f"Page {i} of the manual: check valve {i}." for i in (10, 11)]
+    assert scripts.prepdocslib.contentparsers.worker_reader is not reader
+
+
+@pytest.mark.asyncio
+async def test_local_pdf_parser_processes_keep_event_loop_free():
+    pdf = create_pdf(num_pages=400)
+    ticks = 0
+    parsed = asyncio.Event()
+
+    async def tick():
+        nonlocal ticks
+        while not parsed.is_set():
+            ticks += 1
+            await asyncio.sleep(0.001)
+
+    parser = LocalPdfParser(processes=1)
+    try:
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0)
+        ticks = 0
+        pages = [page async for page in parser.parse(io.BytesIO(pdf))]
+        parsed.set()
+        await ticker
+    finally:
+        parser.close()
+
+    # Other tasks keep running while the pages are extracted
+    assert len(pages) == 400
+    assert ticks > 10
+
+
+def shard_analyze_result(result: AnalyzeResult, first_page: int, last_page: int) -> AnalyzeResult:
+    # The result of analyzing only a range of pages: its content starts with the first page, and its pages and tables
+    # keep their page numbers
+    result_dict = result.to_dict()
+    pages = [page for page in result_dict["pages"] if first_page <= page["page_number"] <= last_page]
+    start = pages[0]["spans"][0]["offset"]
+    end = pages[-1]["spans"][0]["offset"] + pages[-1]["spans"][0]["length"]
+    tables = [
+        table
+        for table in result_dict["tables"]
+        if first_page <= table["bounding_regions"][0]["page_number"] <= last_page
+    ]
+    for item in pages + tables:
+        for span in item["spans"]:
+            span["offset"] -= start
+    return AnalyzeResult.from_dict({"content": result_dict["content"][start:end], "pages": pages, "tables": tables})
+
+
+def mock_begin_analyze_document(monkeypatch, parser: DocumentAnalysisPdfParser, result: AnalyzeResult) -> dict:
+    # Records the page ranges analyzed, and how many analyses ran at the same time
+    calls: dict = {"pages": [], "active": 0, "max_active": 0}
+
+    async def begin_analyze_document(description, document, pages=None):
+        calls["pages"].append(pages)
+        calls["active"] += 1
+        calls["max_active"] = max(calls["max_active"], calls["active"])
+        await asyncio.sleep(0.01)
+        calls["active"] -= 1
+        if pages is None:
+            return result
+        first_page, last_page = pages.split("-")
+        return shard_analyze_result(result, int(first_page), int(last_page))
+
+    monkeypatch.setattr(parser, "begin_analyze_document", begin_analyze_document)
+    return calls
+
+
+def create_parser(**kwargs) -> DocumentAnalysisPdfParser:
+    return DocumentAnalysisPdfParser(
+        endpoint="https://test.cognitiveservices.azure.com/", credential=AzureKeyCredential("x"), **kwargs
+    )
+
+
+async def parse_pages(parser: DocumentAnalysisPdfParser, document: bytes) -> list[tuple[int, int, str]]:
+    content = io.BytesIO(document)
+    content.name = "manual.pdf"
+    return [(page.page_num, page.offset, page.text) async for page in parser.parse(content)]
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse_page_ranges(monkeypatch):
+    result = create_analyze_result(random.Random(5), num_pages=10, page_length=300, tables_per_page=2)
+    pdf = create_pdf(num_pages=10)
+    parser = create_parser()
+    calls = mock_begin_analyze_document(monkeypatch, parser, result)
+    pages = await parse_pages(parser, pdf)
+    assert calls["pages"] == [None]
+
+    # Large PDFs are analyzed in page ranges at the same time, and the pages are stitched back together in order
+    sharded_parser = create_parser(max_concurrency=2, pages_per_shard=4)
+    sharded_calls = mock_begin_analyze_document(monkeypatch, sharded_parser, result)
+    assert await parse_pages(sharded_parser, pdf) == pages
+    assert sorted(sharded_calls["pages"]) == ["1-4", "5-8", "9-10"]
+    assert sharded_calls["max_active"] == 2
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse_page_ranges_default_concurrency(monkeypatch):
+    result = create_analyze_result(random.Random(8), num_pages=12, page_length=300, tables_per_page=1)
+    parser = create_parser(pages_per_shard=1)
+    calls = mock_begin_analyze_document(monkeypatch, parser, result)
+    await parse_pages(parser, create_pdf(num_pages=12))
+    assert len(calls["pages"]) == 12
+    assert calls["max_active"] == DocumentAnalysisPdfParser.DEFAULT_SHARD_CONCURRENCY
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse_page_ranges_failure(monkeypatch):
+    parser = create_parser(max_concurrency=5, pages_per_shard=2)
+    cancelled = []
+
+    async def begin_analyze_document(description, document, pages=None):
+        if pages == "3-4":
+            raise Exception("Analysis failed")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(pages)
+            raise
+
+    monkeypatch.setattr(parser, "begin_analyze_document", begin_analyze_document)
+    with pytest.raises(Exception, match="Analysis failed"):
+        await parse_pages(parser, create_pdf(num_pages=10))
+    # The analyses of the other ranges don't keep running
+    assert sorted(cancelled) == ["1-2", "5-6", "7-8", "9-10"]
+
+
+def test_document_analysis_page_ranges():
+    assert create_parser().page_ranges(create_pdf(num_pages=10)) == [None]
+    assert create_parser(pages_per_shard=5).page_ranges(create_pdf(num_pages=10)) == ["1-5", "6-10"]
+    assert create_parser(pages_per_shard=5).page_ranges(create_pdf(num_pages=11)) == ["1-5", "6-10", "11-11"]
+    assert create_parser(pages_per_shard=20).page_ranges(create_pdf(num_pages=10)) == [None]
+    # Documents that aren't PDFs, such as images, are analyzed whole
+    assert create_parser(pages_per_shard=5).page_ranges(b"not a pdf") == [None]
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse_max_concurrency(monkeypatch):
+    result = create_analyze_result(random.Random(6), num_pages=2, page_length=300, tables_per_page=1)
+    for max_concurrency, expected_max_active in [(None, 5), (3, 3), (1, 1)]:
+        parser = create_parser(max_concurrency=max_concurrency)
+        calls = mock_begin_analyze_document(monkeypatch, parser, result)
+        await asyncio.gather(*(parse_pages(parser, b"pdf") for _ in range(5)))
+        assert calls["max_active"] == expected_max_active
+
+
+@pytest.mark.asyncio
+async def test_document_analysis_parse_page_ranges_cache(monkeypatch, tmp_path):
+    result = create_analyze_result(random.Random(7), num_pages=6, page_length=300, tables_per_page=1)
+    pdf = create_pdf(num_pages=6)
+    analysis_cache = AnalysisCache(str(tmp_path / "analyses.db"))
+    parser = create_parser(pages_per_shard=3, analysis_cache=analysis_cache)
+    calls = mock_begin_analyze_document(monkeypatch, parser, result)
+    pages = await parse_pages(parser, pdf)
+    # Page ranges are cached separately
+    assert await parse_pages(parser, pdf) == pages
+    assert sorted(calls["pages"]) == ["1-3", "4-6"]
+    assert analysis_cache.get("prebuilt-layout", pdf) is None
+    analysis_cache.close()
@@ -0,0 +1,177 @@
+import json
+import os
+import tempfile
+
+import aiohttp
+import pytest
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+import app
+from core.feedback import FeedbackSink
+
+
+class MockPostResponse:
+    def __init__(self, url, status):
+        self.url = URL(url)
+        self.status = status
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            request_info = aiohttp.RequestInfo(self.url, "POST", CIMultiDictProxy(CIMultiDict()), self.url)
+            raise aiohttp.ClientResponseError(request_info, (), status=self.status)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+@pytest.fixture
+def posted_batches(monkeypatch):
+    batches = []
+    statuses = []
+
+    def mock_post(self, url, headers, json):
+        batches.append(json)
+        return MockPostResponse(url, statuses.pop(0) if statuses else 201)
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    return batches, statuses
+
+
+@pytest.mark.asyncio
+async def test_feedbacksink_batches_rows(posted_batches):
+    batches, _ = posted_batches
+    sink = FeedbackSink("https://test.supabase.co/rest/v1/feedback", "key", flush_interval=0.05)
+    await sink.start()
+    for rating in range(3):
+        sink.add({"rating": rating})
+    await sink.close()
+    assert batches == [[{"rating": 0}, {"rating": 1}, {"rating": 2}]]
+
+
+@pytest.mark.asyncio
+async def test_feedbacksink_retries(posted_batches):
+    batches, statuses = posted_batches
+    statuses.extend([503, 503])
+    sink = FeedbackSink("https://test.supabase.co/rest/v1/feedback", "key", flush_interval=0, retry_delay=0)
+    await sink.start()
+    sink.add({"rating": 1})
+    await sink.close()
+    assert batches == [[{"rating": 1}]] * 3
+
+
+@pytest.mark.asyncio
+async def test_feedbacksink_spills_and_resends(posted_batches):
+    batches, statuses = posted_batches
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        spill_path = os.path.join(tmpdirname, "feedback.jsonl")
+        statuses.extend([503, 503])
+        sink = FeedbackSink(
+            "https://test.supabase.co/rest/v1/feedback",
+            "key",
+            spill_path=spill_path,
+            flush_interval=0,
+            max_retries=1,
+            retry_delay=0,
+        )
+        await sink.start()
+        sink.add({"rating": 1, "feedback": "Très bien"})
+        await sink.close()
+        spill_files = os.listdir(tmpdirname)
+        assert len(spill_files) == 1
+        with open(os.path.join(tmpdirname, spill_files[0]), encoding="utf-8") as spill_file:
+            assert [json.loads(line) for line in spill_file] == [{"rating": 1, "feedback": "Très bien"}]
+
+        # The next sink sends the spilled rows and removes the spill file
+        batches.clear()
+        sink = FeedbackSink("https://test.supabase.co/rest/v1/feedback", "key", spill_path=spill_path)
+        await sink.start()
+        await sink.close()
+        assert batches == [[{"rating": 1, "feedback": "Très bien"}]]
+        assert os.listdir(tmpdirname) == []
+
+
+@pytest.mark.asyncio
+async def test_feedbacksink_drops_rejected_rows(posted_batches, caplog):
+    batches, statuses = posted_batches
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        spill_path = os.path.join(tmpdirname, "feedback.jsonl")
+        statuses.extend([400, 429, 201])
+        sink = FeedbackSink(
+            "https://test.supabase.co/rest/v1/feedback",
+            "key",
+            spill_path=spill_path,
+            flush_interval=0,
+            retry_delay=0,
+        )
+        await sink.start()
+        sink.add({"conversation_id": "c1", "rating": "invalid", "question": "Où est le manuel ?"})
+        await sink.queue.join()
+        sink.add({"rating": 1})
+        await sink.close()
+        # Rows rejected with a client error are dropped, logging only their ids, rate limited rows are retried
+        assert batches == [
+            [{"conversation_id": "c1", "rating": "invalid", "question": "Où est le manuel ?"}],
+            [{"rating": 1}],
+            [{"rating": 1}],
+        ]
+        assert "Dropping 1 feedback rows rejected with status 400, conversation ids: c1" in caplog.text
+        assert "manuel" not in caplog.text
+        assert os.listdir(tmpdirname) == []
+
+
+def test_feedbacksink_spill_files_shared_by_workers():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        spill_path = os.path.join(tmpdirname, "feedback.jsonl")
+        workers = [
+            FeedbackSink("https://test.supabase.co/rest/v1/feedback", "key", spill_path=spill_path) for _ in range(2)
+        ]
+        workers[0].spill([{"rating": 1}])
+        workers[1].spill([{"rating": 2}, {"rating": 3}])
+        workers[0].spill([{"rating": 4}])
+
+        # Each spilled row is read by exactly one worker
+        rows = workers[1].read_spilled_rows() + workers[0].read_spilled_rows()
+        assert sorted(row["rating"] for row in rows) == [1, 2, 3, 4]
+        assert os.listdir(tmpdirname) == []
+
+
+@pytest.mark.asyncio
+async def test_feedbacksink_full_queue_spills():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        spill_path = os.path.join(tmpdirname, "feedback.jsonl")
+        # Not started, so nothing takes rows off the queue
+        sink = FeedbackSink("https://test.supabase.co/rest/v1/feedback", "key", spill_path=spill_path, max_queue_size=1)
+        sink.add({"rating": 1})
+        sink.add({"rating": 2})
+        assert sink.read_spilled_rows() == [{"rating": 2}]
+
+
+@pytest.mark.asyncio
+async def test_save_conversation(client):
+    rows = []
+
+    class MockFeedbackSink:
+        def add(self, row):
+            rows.append(row)
+
+    client.app.config[app.CONFIG_FEEDBACK_SINK] = MockFeedbackSink()
+    response = await client.post(
+        "/save_conversation",
+        json={"conversationId": "1234", "rating": "up", "question": "What is the capital of France?"},
+    )
+    assert response.status_code == 202
+    assert rows[0]["conversation_id"] == "1234"
+    assert rows[0]["rating"] == "up"
+    # Avoid closing the mock sink when the app stops serving
+    client.app.config[app.CONFIG_FEEDBACK_SINK] = None
+
+
+@pytest.mark.asyncio
+async def test_save_conversation_not_configured(client):
+    response = await client.post("/save_conversation", json={"conversationId": "1234", "rating": "up"})
+    assert response.status_code == 500
+    assert (await response.get_json())["error"] == "feedback storage is not configured"
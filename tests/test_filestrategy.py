@@ -0,0 +1,373 @@
+import asyncio
+import io
+import os
+import re
+import tempfile
+from typing import Optional
+
+import openai
+import pytest
+from conftest import MockAzureCredential
+
+from scripts.prepdocslib.chunkmanifest import ChunkManifest
+from scripts.prepdocslib.contentparsers import Page
+from scripts.prepdocslib.embeddingcache import EmbeddingCache
+from scripts.prepdocslib.embeddings import AzureOpenAIEmbeddingService, OpenAIEmbeddings
+from scripts.prepdocslib.filestrategy import FileStrategy
+from scripts.prepdocslib.listfilestrategy import File, ListFileStrategy
+from scripts.prepdocslib.searchmanager import SearchManager
+from scripts.prepdocslib.strategy import SearchInfo
+from scripts.prepdocslib.textsplitter import HtmlTextSplitter, TextSplitter
+
+
+class MockListFileStrategy(ListFileStrategy):
+    def __init__(self, files: list[File]):
+        self.files = files
+        self.listed: list[File] = []
+
+    async def list(self):
+        for file in self.files:
+            self.listed.append(file)
+            yield file
+
+
+class MockContentParser:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.closed = False
+
+    async def parse(self, content):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        yield Page(0, 0, content.getvalue().decode("utf-8"))
+
+    def close(self):
+        self.closed = True
+
+
+class MockBlobManager:
+    def __init__(self):
+        self.uploaded = []
+
+    async def upload_blob(self, file: File):
+        await asyncio.sleep(0)
+        self.uploaded.append(file.filename())
+
+
+def create_file(name: str, text: str) -> File:
+    content = io.BytesIO(text.encode("utf-8"))
+    content.name = name
+    return File(content=content)
+
+
+class MockSearchClient:
+    def __init__(
+        self,
+        uploaded_batches: list,
+        fail: Optional[str],
+        deleted_ids: Optional[list] = None,
+        index: Optional[dict] = None,
+    ):
+        self.uploaded_batches = uploaded_batches
+        self.fail = fail
+        self.deleted_ids = deleted_ids
+        # The documents in the index by id
+        self.index = index if index is not None else {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def upload_documents(self, documents):
+        await asyncio.sleep(0)
+        if any(document["sourcefile"] == self.fail for document in documents):
+            raise Exception("Failed to index")
+        self.uploaded_batches.append(documents)
+        self.index.update((document["id"], document) for document in documents)
+
+    async def delete_documents(self, documents):
+        await asyncio.sleep(0)
+        self.deleted_ids.extend(document["id"] for document in documents)
+        for document in documents:
+            self.index.pop(document["id"], None)
+        return documents
+
+    async def search(self, search_text, filter, select):
+        sourcefile = re.fullmatch(r"sourcefile eq '(.*)'", filter).group(1).replace("''", "'")
+
+        async def results():
+            for document in list(self.index.values()):
+                if document["sourcefile"] == sourcefile:
+                    yield {field: document[field] for field in select}
+
+        return results()
+
+
+@pytest.fixture
+def ingested(monkeypatch):
+    ingested = {"batches": [], "embedding_batches": [], "deleted_ids": [], "fail": None, "index": {}}
+
+    def mock_create_search_client(self):
+        return MockSearchClient(ingested["batches"], ingested["fail"], ingested["deleted_ids"], ingested["index"])
+
+    async def mock_acreate(*args, **kwargs):
+        ingested["embedding_batches"].append(kwargs["input"])
+        return {"data": [{"embedding": [0.1, 0.2, 0.3]} for _ in kwargs["input"]]}
+
+    monkeypatch.setattr(SearchInfo, "create_search_client", mock_create_search_client)
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    return ingested
+
+
+def create_file_strategy(
+    files: list[File],
+    concurrency: int,
+    embeddings: Optional[OpenAIEmbeddings] = None,
+    chunk_manifest: Optional[ChunkManifest] = None,
+    text_splitter: Optional[TextSplitter] = None,
+):
+    return FileStrategy(
+        list_file_strategy=MockListFileStrategy(files),
+        blob_manager=MockBlobManager(),
+        content_parser=MockContentParser(),
+        text_splitter=text_splitter or TextSplitter(),
+        embeddings=embeddings,
+        concurrency=concurrency,
+        chunk_manifest=chunk_manifest,
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", [1, 3])
+async def test_filestrategy_add_files_concurrently(ingested, concurrency):
+    files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(7)]
+    file_strategy = create_file_strategy(files, concurrency)
+    await file_strategy.run(SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test"))
+
+    # Sections from all files are uploaded to the index in one batch
+    assert len(ingested["batches"]) == 1
+    assert sorted(document["content"] for document in ingested["batches"][0]) == sorted(
+        f"Content of file {i}. " * 8 for i in range(7)
+    )
+    assert sorted(file_strategy.blob_manager.uploaded) == sorted(file.filename() for file in files)
+    assert file_strategy.content_parser.max_active == concurrency
+    assert file_strategy.content_parser.closed
+    assert all(file.content.closed for file in files)
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_embedding_batches(monkeypatch, ingested):
+    monkeypatch.setattr(SearchManager, "MAX_BATCH_SIZE", 8)
+    files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(20)]
+    files.append(create_file("long.txt", "A long sentence for the index. " * 600))
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+    )
+    file_strategy = create_file_strategy(files, concurrency=4, embeddings=embeddings)
+    await file_strategy.run(SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test"))
+
+    # Embedding requests and index uploads are filled with sections from different files
+    documents = [document for batch in ingested["batches"] for document in batch]
+    assert len(documents) == len(set(document["id"] for document in documents)) > 30
+    assert [len(batch) for batch in ingested["batches"][:-1]] == [8] * (len(ingested["batches"]) - 1)
+    assert len(ingested["embedding_batches"][0]) == 16
+    assert all(document["embedding"] == [0.1, 0.2, 0.3] for document in documents)
+    # Without a chunk manifest, ids number the sections of each file in batches of MAX_BATCH_SIZE,
+    # so ingesting a file again overwrites its sections
+    long_ids = [document["id"] for document in documents if document["sourcefile"] == "long.txt"]
+    assert long_ids[0].endswith("-batch-0-page-0")
+    assert long_ids[9].endswith("-batch-1-page-1")
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_error(monkeypatch, ingested):
+    monkeypatch.setattr(SearchManager, "MAX_BATCH_SIZE", 2)
+    ingested["fail"] = "file1.txt"
+    list_file_strategy = MockListFileStrategy(
+        [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(100)]
+    )
+    file_strategy = FileStrategy(
+        list_file_strategy=list_file_strategy,
+        blob_manager=MockBlobManager(),
+        content_parser=MockContentParser(),
+        text_splitter=TextSplitter(),
+        concurrency=2,
+    )
+    with pytest.raises(Exception, match="Failed to index"):
+        await file_strategy.run(
+            SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test")
+        )
+    # The files that were listed but not ingested are closed too
+    assert 2 < len(list_file_strategy.listed) < 100
+    assert all(file.content.closed for file in list_file_strategy.listed)
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_embedding_cache(ingested):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        embeddings = AzureOpenAIEmbeddingService(
+            open_ai_service="x",
+            open_ai_deployment="x",
+            open_ai_model_name="text-embedding-ada-002",
+            credential=MockAzureCredential(),
+            embedding_cache=EmbeddingCache(os.path.join(tmpdirname, "embeddings.db")),
+        )
+        search_info = SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test")
+        files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(3)]
+        await create_file_strategy(files, concurrency=2, embeddings=embeddings).run(search_info)
+        assert len(ingested["embedding_batches"]) == 1
+
+        # Only the changed file is embedded again, all files are indexed
+        files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(2)]
+        files.append(create_file("file2.txt", "Changed content of file 2. " * 8))
+        await create_file_strategy(files, concurrency=2, embeddings=embeddings).run(search_info)
+        assert ingested["embedding_batches"][1] == ["Changed content of file 2. " * 8]
+        assert len([document for batch in ingested["batches"][1:] for document in batch]) == 3
+        assert embeddings.embedding_cache.hits == 2
+        embeddings.embedding_cache.close()
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_chunk_manifest(ingested):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        chunk_manifest = ChunkManifest(os.path.join(tmpdirname, "manifest.db"), "test")
+        search_info = SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test")
+        files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(2)]
+        files.append(create_file("long.txt", "".join(f"Sentence {i} for the index. " for i in range(600))))
+        await create_file_strategy(files, concurrency=2, chunk_manifest=chunk_manifest).run(search_info)
+        first_ids = [document["id"] for batch in ingested["batches"] for document in batch]
+        assert len(first_ids) > 10
+        assert ingested["deleted_ids"] == []
+
+        # Only the sections that changed are uploaded, the sections the shorter file no longer has are deleted
+        ingested["batches"].clear()
+        files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(2)]
+        files.append(create_file("long.txt", "".join(f"Sentence {i} for the index. " for i in range(300))))
+        await create_file_strategy(files, concurrency=2, chunk_manifest=chunk_manifest).run(search_info)
+        long_ids = set(chunk_manifest.get("long.txt"))
+        uploaded_ids = [document["id"] for batch in ingested["batches"] for document in batch]
+        assert 0 < len(uploaded_ids) < len(long_ids)
+        assert set(uploaded_ids) <= long_ids
+        assert sorted(ingested["deleted_ids"]) == sorted(
+            set(first_ids) - set(chunk_manifest.get("file0.txt")) - set(chunk_manifest.get("file1.txt")) - long_ids
+        )
+
+        # Nothing is uploaded when no file changed
+        ingested["batches"].clear()
+        files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(2)]
+        files.append(create_file("long.txt", "".join(f"Sentence {i} for the index. " for i in range(300))))
+        await create_file_strategy(files, concurrency=2, chunk_manifest=chunk_manifest).run(search_info)
+        assert ingested["batches"] == []
+        chunk_manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_chunk_manifest_existing_index(ingested):
+    search_info = SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test")
+    text = "".join(f"Sentence {i} for the index. " for i in range(300))
+    await create_file_strategy([create_file("long.txt", text)], concurrency=1).run(search_info)
+    positional_ids = set(ingested["index"])
+    assert len(positional_ids) > 3
+
+    # Ingesting an edited file again without a manifest overwrites its sections
+    edited_text = text.replace("Sentence 5 ", "Edited sentence 5 ")
+    await create_file_strategy([create_file("long.txt", edited_text)], concurrency=1).run(search_info)
+    assert set(ingested["index"]) == positional_ids
+
+    # The first run with a manifest replaces the sections that were indexed without it
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        chunk_manifest = ChunkManifest(os.path.join(tmpdirname, "manifest.db"), "test")
+        strategy = create_file_strategy(
+            [create_file("long.txt", edited_text)], concurrency=1, chunk_manifest=chunk_manifest
+        )
+        await strategy.run(search_info)
+        assert set(ingested["index"]) == set(chunk_manifest.get("long.txt"))
+        assert set(ingested["deleted_ids"]) == positional_ids
+        assert len(ingested["index"]) == len(positional_ids)
+        chunk_manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_chunk_manifest_insert(ingested):
+    def create_manual(sections: list[str]) -> File:
+        return create_file(
+            "manual.html", "".join(f"<section><h2>{title}</h2><p>{title} text.</p></section>" for title in sections)
+        )
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        chunk_manifest = ChunkManifest(os.path.join(tmpdirname, "manifest.db"), "test")
+        search_info = SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test")
+        titles = [f"Chapter {i}" for i in range(10)]
+        strategy = create_file_strategy(
+            [create_manual(titles)], concurrency=1, chunk_manifest=chunk_manifest, text_splitter=HtmlTextSplitter()
+        )
+        await strategy.run(search_info)
+        first_ids = set(chunk_manifest.get("manual.html"))
+        assert len(first_ids) == 10
+
+        # A section inserted in the middle doesn't change the ids of the sections after it
+        ingested["batches"].clear()
+        titles.insert(5, "Inserted chapter")
+        strategy = create_file_strategy(
+            [create_manual(titles)], concurrency=1, chunk_manifest=chunk_manifest, text_splitter=HtmlTextSplitter()
+        )
+        await strategy.run(search_info)
+        uploaded = [document for batch in ingested["batches"] for document in batch]
+        assert [document["content"] for document in uploaded] == [
+            "<section><h2>Inserted chapter</h2><p>Inserted chapter text.</p></section>"
+        ]
+        assert set(chunk_manifest.get("manual.html")) == first_ids | {uploaded[0]["id"]}
+        assert ingested["deleted_ids"] == []
+        chunk_manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_chunk_manifest_error(ingested):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        chunk_manifest = ChunkManifest(os.path.join(tmpdirname, "manifest.db"), "test")
+        search_info = SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test")
+        files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 8) for i in range(2)]
+        await create_file_strategy(files, concurrency=1, chunk_manifest=chunk_manifest).run(search_info)
+        indexed_hashes = chunk_manifest.get("file1.txt")
+
+        ingested["fail"] = "file1.txt"
+        files = [create_file(f"file{i}.txt", f"Changed content of file {i}. " * 8) for i in range(2)]
+        with pytest.raises(Exception, match="Failed to index"):
+            await create_file_strategy(files, concurrency=1, chunk_manifest=chunk_manifest).run(search_info)
+        # Files whose sections weren't indexed keep their previous sections and aren't recorded,
+        # so they are indexed again next time
+        assert chunk_manifest.get("file1.txt") == indexed_hashes
+        assert not any(id in indexed_hashes for id in ingested["deleted_ids"])
+        chunk_manifest.close()
+
+
+@pytest.mark.asyncio
+async def test_filestrategy_add_files_splitter_token_counts(monkeypatch, ingested):
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+    )
+
+    # The token counts of the text splitter are used to fill the embedding batches
+    def fail_calculate_token_length(text):
+        raise AssertionError("Text was tokenized again")
+
+    monkeypatch.setattr(embeddings, "calculate_token_length", fail_calculate_token_length)
+    files = [create_file(f"file{i}.txt", f"Content of file {i}. " * 80) for i in range(5)]
+    file_strategy = create_file_strategy(files, concurrency=2, embeddings=embeddings)
+    file_strategy.text_splitter = TextSplitter(max_tokens=500)
+    await file_strategy.run(SearchInfo(endpoint="https://test.search.windows.net", credential=None, index_name="test"))
+
+    documents = [document for batch in ingested["batches"] for document in batch]
+    assert len(documents) == sum(len(batch) for batch in ingested["embedding_batches"]) > 5
+    assert all(document["embedding"] == [0.1, 0.2, 0.3] for document in documents)
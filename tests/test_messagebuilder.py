@@ -1,4 +1,9 @@
-from core.messagebuilder import MessageBuilder
+import time
+from collections import deque
+
+import pytest
+
+from core.messagebuilder import MessageBuilder, normalize_nfc
 
 
 def test_messagebuilder():
@@ -47,3 +52,75 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_insert_positions():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.insert_message("user", "third")
+    builder.insert_message("assistant", "second")
+    builder.insert_message("user", "first")
+    builder.append_message("assistant", "fifth")
+    builder.insert_message("user", "fourth", index=4)
+    assert [message["content"] for message in builder.messages] == [
+        "You are a bot.",
+        "first",
+        "second",
+        "third",
+        "fourth",
+        "fifth",
+    ]
+
+
+def test_messagebuilder_normalized_content_cached():
+    normalize_nfc.cache_clear()
+    builder = MessageBuilder("á", "gpt-35-turbo")
+    builder.insert_message("user", "á")
+    assert builder.messages[1]["content"] == "á"
+    assert normalize_nfc.cache_info().hits == 1
+
+
+def build_history(num_turns: int) -> list[dict[str, str]]:
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    for turn in reversed(range(num_turns)):
+        builder.insert_message("assistant", f"Answer {turn}")
+        builder.insert_message("user", f"Question {turn}")
+    return builder.messages
+
+
+@pytest.mark.parametrize("num_turns", [100, 1000])
+def test_messagebuilder_long_history(num_turns):
+    messages = build_history(num_turns)
+    assert len(messages) == 2 * num_turns + 1
+    assert messages[1] == {"role": "user", "content": "Question 0"}
+    assert messages[-1] == {"role": "assistant", "content": f"Answer {num_turns - 1}"}
+
+
+def test_messagebuilder_materializes_messages_once():
+    # Inserting in front of the history goes into a deque, and the list of messages is only built when it is read,
+    # so building a long history doesn't copy the messages after each insertion
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    for turn in reversed(range(2000)):
+        builder.insert_message("assistant", f"Answer {turn}")
+        builder.insert_message("user", f"Question {turn}")
+    assert isinstance(builder.conversation, deque)
+    messages = builder.messages
+    assert builder.messages is messages
+    assert len(messages) == 4001
+    builder.append_message("user", "Last question")
+    assert builder.messages is not messages
+    assert len(messages) == 4001
+    assert builder.messages[-1] == {"role": "user", "content": "Last question"}
+
+
+@pytest.mark.benchmark
+def test_messagebuilder_benchmark():
+    # Micro-benchmark: building a history 20 times as long should take about 20 times as long, not 400 times
+    def seconds_per_turn(num_turns: int) -> float:
+        start = time.perf_counter()
+        for _ in range(5):
+            assert len(build_history(num_turns)) == 2 * num_turns + 1
+        return (time.perf_counter() - start) / num_turns
+
+    seconds_per_turn(100)  # warm up
+    short_history, long_history = seconds_per_turn(100), seconds_per_turn(2000)
+    assert long_history < short_history * 5
@@ -1,9 +1,15 @@
 import pytest
 
 from core.modelhelper import (
+    TOKEN_COUNTS,
+    TokenCounts,
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
+    num_tokens_from_texts,
+    truncate_to_tokens,
 )
 
 
@@ -59,3 +65,54 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_num_tokens_from_messages_batch():
+    messages = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "I am fine, thank you."},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    counts = num_tokens_from_messages_batch(messages, "gpt-35-turbo")
+    assert counts == [num_tokens_from_messages(message, "gpt-35-turbo") for message in messages]
+    assert counts[0] == 9
+
+
+def test_token_counts_cached(monkeypatch):
+    TOKEN_COUNTS.clear()
+    encoding = get_encoding("gpt-35-turbo")
+    assert get_encoding("gpt-35-turbo") is encoding
+    assert num_tokens_from_messages({"role": "user", "content": "Hello, how are you?"}, "gpt-35-turbo") == 9
+
+    def fail_encode(*args, **kwargs):
+        raise AssertionError("Counted tokens again")
+
+    monkeypatch.setattr(encoding, "encode", fail_encode)
+    monkeypatch.setattr(encoding, "encode_batch", fail_encode)
+    assert num_tokens_from_messages({"role": "user", "content": "Hello, how are you?"}, "gpt-35-turbo") == 9
+
+
+def test_token_counts_bounded():
+    token_counts = TokenCounts(max_size=2)
+    encoding = get_encoding("gpt-35-turbo")
+    counts = token_counts.lookup(encoding, ["one", "two", "three", "two"])
+    assert counts == {text: len(encoding.encode(text)) for text in ["one", "two", "three"]}
+    assert len(token_counts.counts) == 2
+
+
+def test_token_counts_without_thread_pool(monkeypatch):
+    encoding = get_encoding("gpt-35-turbo")
+
+    def fail_encode_batch(*args, **kwargs):
+        raise AssertionError("encode_batch starts a thread pool for every call")
+
+    monkeypatch.setattr(encoding, "encode_batch", fail_encode_batch)
+    counts = TokenCounts(max_size=10).lookup(encoding, ["one", "two", "three"])
+    assert counts == {text: len(encoding.encode(text)) for text in ["one", "two", "three"]}
+
+
+def test_truncate_to_tokens():
+    text = "Hello, how are you?"
+    assert truncate_to_tokens(text, 10, "gpt-35-turbo") == text
+    assert truncate_to_tokens(text, 2, "gpt-35-turbo") == "Hello,"
+    assert num_tokens_from_texts([text, "Hello,"], "gpt-35-turbo") == [6, 2]
@@ -1,12 +1,20 @@
+import asyncio
+import os
+import tempfile
+import time
+
 import openai
 import pytest
 import tenacity
 from conftest import MockAzureCredential
 
+from scripts.prepdocslib.embeddingcache import EmbeddingCache
 from scripts.prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     OpenAIEmbeddingService,
 )
+from scripts.prepdocslib.ratelimiter import RateLimiter, get_retry_after
+from scripts.prepdocslib.tokenizer import get_encoding
 
 
 @pytest.mark.asyncio
@@ -154,3 +162,173 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
             verbose=True,
         )
         await embeddings.create_embeddings(texts=["foo"])
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_concurrent_batches(monkeypatch, capsys):
+    active = {"now": 0, "max": 0}
+
+    async def mock_acreate(*args, **kwargs):
+        active["now"] += 1
+        active["max"] = max(active["max"], active["now"])
+        await asyncio.sleep(0.01)
+        active["now"] -= 1
+        return {
+            "data": [{"embedding": [float(text.split()[1])]} for text in kwargs["input"]],
+            "usage": {"prompt_tokens": 8, "total_tokens": 8},
+        }
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+        verbose=True,
+        max_concurrency=3,
+        tokens_per_minute=240000,
+        requests_per_minute=1200,
+    )
+    texts = [f"text {i}" for i in range(80)]
+    # Embeddings are returned in the order of the texts, even though 5 batches were sent 3 at a time
+    assert await embeddings.create_embeddings(texts=texts) == [[float(i)] for i in range(80)]
+    assert active["max"] == 3
+    assert embeddings.embedding_requests == 5
+    assert embeddings.embedded_tokens == 40
+    assert capsys.readouterr().out.count("requests/minute") == 5
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_retry_after(monkeypatch, capsys):
+    responses = [openai.error.RateLimitError(headers={"retry-after-ms": "50", "Retry-After": "1"})]
+
+    async def mock_acreate(*args, **kwargs):
+        if responses:
+            raise responses.pop()
+        return {"data": [{"embedding": [0.1]}]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+        verbose=True,
+        requests_per_minute=60000,
+    )
+    start = time.monotonic()
+    # Waits for the 50 milliseconds the service asked for, instead of backing off for 15 seconds or more
+    assert await embeddings.create_embeddings(texts=["foo"]) == [[0.1]]
+    assert 0.05 <= time.monotonic() - start < 1
+    assert embeddings.rate_limiter.paused_until > start
+    assert capsys.readouterr().out.count("Rate limited on the OpenAI embeddings API") == 1
+
+
+@pytest.mark.asyncio
+async def test_ratelimiter_tokens_per_minute():
+    # 60000 tokens per minute refill 1000 tokens per second, and the bucket holds 10 seconds worth
+    rate_limiter = RateLimiter(tokens_per_minute=60000)
+    start = time.monotonic()
+    await rate_limiter.acquire(10000)
+    assert time.monotonic() - start < 0.05
+    await rate_limiter.acquire(100)
+    assert 0.09 <= time.monotonic() - start < 0.5
+
+
+@pytest.mark.asyncio
+async def test_ratelimiter_requests_per_minute_and_pause():
+    rate_limiter = RateLimiter(requests_per_minute=600)
+    start = time.monotonic()
+    for _ in range(100):
+        await rate_limiter.acquire(1)
+    assert time.monotonic() - start < 0.05
+    rate_limiter.pause(0.05)
+    await rate_limiter.acquire(1)
+    # Both the pause and the exhausted bucket (10 requests per second) have to clear
+    assert 0.09 <= time.monotonic() - start < 0.5
+
+
+def test_get_retry_after():
+    assert get_retry_after(openai.error.RateLimitError(headers={"Retry-After": "2"})) == 2
+    assert get_retry_after(openai.error.RateLimitError(headers={"retry-after-ms": "1500", "retry-after": "2"})) == 1.5
+    assert (
+        get_retry_after(openai.error.RateLimitError(headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) is None
+    )
+    assert get_retry_after(openai.error.RateLimitError()) is None
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_cache(monkeypatch):
+    inputs = []
+
+    async def mock_acreate(*args, **kwargs):
+        inputs.append(kwargs["input"])
+        return {"data": [{"embedding": [len(text) / 3, 0.1]} for text in kwargs["input"]]}
+
+    monkeypatch.setattr(openai.Embedding, "acreate", mock_acreate)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_path = os.path.join(tmpdirname, "embeddings.db")
+        embeddings = AzureOpenAIEmbeddingService(
+            open_ai_service="x",
+            open_ai_deployment="x",
+            open_ai_model_name="text-embedding-ada-002",
+            credential=MockAzureCredential(),
+            embedding_cache=EmbeddingCache(cache_path),
+        )
+        assert await embeddings.create_embeddings(texts=["foo", "bar", "foo"]) == [[1.0, 0.1], [1.0, 0.1], [1.0, 0.1]]
+        assert inputs == [["foo", "bar"]]
+        embeddings.embedding_cache.close()
+
+        # A later run only embeds the texts that changed, and gets the cached embeddings back exactly
+        embeddings.embedding_cache = EmbeddingCache(cache_path)
+        assert await embeddings.create_embeddings(texts=["foo", "quux", "bar"]) == [
+            [1.0, 0.1],
+            [4 / 3, 0.1],
+            [1.0, 0.1],
+        ]
+        assert inputs == [["foo", "bar"], ["quux"]]
+        assert (embeddings.embedding_cache.hits, embeddings.embedding_cache.misses) == (2, 1)
+        assert embeddings.embedding_cache.stats() == "2 hits, 1 misses (67% hit ratio)"
+
+        # Token lengths counted by the text splitter are passed on for the texts that are embedded
+        monkeypatch.setattr(embeddings, "calculate_token_length", lambda text: pytest.fail("tokens counted again"))
+        assert await embeddings.create_embeddings(texts=["bar", "quuux"], token_lengths=[1, 2]) == [
+            [1.0, 0.1],
+            [5 / 3, 0.1],
+        ]
+        assert inputs[-1] == ["quuux"]
+        embeddings.embedding_cache.close()
+
+
+def test_embedding_cache_keys():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        embedding_cache = EmbeddingCache(os.path.join(tmpdirname, "embeddings.db"))
+        texts = [f"text {i}" for i in range(1200)]
+        embedding_cache.set_many("text-embedding-ada-002", texts, [[float(i)] for i in range(1200)])
+        assert embedding_cache.get_many("text-embedding-ada-002", texts) == [[float(i)] for i in range(1200)]
+        # Embeddings of another model aren't returned
+        assert embedding_cache.get_many("other-model", ["text 1"]) == [None]
+        embedding_cache.close()
+
+
+def test_split_text_into_batches_token_lengths(monkeypatch):
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name="text-embedding-ada-002",
+        credential=MockAzureCredential(),
+    )
+    texts = [f"text {i}" for i in range(20)]
+    counted = [embeddings.calculate_token_length(text) for text in texts]
+    assert get_encoding("text-embedding-ada-002") is get_encoding("text-embedding-ada-002")
+
+    # Token lengths counted by the text splitter aren't counted again
+    def fail_calculate_token_length(text):
+        raise AssertionError("Text was tokenized again")
+
+    monkeypatch.setattr(embeddings, "calculate_token_length", fail_calculate_token_length)
+    batches = embeddings.split_text_into_batches(texts, counted)
+    assert [batch.texts for batch in batches] == [texts[:16], texts[16:]]
+    assert [batch.token_length for batch in batches] == [sum(counted[:16]), sum(counted[16:])]
+    batches = embeddings.split_text_into_batches(texts, [4000] * 20)
+    assert [len(batch.texts) for batch in batches] == [2] * 10
@@ -0,0 +1,245 @@
+import random
+import re
+import time
+
+import pytest
+
+from scripts.prepdocslib.contentparsers import Page
+from scripts.prepdocslib.textsplitter import HtmlTextSplitter, TextSplitter
+
+
+def reference_split_pages(splitter: TextSplitter, pages: list[Page]) -> list[tuple[int, str]]:
+    # The previous implementation, which scans the text character by character and walks the pages for every section
+    def find_page(offset):
+        num_pages = len(pages)
+        for i in range(num_pages - 1):
+            if offset >= pages[i].offset and offset < pages[i + 1].offset:
+                return pages[i].page_num
+        return pages[num_pages - 1].page_num
+
+    sections = []
+    all_text = "".join(page.text for page in pages)
+    length = len(all_text)
+    start = 0
+    end = length
+    while start + splitter.section_overlap < length:
+        last_word = -1
+        end = start + splitter.max_section_length
+
+        if end > length:
+            end = length
+        else:
+            while (
+                end < length
+                and (end - start - splitter.max_section_length) < splitter.sentence_search_limit
+                and all_text[end] not in splitter.sentence_endings
+            ):
+                if all_text[end] in splitter.word_breaks:
+                    last_word = end
+                end += 1
+            if end < length and all_text[end] not in splitter.sentence_endings and last_word > 0:
+                end = last_word
+        if end < length:
+            end += 1
+
+        last_word = -1
+        while (
+            start > 0
+            and start > end - splitter.max_section_length - 2 * splitter.sentence_search_limit
+            and all_text[start] not in splitter.sentence_endings
+        ):
+            if all_text[start] in splitter.word_breaks:
+                last_word = start
+            start -= 1
+        if all_text[start] not in splitter.sentence_endings and last_word > 0:
+            start = last_word
+        if start > 0:
+            start += 1
+
+        section_text = all_text[start:end]
+        sections.append((find_page(start), section_text))
+
+        last_table_start = section_text.rfind("<table")
+        if last_table_start > 2 * splitter.sentence_search_limit and last_table_start > section_text.rfind("</table"):
+            start = min(end - splitter.section_overlap, start + last_table_start)
+        else:
+            start = end - splitter.section_overlap
+
+    if start + splitter.section_overlap < end:
+        sections.append((find_page(start), all_text[start:end]))
+    return sections
+
+
+def split_pages(splitter: TextSplitter, pages: list[Page]) -> list[tuple[int, str]]:
+    return [(split_page.page_num, split_page.text) for split_page in splitter.split_pages(pages)]
+
+
+def create_pages(rng: random.Random, num_pages: int, words_per_page: int) -> list[Page]:
+    words = ["manual", "valve", "pressure", "(see", "figure)", "step:", "a", "b;", "c,", "{x}", "[y]", "end.", "stop!"]
+    words += ["why?", "\n", "\t", "averyveryverylongwordwithoutbreaks" * 5]
+    pages = []
+    offset = 0
+    for page_num in range(num_pages):
+        text = "".join(rng.choice(words) + rng.choice(["", " "]) for _ in range(rng.randint(0, words_per_page)))
+        pages.append(Page(page_num=page_num, offset=offset, text=text))
+        offset += len(text)
+    return pages
+
+
+def test_split_pages_matches_reference():
+    rng = random.Random(42)
+    splitter = TextSplitter()
+    for _ in range(200):
+        pages = create_pages(rng, num_pages=rng.randint(1, 8), words_per_page=rng.choice([5, 100, 600]))
+        assert split_pages(splitter, pages) == reference_split_pages(splitter, pages)
+
+
+def test_split_pages_matches_reference_small_limits():
+    rng = random.Random(7)
+    splitter = TextSplitter()
+    splitter.max_section_length = 60
+    splitter.sentence_search_limit = 10
+    splitter.section_overlap = 15
+    for _ in range(200):
+        pages = create_pages(rng, num_pages=rng.randint(1, 4), words_per_page=80)
+        assert split_pages(splitter, pages) == reference_split_pages(splitter, pages)
+
+
+def test_split_pages_matches_reference_tables():
+    rng = random.Random(11)
+    splitter = TextSplitter()
+    for _ in range(50):
+        pages = create_pages(rng, num_pages=3, words_per_page=300)
+        for page in pages:
+            rows = "".join(f"<tr><td>Row {i}, step {i}.</td><td>Value {i}</td></tr>" for i in range(rng.randint(1, 60)))
+            page.text += f"<table>{rows}</table>"
+        offset = 0
+        for page in pages:
+            page.offset = offset
+            offset += len(page.text)
+        assert split_pages(splitter, pages) == reference_split_pages(splitter, pages)
+
+
+def test_split_pages_matches_reference_unordered_offsets():
+    # Parsers may report offsets that don't follow the order of the pages, the page lookup still agrees
+    rng = random.Random(3)
+    splitter = TextSplitter()
+    pages = create_pages(rng, num_pages=6, words_per_page=400)
+    pages[2].offset, pages[4].offset = pages[4].offset, pages[2].offset
+    assert split_pages(splitter, pages) == reference_split_pages(splitter, pages)
+    pages = [Page(page_num=page.page_num, offset=page.offset + 5000, text=page.text) for page in pages]
+    assert split_pages(splitter, pages) == reference_split_pages(splitter, pages)
+
+
+def test_split_pages_merged_manual():
+    rng = random.Random(0)
+    splitter = TextSplitter()
+    pages = create_pages(rng, num_pages=300, words_per_page=250)
+    assert split_pages(splitter, pages) == reference_split_pages(splitter, pages)
+
+
+@pytest.mark.benchmark
+def test_split_pages_merged_manual_benchmark():
+    # Micro-benchmark: splitting a multi-megabyte manual with many pages is much faster than the previous splitter
+    rng = random.Random(0)
+    splitter = TextSplitter()
+    pages = create_pages(rng, num_pages=1500, words_per_page=250)
+    assert sum(len(page.text) for page in pages) > 2_000_000
+
+    start = time.perf_counter()
+    sections = split_pages(splitter, pages)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reference_sections = reference_split_pages(splitter, pages)
+    reference_seconds = time.perf_counter() - start
+
+    assert sections == reference_sections
+    assert seconds * 3 < reference_seconds
+
+
+def test_split_pages_max_tokens():
+    rng = random.Random(5)
+    pages = create_pages(rng, num_pages=4, words_per_page=600)
+    pages.append(Page(page_num=4, offset=sum(len(page.text) for page in pages), text="averyveryverylongword" * 60))
+    split_pages = list(TextSplitter(max_tokens=60).split_pages(pages))
+    reference_split_pages = list(TextSplitter().split_pages(pages))
+
+    # Sections with more tokens are split further, at sentence endings or word breaks, and carry their token count
+    splitter = TextSplitter()
+    assert len(split_pages) > len(reference_split_pages)
+    assert all(split_page.token_count == splitter.count_tokens(split_page.text) for split_page in split_pages)
+    assert all(split_page.token_count <= 60 for split_page in split_pages if len(split_page.text) > 1)
+    assert "".join(split_page.text for split_page in split_pages) == "".join(
+        split_page.text for split_page in reference_split_pages
+    )
+    assert all(split_page.token_count is None for split_page in reference_split_pages)
+
+
+def create_manual(num_sections: int, steps_per_section: int) -> str:
+    sections = []
+    for i in range(num_sections):
+        steps = "".join(
+            f"<li>Turn the valve {j} clockwise until it stops. Check the pressure.</li>"
+            for j in range(steps_per_section)
+        )
+        rows = "".join(f"<tr><td>Part {j}</td><td>Torque {j} Nm</td></tr>" for j in range(steps_per_section))
+        sections.append(
+            f"<!-- Start of section about Valve {i} -->"
+            f'<section id="SEC-{i}" class="section" name="valve-{i}"><h3>Replace valve {i}</h3>'
+            f"Read the safety instructions before replacing the valve."
+            f'<h4 id="SUB-{i}">Procedure</h4><!-- This subsection is part of the parent section : Replace valve {i} -->'
+            f'<ol id="ordered-list">{steps}</ol><h4 id="TAB-{i}">Parts</h4><table class="xml-table">{rows}</table>'
+            "</section>"
+        )
+    return "<html><body>" + "".join(sections) + "</body></html>"
+
+
+def test_html_splitter_sections():
+    splitter = HtmlTextSplitter(max_tokens=2000)
+    html = create_manual(num_sections=3, steps_per_section=2)
+    split_pages = list(splitter.split_pages([Page(page_num=0, offset=0, text=html)]))
+
+    # Sections that fit are chunks of their own, anchored to the section
+    assert [split_page.anchor for split_page in split_pages] == [None, "SEC-0", "SEC-1", "SEC-2"]
+    assert split_pages[1].text.startswith('<!-- Start of section about Valve 0 --><section id="SEC-0"')
+    assert split_pages[1].text.endswith("</section>")
+    assert "".join(split_page.text for split_page in split_pages) == html
+
+
+def test_html_splitter_long_sections():
+    html = create_manual(num_sections=2, steps_per_section=12)
+    step = "<li>Turn the valve 10 clockwise until it stops. Check the pressure.</li>"
+    max_tokens = HtmlTextSplitter().count_tokens(step) * 4
+    splitter = HtmlTextSplitter(max_tokens=max_tokens)
+    split_pages = list(splitter.split_pages([Page(page_num=0, offset=0, text=html)]))
+
+    assert all(
+        split_page.token_count == splitter.count_tokens(split_page.text) <= max_tokens for split_page in split_pages
+    )
+    # Long sections are split at headings, list items and table rows, and never inside them
+    for split_page in split_pages:
+        text = re.sub(r"^<h3>Replace valve \d</h3>", "", split_page.text)
+        assert text.startswith("<"), text
+        assert text.count("<li>") == text.count("</li>")
+        assert text.count("<tr>") == text.count("</tr>")
+    assert any(split_page.text.count("<li>") >= 3 for split_page in split_pages)
+    # Chunks of a section after the first repeat its title, and subsections are anchored to their heading
+    section_pages = [split_page for split_page in split_pages if split_page.anchor in ("SEC-1", "SUB-1", "TAB-1")]
+    assert section_pages[0].anchor == "SEC-1"
+    assert "<h3>Replace valve 1</h3>Read the safety instructions" in section_pages[0].text
+    assert all(split_page.text.startswith("<h3>Replace valve 1</h3>") for split_page in section_pages[1:])
+    assert [split_page.anchor for split_page in section_pages if '<h4 id="SUB-1">' in split_page.text] == ["SUB-1"]
+    assert [split_page.anchor for split_page in section_pages if '<h4 id="TAB-1">' in split_page.text] == ["TAB-1"]
+
+
+def test_html_splitter_long_text():
+    # Text without structure falls back to sentences and words
+    sentence = "A long sentence for the index. "
+    max_tokens = HtmlTextSplitter().count_tokens(sentence) * 3
+    splitter = HtmlTextSplitter(max_tokens=max_tokens)
+    text = sentence * 100 + "averyveryverylongwordwithoutbreaks" * 40
+    split_pages = list(splitter.split_pages([Page(page_num=0, offset=0, text=text)]))
+
+    assert all(splitter.count_tokens(split_page.text) <= max_tokens for split_page in split_pages)
+    assert [split_page.text for split_page in split_pages[:33]] == [sentence * 3] * 33
+    assert "".join(split_page.text for split_page in split_pages) == text